@@ -24,16 +24,31 @@ REACTION_EMOJIS = {
     'room_stats': '📊',            # ルーム統計表示
     'guild_info': '🏛️',            # ギルド情報収集
     'processing': '⏳',            # 処理中
+    'busy': '🚧',                  # 混雑中（後で再試行）
     'success': '✅',               # 成功
     'error': '❌',                 # エラー
 }
 
+# 機能ごとのトリガーキーワード（全機能分をまとめて1回の走査で判定）
+# 英数字のキーワードは単語の境界でのみ一致し、漢字1文字のキーワードは前後が漢字でない場合のみ一致
+TRIGGER_KEYWORDS = {
+    'chatgpt_text': ['chatgpt', 'gpt', '質問', 'おしえて', '教えて', '会話', '話', 'ai'],
+    'chat_collect': ['チャット収集', 'ログ収集', 'chat collect', 'collect', '履歴収集', 'history'],
+    'room_stats': ['ルーム統計', 'room stats', '統計', 'stats', 'ログ統計', '部屋統計'],
+    'guild_info': ['ギルド情報', 'guild info', 'サーバー情報', 'server info', 'メンバー情報', 'member info'],
+}
+
 # ChatGPT設定
 CHATGPT_CONFIG = {
     'vision_model': 'gpt-4o',
+    'vision_detail': 'adaptive',    # 'low' / 'high' / 'auto' / 'adaptive'（低詳細度から必要時のみ昇格）
     'text_model': 'gpt-4',
     'max_tokens': 1000,
     'max_message_length': 1900,
+    'max_parallel_attachments': 3,  # 1メッセージ内の添付を同時に処理する上限
+    'stream_responses': True,       # 応答をストリーミングで逐次表示
+    'stream_edit_interval': 1.0,    # メッセージ編集の最短間隔（秒）
+    'stream_edit_tokens': 40,       # 最短間隔に加えて、このトークン数がたまるまで編集しない
 }
 
 # ボット設定
@@ -43,4 +58,205 @@ BOT_CONFIG = {
     'intents_reactions': True,
     'intents_voice_states': True,
     'target_channel_id': 1418512165165465600,  # 対象チャンネル指定
-}
\ No newline at end of file
+    'max_messages': 100,            # discord.pyのメッセージキャッシュ件数（リアクション対象は別途取得するため小さくてよい）
+    'fetched_message_cache_size': 128,  # リアクション対象として取得したメッセージを保持する件数
+}
+# OpenAI共有クライアント設定
+OPENAI_CLIENT_CONFIG = {
+    'timeout': 60.0,                # リクエスト全体のタイムアウト（秒）
+    'connect_timeout': 5.0,         # 接続確立のタイムアウト（秒）
+    'max_connections': 20,          # 同時接続数の上限
+    'max_keepalive_connections': 10,  # 再利用のため保持する接続数
+    'keepalive_expiry': 60.0,       # アイドル接続を保持する時間（秒）
+    'max_retries': 0,               # SDK内部のリトライ回数（再試行はスロットラーが担当）
+    'warmup_on_ready': True,        # on_readyで接続を事前確立
+    'base_url': None,               # APIの接続先（Noneなら環境変数OPENAI_BASE_URL、未設定なら公式API）
+}
+
+# ローカルのOpenAI互換モックサーバー設定（mock_openai_server.py、負荷試験用）
+MOCK_OPENAI_CONFIG = {
+    'host': '127.0.0.1',
+    'port': 8089,
+    'seed': 0,                      # 乱数シード（同じ値なら同じ遅延・エラー列を再現）
+    'latency': {                    # エンドポイントごとの遅延分布（秒）
+        'chat': {'distribution': 'lognormal', 'median': 0.8, 'sigma': 0.5},
+        'vision': {'distribution': 'lognormal', 'median': 2.5, 'sigma': 0.4},
+        'audio': {'distribution': 'uniform', 'min': 1.0, 'max': 4.0},
+        'models': {'distribution': 'fixed', 'value': 0.05},
+    },
+    'stream_token_interval': 0.02,  # ストリーミング時のトークン間隔（秒）
+    'completion_tokens': (20, 400), # 応答トークン数の範囲（max_tokensで打ち切り）
+    'error_rate': 0.0,              # 500エラーを返す確率
+    'rate_limit_rate': 0.0,         # 429をランダムに返す確率
+    'requests_per_minute': 500,     # 擬似的なレート制限（x-ratelimit-*ヘッダーにも反映）
+    'tokens_per_minute': 200000,
+}
+
+# ジョブキュー設定（機能ごとのワーカー数と最大待機数）
+JOB_QUEUE_CONFIG = {
+    'image_ocr': {'workers': 2, 'max_queue': 20},
+    'voice_transcribe': {'workers': 1, 'max_queue': 10},
+    'chatgpt_text': {'workers': 3, 'max_queue': 30},
+}
+
+# ChatGPT応答キャッシュ設定
+RESPONSE_CACHE_CONFIG = {
+    'enabled': True,
+    'max_entries': 500,             # 保持する応答の最大件数（超過分は古い順に削除）
+    'ttl_seconds': 6 * 60 * 60,     # 応答の有効期限（秒）
+    'persist_path': 'cache/chatgpt_response_cache.json',  # Noneでメモリのみ
+    'save_delay_seconds': 5.0,      # 保存をまとめる待ち時間（秒）
+}
+
+# OCR結果キャッシュ設定（画像のSHA-256・モデル・プロンプト版をキーに保存）
+OCR_CACHE_CONFIG = {
+    'enabled': True,
+    'db_path': 'cache/ocr_results.sqlite3',
+    'max_entries': 5000,            # 保持する結果の最大件数
+    'max_bytes': 50 * 1024 * 1024,  # 保存テキストの合計サイズ上限
+}
+
+# 文字起こし結果キャッシュ設定（音声のSHA-256・言語をキーに保存）
+TRANSCRIPTION_CACHE_CONFIG = {
+    'enabled': True,
+    'db_path': 'cache/transcriptions.sqlite3',
+    'max_entries': 2000,            # 保持する結果の最大件数
+    'max_bytes': 100 * 1024 * 1024, # 保存テキストの合計サイズ上限
+}
+
+# ジョブ重複排除設定（同じメッセージ・機能の処理をまとめる）
+SINGLE_FLIGHT_CONFIG = {
+    'enabled': True,                # 完了済み結果の索引を使って以前の返信へリンクする
+    'db_path': 'cache/completed_jobs.sqlite3',
+    'max_entries': 5000,            # 索引に保持する完了済みジョブ数
+}
+
+# 画像前処理設定（Vision APIへ送る前の縮小・再圧縮）
+IMAGE_PREPROCESS_CONFIG = {
+    'enabled': True,
+    'max_edge': 2048,               # 長辺の最大ピクセル数（文字が読める範囲で縮小）
+    'jpeg_quality': 85,             # 写真をJPEGで再圧縮する際の品質
+    'process_workers': 2,           # 前処理を実行するプロセス数
+}
+
+# 画像OCRの詳細度自動調整設定（vision_detail='adaptive'時）
+VISION_DETAIL_CONFIG = {
+    'tall_aspect_ratio': 2.5,       # これ以上縦長/横長の画像は最初から高詳細度
+    'dense_bytes_per_pixel': 0.6,   # 圧縮後の情報密度がこれ以上なら最初から高詳細度
+    'min_text_length': 3,           # これ未満の文字数なら高詳細度で再実行
+    'unreadable_markers': ['読み取れ', '判読', '解像度が低', 'できません'],
+}
+
+# 長時間音声の分割文字起こし設定（ffmpegが必要）
+AUDIO_CHUNK_CONFIG = {
+    'enabled': True,
+    'max_upload_bytes': 25 * 1024 * 1024,  # API上限（これを超える音声は必ず分割）
+    'probe_min_bytes': 1024 * 1024,  # これ未満の音声は長さを調べずにそのまま送信
+    'chunk_threshold_seconds': 600, # これより長い音声は分割して並列処理
+    'segment_seconds': 300,         # 1区間の長さ（秒）
+    'overlap_seconds': 5,           # 区間同士の重なり（秒）
+    'max_parallel_segments': 4,     # 同時に文字起こしする区間数
+}
+
+# OpenAIレート制限スロットラー設定（全API呼び出しで共有）
+THROTTLE_CONFIG = {
+    'initial_concurrency': 8,       # 同時実行数の初期上限
+    'min_concurrency': 1,
+    'max_concurrency': 32,
+    'decrease_factor': 0.5,         # 429・遅延急増時に上限へ掛ける係数
+    'latency_spike_factor': 3.0,    # 平均のこの倍を超えたら遅延急増とみなす
+    'latency_spike_min_seconds': 5.0,  # これ未満の遅延は急増とみなさない
+    'max_retries': 4,               # 429・接続エラー・5xxの再試行回数
+    'backoff_base': 0.5,            # 指数バックオフの初期待機秒数
+    'backoff_max': 20.0,            # 待機秒数の上限
+}
+
+# 会話コンテキスト設定（チャンネル×ユーザーごとの履歴）
+CONVERSATION_CONFIG = {
+    'max_turns': 10,                # 1会話で保持するターン数
+    'max_context_tokens': 3000,     # 履歴として送るトークン数の上限
+    'max_conversations': 1000,      # 保持する会話数（超えたら最も古い会話から削除）
+    'ttl_seconds': 3600,            # 最後の発言からこの秒数で会話を破棄
+}
+
+# 会話レーン設定（会話ごとの順序を保ちつつ別の会話は並列に応答）
+CONVERSATION_LANE_CONFIG = {
+    'scope': 'user',                # 'user': チャンネル×ユーザーごと / 'channel': チャンネルごと
+    'max_pending': 3,               # 1会話で実行中+待機できる件数（超えたら🚧で受付拒否）
+    'max_concurrent': 4,            # run()で直接実行する場合の全会話での同時応答数の上限（ジョブキュー経由ではワーカー数）
+}
+
+# モデルルーター設定（質問の長さ・複雑さ・現在のレイテンシから応答モデルを選択）
+MODEL_ROUTER_CONFIG = {
+    'enabled': True,
+    'tiers': [                      # 速い順。strongのモデルはCHATGPT_CONFIG['text_model']
+        {'name': 'fast', 'model': 'gpt-4o-mini', 'slo_p95_seconds': 8.0},
+        {'name': 'standard', 'model': 'gpt-4o', 'slo_p95_seconds': 15.0},
+        {'name': 'strong', 'model': None, 'slo_p95_seconds': 30.0},
+    ],
+    'short_prompt_tokens': 40,      # これ以下で複雑さの兆候がなければfast
+    'long_prompt_tokens': 400,      # これ以上はstrong
+    'complex_keywords': ['コード', 'プログラム', '実装', '設計', '比較', '詳しく', '理由', 'なぜ', '証明', '計算', 'エラー', 'code'],
+    'latency_window': 50,           # p95計算に使う直近の件数
+    'min_latency_samples': 10,      # これ未満の件数ではSLO判定しない
+    'latency_max_age_seconds': 600, # これより古いレイテンシは判定に使わない
+}
+
+# トークン予算設定（送信前にプロンプトを数えてmax_tokensを決定）
+TOKEN_BUDGET_CONFIG = {
+    'context_windows': {            # モデルごとのコンテキスト長
+        'gpt-4': 8192,
+        'gpt-4-turbo-preview': 128000,
+        'gpt-4o': 128000,
+        'gpt-4o-mini': 128000,
+    },
+    'default_context_window': 8192,
+    'safety_margin_tokens': 64,     # メッセージ書式などの誤差分
+    'min_completion_tokens': 400,   # 応答長の下限（これを確保できない入力は拒否）
+    'answer_ratio': 3.0,            # 想定応答長 = 入力トークン数 × この倍率（上限は各機能のmax_tokens）
+    'max_input_tokens': 3000,       # ユーザー入力がこれを超えたら末尾を切り詰め
+    'reject_input_tokens': 12000,   # ユーザー入力がこれを超えたら送信せず拒否
+}
+
+# ヘッジリクエスト設定（冪等なOpenAI呼び出しが遅いとき2本目を送り、先に返った方を使う）
+HEDGING_CONFIG = {
+    'enabled': False,               # 追加のリクエスト費用がかかるため明示的に有効化した場合のみ
+    'features': ['chatgpt_text', 'image_ocr', 'voice_transcribe'],  # ヘッジする機能（ストリーミングは対象外）
+    'hedge_percentile': 0.9,        # 1本目がこの分位のレイテンシを超えたら2本目を送る
+    'budget_ratio': 0.05,           # 機能ごとの追加リクエストの上限（全リクエスト数に対する割合）
+    'latency_window': 200,          # 分位の計算に使う直近の件数
+    'min_latency_samples': 20,      # これ未満の件数ではヘッジしない
+    'min_delay_seconds': 1.0,       # 2本目を送るまでの最短の待ち時間
+}
+
+# サーキットブレーカー設定（OpenAIの障害時にエンドポイント単位で即座に失敗させる）
+CIRCUIT_BREAKER_CONFIG = {
+    'enabled': True,
+    'endpoints': {                  # エンドポイントごとの表示名と遅延とみなす秒数
+        'chat': {'label': 'ChatGPT', 'slow_call_seconds': 30.0},
+        'vision': {'label': '画像文字起こし', 'slow_call_seconds': 40.0},
+        'audio': {'label': '音声文字起こし', 'slow_call_seconds': 50.0},  # クライアントのタイムアウト(60秒)未満にする
+    },
+    'window_seconds': 60,           # 失敗率・遅延率を計算する直近の期間
+    'min_calls': 5,                 # 期間内の呼び出しがこれ未満なら判定しない
+    'failure_rate_threshold': 0.5,  # 失敗率がこれ以上でオープン
+    'slow_call_rate_threshold': 0.8,  # 遅延率がこれ以上でオープン
+    'open_seconds': 30,             # オープン後に試行を再開するまでの秒数
+    'half_open_max_calls': 1,       # 試行中（ハーフオープン）に通す呼び出し数（残りは試行の結果を待つ）
+}
+
+# Discord送信アクションキュー設定（リアクションをルートバケットに合わせて送信）
+DISCORD_ACTION_CONFIG = {
+    'enabled': True,
+    'coalesce_seconds': 0.4,        # 一時的な絵文字の追加はこの秒数だけ待ち、間に削除されたら両方省略
+    'transient_emojis': [REACTION_EMOJIS['processing']],  # 追加を遅らせる一時的な絵文字
+    'reaction_limit': 1,            # チャンネルごとのリアクション送信数の上限（Discordのルートバケット）
+    'reaction_period': 0.25,        # 上記の上限が回復するまでの秒数
+    'worker_idle_seconds': 30,      # この秒数送信がなければチャンネルの送信タスクを終了
+}
+
+# 長文の返信設定（行・コードブロックの境界で分割し、多すぎる場合はファイルで送信）
+REPLY_DELIVERY_CONFIG = {
+    'max_chunks': 3,                # これより多く分割される長文は添付ファイル1つで送信
+    'file_preview_length': 500,     # 添付ファイルで送るときに本文に載せる冒頭の文字数
+}
@@ -0,0 +1,44 @@
+"""
+添付ファイル一括処理
+1メッセージ内の複数添付を同時実行数の上限付きで並列処理し、添付順に結果をまとめる
+"""
+
+import asyncio
+
+class AttachmentError(Exception):
+    """添付1件の処理失敗（メッセージはそのまま利用者に表示する）"""
+
+async def process_attachments(attachments, worker, max_concurrency):
+    """添付ごとにworkerを並列実行し、添付順の結果リストを返す（失敗は例外オブジェクト）"""
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(attachment):
+        async with semaphore:
+            return await worker(attachment)
+
+    return await asyncio.gather(*(run(attachment) for attachment in attachments), return_exceptions=True)
+
+def combine_attachment_results(attachments, results, empty_text, error_text):
+    """複数添付の結果を添付順に1つのテキストへまとめ、(テキスト, 全件成功したか) を返す
+    （添付が1つなら結果をそのまま返し、AttachmentError以外の失敗は再送出）"""
+    if len(attachments) == 1:
+        if isinstance(results[0], AttachmentError):
+            return str(results[0]), False
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        return results[0] or '', True
+
+    sections = []
+    succeeded = True
+    for i, (attachment, result) in enumerate(zip(attachments, results)):
+        if isinstance(result, BaseException):
+            print(f"添付処理エラー ({attachment.filename}): {result}")
+            text = str(result) if isinstance(result, AttachmentError) else error_text
+            succeeded = False
+        elif not result or not result.strip():
+            text = empty_text
+        else:
+            text = result.strip()
+        sections.append(f"=== {i+1}/{len(attachments)}: {attachment.filename} ===\n{text}")
+
+    return "\n\n".join(sections), succeeded
@@ -0,0 +1,176 @@
+"""
+長時間音声の分割文字起こし
+ffmpegで音声を重なり付きの区間に分割し、並列に文字起こしして重複を除いて結合
+"""
+
+import os
+import re
+import shutil
+import asyncio
+import tempfile
+import difflib
+from config import AUDIO_CHUNK_CONFIG
+
+DURATION_PATTERN = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def ffmpeg_available():
+    """ffmpegが利用可能かどうか"""
+    return shutil.which('ffmpeg') is not None
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def run_ffmpeg(*args):
+    """ffmpegを実行して (終了コード, 標準エラー出力) を返す"""
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-nostdin', *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # 取り消されたら作業ディレクトリが削除される前にffmpegを止める
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stderr.decode('utf-8', errors='replace')
+
+async def run_all(coroutines):
+    """TaskGroupで並列に実行して結果を順に返す（1つでも失敗したら残りを取り消し、最初の例外を送出）"""
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(coroutine) for coroutine in coroutines]
+    except ExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() for task in tasks]
+
+async def probe_duration(file_path):
+    """音声の長さ（秒）を取得（取得できない場合はNone）"""
+    _, output = await run_ffmpeg('-i', file_path)
+    match = DURATION_PATTERN.search(output)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def plan_segments(duration, segment_seconds, overlap_seconds):
+    """重なり付きの区間 (開始秒, 長さ秒) のリストを作成"""
+    step = max(1.0, segment_seconds - overlap_seconds)
+    segments = []
+    start = 0.0
+    while start < duration:
+        segments.append((start, min(segment_seconds, duration - start)))
+        if start + segment_seconds >= duration:
+            break
+        start += step
+    return segments
+
+def stitch_transcripts(texts, search_chars=200, min_match_chars=8):
+    """隣り合う区間の重なり部分を検出して重複を除きながら結合"""
+    merged = ''
+    for text in texts:
+        text = text.strip()
+        if not merged:
+            merged = text
+            continue
+        if not text:
+            continue
+
+        # 前区間の末尾と次区間の先頭で最長一致を探し、一致部分の後ろから続ける
+        tail = merged[-search_chars:]
+        head = text[:search_chars]
+        match = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+        if match.size >= min_match_chars:
+            cut = len(merged) - len(tail) + match.a + match.size
+            merged = merged[:cut] + text[match.b + match.size:]
+        else:
+            merged = f"{merged}\n{text}"
+
+    return merged
+
+async def write_source(audio_data, filename, work_dir):
+    """元の音声を作業ディレクトリに書き出してパスを返す"""
+    source_ext = os.path.splitext(filename)[1] if filename else '.mp3'
+    source_path = os.path.join(work_dir, f"source{source_ext}")
+    await asyncio.to_thread(_write_file, source_path, audio_data)
+    return source_path
+
+async def split_audio(source_path, duration, filename, work_dir):
+    """書き出し済みの音声を区間ごとのmp3ファイルに分割し、[(開始秒, バイト列), ...] を返す"""
+    segments = plan_segments(duration, AUDIO_CHUNK_CONFIG['segment_seconds'], AUDIO_CHUNK_CONFIG['overlap_seconds'])
+    print(f"[DEBUG] 音声分割: {filename} {duration:.0f}秒 -> {len(segments)}区間")
+
+    semaphore = asyncio.Semaphore(AUDIO_CHUNK_CONFIG['max_parallel_segments'])
+
+    async def extract(index, start, length):
+        segment_path = os.path.join(work_dir, f"segment_{index:03d}.mp3")
+        async with semaphore:
+            # モノラル16kHz/64kbpsに変換してアップロード量を抑える
+            returncode, output = await run_ffmpeg(
+                '-y', '-ss', f"{start:.2f}", '-t', f"{length:.2f}", '-i', source_path,
+                '-vn', '-ac', '1', '-ar', '16000', '-b:a', '64k', segment_path
+            )
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg分割エラー: {output[-300:]}")
+        return start, await asyncio.to_thread(_read_file, segment_path)
+
+    return await run_all(extract(i, start, length) for i, (start, length) in enumerate(segments))
+
+def needs_chunking(audio_size, duration):
+    """分割して文字起こしすべきかどうかを判定（durationは取得できなければNone）"""
+    if audio_size > AUDIO_CHUNK_CONFIG['max_upload_bytes']:
+        return True
+    return duration is not None and duration > AUDIO_CHUNK_CONFIG['chunk_threshold_seconds']
+
+async def transcribe_long_audio(audio_data, filename, transcribe_segment, on_segment=None):
+    """長い音声を区間ごとに並列で文字起こしして結合（分割が不要な音声ならNoneを返す）
+
+    長さの確認は1回だけ行い、書き出したファイルと長さをそのまま分割に使う。
+    transcribe_segment(segment_data, segment_filename) は区間のテキストを返すコルーチン。
+    on_segment(完了区間数, 全区間数, 先頭から連続して完了した区間のテキスト) は進捗通知用。
+    """
+    # 小さいファイルは長さを調べるまでもなく短い
+    if len(audio_data) < AUDIO_CHUNK_CONFIG['probe_min_bytes']:
+        return None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_path = await write_source(audio_data, filename, work_dir)
+        duration = await probe_duration(source_path)
+        if not needs_chunking(len(audio_data), duration):
+            return None
+        if duration is None:
+            raise ValueError("音声の長さを取得できませんでした")
+        segments = await split_audio(source_path, duration, filename, work_dir)
+
+    total = len(segments)
+    texts = [None] * total
+    done = 0
+    semaphore = asyncio.Semaphore(AUDIO_CHUNK_CONFIG['max_parallel_segments'])
+
+    async def transcribe(index, start, segment_data):
+        nonlocal done
+        async with semaphore:
+            texts[index] = await transcribe_segment(segment_data, f"segment_{index:03d}.mp3")
+        done += 1
+        print(f"[DEBUG] 区間文字起こし完了: {filename} {index+1}/{total} ({start:.0f}秒〜)")
+
+        if on_segment is not None:
+            contiguous = []
+            for text in texts:
+                if text is None:
+                    break
+                contiguous.append(text)
+            try:
+                await on_segment(done, total, stitch_transcripts(contiguous))
+            except Exception as e:
+                print(f"区間進捗通知エラー: {e}")
+
+    # 1区間でも失敗したら残りのAPI呼び出しと進捗表示を止める
+    await run_all(transcribe(i, start, data) for i, (start, data) in enumerate(segments))
+    return stitch_transcripts(texts)
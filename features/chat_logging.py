@@ -5,8 +5,11 @@
 
 import os
 import json
+import asyncio
 import datetime
 from config import BOT_CONFIG
+from features.discord_actions import discord_actions, PRIORITY_COSMETIC
+from features.trigger_registry import trigger_registry
 
 class ChatLogger:
     def __init__(self):
@@ -41,6 +44,15 @@ class ChatLogger:
             print(f"チャットログ保存エラー: {e}")
             return None
 
+    def append_daily_log(self, log_entry):
+        """日ごとの簡易ログファイルに1行追記"""
+        daily_log_file = os.path.join(
+            self.log_dir,
+            f"daily_{datetime.datetime.now().strftime('%Y%m%d')}.txt"
+        )
+        with open(daily_log_file, 'a', encoding='utf-8') as f:
+            f.write(log_entry)
+
     async def collect_channel_history(self, channel, limit=100):
         """チャンネルの履歴を収集"""
         try:
@@ -75,17 +87,11 @@ async def handle_chat_logging(message):
         return False
 
     try:
-        # 簡易ログファイルにリアルタイム記録
-        daily_log_file = os.path.join(
-            chat_logger.log_dir,
-            f"daily_{datetime.datetime.now().strftime('%Y%m%d')}.txt"
-        )
-
+        # 簡易ログファイルにリアルタイム記録（並列に動く他の段階を止めないようスレッドで書き込み）
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_entry = f"[{timestamp}] {message.guild.name}#{message.channel.name} {message.author.name}: {message.content}\n"
 
-        with open(daily_log_file, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
+        await asyncio.to_thread(chat_logger.append_daily_log, log_entry)
 
         if BOT_CONFIG.get('debug_level') == 'DEBUG':
             print(f"チャットログ記録: {message.guild.name}#{message.channel.name}")
@@ -129,14 +135,14 @@ async def handle_chat_collection_reaction(message, bot):
 
     try:
         # 処理開始を通知
-        await message.add_reaction(REACTION_EMOJIS['processing'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['processing'])
 
         # ギルドの全チャンネル履歴を収集
         collected_files = await collect_all_channels_history_with_files(bot, message.guild)
 
         # 結果を送信
         if collected_files:
-            await message.reply(f"**📜 チャット履歴収集完了:**\n`{len(collected_files)}チャンネル`の履歴を収集しました。")
+            await discord_actions.reply(message, f"**📜 チャット履歴収集完了:**\n`{len(collected_files)}チャンネル`の履歴を収集しました。")
 
             # 収集したファイルをDiscordに送信
             for file_path in collected_files[:5]:  # 最大5ファイルまで送信
@@ -151,18 +157,16 @@ async def handle_chat_collection_reaction(message, bot):
             if len(collected_files) > 5:
                 await message.channel.send(f"**注意:** {len(collected_files) - 5}個のファイルは制限により表示されていません。")
         else:
-            await message.reply("チャット履歴の収集に失敗しました。権限を確認してください。")
+            await discord_actions.reply(message, "チャット履歴の収集に失敗しました。権限を確認してください。")
 
         # 処理完了を通知
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['success'])
+        discord_actions.finish_processing(message, REACTION_EMOJIS['success'], bot.user)
         return True
 
     except Exception as e:
         print(f"チャット収集処理エラー: {str(e)}")
-        await message.reply("チャット履歴収集中にエラーが発生しました。")
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['error'])
+        await discord_actions.reply(message, "チャット履歴収集中にエラーが発生しました。")
+        discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
         return False
 
 async def collect_all_channels_history_with_files(bot, guild):
@@ -192,7 +196,7 @@ async def collect_all_channels_history_with_files(bot, guild):
         print(f"全履歴収集エラー: {e}")
         return []
 
-async def auto_add_chat_collect_reaction(message):
+async def auto_add_chat_collect_reaction(message, triggers=None):
     """特定のキーワードメッセージに自動で📜リアクションを追加"""
     from config import BOT_CONFIG, REACTION_EMOJIS
 
@@ -201,9 +205,10 @@ async def auto_add_chat_collect_reaction(message):
         return False
 
     # 特定のキーワードでチャット収集をトリガー
-    trigger_keywords = ['チャット収集', 'ログ収集', 'chat collect', 'collect', '履歴収集', 'history']
-    if message.content and any(keyword in message.content.lower() for keyword in trigger_keywords):
+    if triggers is None:
+        triggers = trigger_registry.match(message.content)
+    if 'chat_collect' in triggers:
         print(f"[DEBUG] 📜リアクション追加: チャット収集トリガー")
-        await message.add_reaction(REACTION_EMOJIS['chat_collect'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['chat_collect'], PRIORITY_COSMETIC)
         return True
     return False
\ No newline at end of file
@@ -3,43 +3,200 @@ ChatGPTテキスト会話機能
 テキストメッセージに対するChatGPT応答
 """
 
-import os
-from openai import OpenAI
-from config import CHATGPT_CONFIG
+import time
+from config import CHATGPT_CONFIG, RESPONSE_CACHE_CONFIG
+from features.openai_client import get_openai_client
+from features.openai_throttle import openai_throttler
+from features.request_hedging import request_hedger
+from features.circuit_breaker import circuit_breakers, CircuitOpenError
+from features.discord_actions import discord_actions
+from features.reply_delivery import send_long_reply, split_first_chunk
+from features.trigger_registry import trigger_registry
+from features.token_budget import token_budget, TokenBudgetError
+from features.conversation_store import conversation_store
+from features.model_router import model_router
+from features.response_cache import chatgpt_response_cache
 
-async def get_chatgpt_response(user_message):
-    """ChatGPT APIでテキスト応答を取得"""
+class ChatReplyError(Exception):
+    """利用者にそのまま表示するChatGPT応答の失敗"""
+
+def describe_chat_error(error):
+    """応答に失敗した理由を利用者向けのメッセージにする"""
+    if isinstance(error, ChatReplyError):
+        return str(error)
+    if isinstance(error, TokenBudgetError):
+        return f"⚠️ {error}"
+    if isinstance(error, CircuitOpenError):
+        return f"⚡ {error}"
+    return "ChatGPTとの会話でエラーが発生しました。"
+
+def make_response_cache_key(user_message, route):
+    """ルーターが選んだ階層・モデルごとに応答キャッシュのキーを作成"""
+    return chatgpt_response_cache.make_key(user_message, f"{route['tier']}:{route['model']}", CHATGPT_CONFIG['max_tokens'])
+
+def lookup_cached_response(user_message, route):
+    """応答キャッシュを検索（無効またはミスの場合はNone）"""
+    if not RESPONSE_CACHE_CONFIG['enabled']:
+        return None
+
+    cache_key = make_response_cache_key(user_message, route)
+    cached_text = chatgpt_response_cache.get(cache_key)
+    if cached_text is not None:
+        stats = chatgpt_response_cache.get_stats()
+        print(f"[DEBUG] 応答キャッシュヒット (ヒット: {stats['hits']}, ミス: {stats['misses']})")
+    return cached_text
+
+def store_cached_response(user_message, route, response_text):
+    """正常な応答を、応答したモデルのキーでキャッシュに保存"""
+    if not RESPONSE_CACHE_CONFIG['enabled'] or not response_text or not response_text.strip():
+        return
+
+    cache_key = make_response_cache_key(user_message, route)
+    chatgpt_response_cache.set(cache_key, response_text)
+
+def get_conversation_history(conversation_key):
+    """(チャンネルID, ユーザーID) の会話履歴をmessages形式で取得"""
+    if conversation_key is None:
+        return []
+    return conversation_store.build_messages(*conversation_key)
+
+def remember_turn(conversation_key, user_message, response_text, model):
+    """応答できたターンを会話履歴に追加（トークン数は応答に使ったモデルで数える）"""
+    if conversation_key is None or not response_text or not response_text.strip():
+        return
+    conversation_store.add_turn(*conversation_key, user_message, response_text, model)
+
+def build_chat_request(user_message, history=None, model=None):
+    """入力をトークン予算に収めて (messages, 予算) を返す（収まらない場合はTokenBudgetError）"""
+    model = model or CHATGPT_CONFIG['text_model']
+    user_message = token_budget.fit_input('chatgpt_text', user_message, model)
+    messages = list(history or []) + [
+        {
+            "role": "user",
+            "content": user_message
+        }
+    ]
+    # 履歴の分だけ応答を長くしないよう、想定応答長は今回の発言から見積もる
+    budget = token_budget.plan('chatgpt_text', model, messages, CHATGPT_CONFIG['max_tokens'],
+                               expected_completion_tokens=token_budget.expected_answer_tokens(user_message, model))
+    return messages, budget
+
+async def get_chatgpt_response(user_message, conversation_key=None):
+    """ChatGPT APIでテキスト応答を取得（conversation_key指定時は会話履歴を含める）
+
+    失敗は例外で返し、エラー表示がキャッシュや会話履歴に残らないようにする
+    """
+    history = get_conversation_history(conversation_key)
+
+    # 応答キャッシュは履歴のない単発の質問にだけ、ルーティング後のモデル単位で使う
+    route = model_router.route(user_message, history)
+    if not history:
+        cached_text = lookup_cached_response(user_message, route)
+        if cached_text is not None:
+            remember_turn(conversation_key, user_message, cached_text, route['model'])
+            return cached_text
+
+    # 共有クライアントを取得
+    client = get_openai_client()
+    if client is None:
+        raise ChatReplyError("OpenAI APIキーが設定されていません。")
+
+    messages, budget = build_chat_request(user_message, history, route['model'])
+    start = time.monotonic()
     try:
-        OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-        if not OPENAI_API_KEY:
-            return "OpenAI APIキーが設定されていません。"
-
-        # APIキーをクリーンアップ（改行や空白を除去）
-        OPENAI_API_KEY = OPENAI_API_KEY.strip().replace('\n', '').replace(' ', '')
-        print(f"[DEBUG] OpenAI APIキー長: {len(OPENAI_API_KEY)}")
-
-        # OpenAIクライアントを初期化
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
-        response = client.chat.completions.create(
-            model=CHATGPT_CONFIG['text_model'],
-            messages=[
-                {
-                    "role": "user",
-                    "content": user_message
-                }
-            ],
-            max_tokens=CHATGPT_CONFIG['max_tokens']
-        )
+        async with circuit_breakers.guard('chat'):
+            # 階層ごとにレイテンシが大きく違うため、ヘッジの待ち時間はモデル別に計算
+            response = await request_hedger.call(
+                'chatgpt_text',
+                lambda: openai_throttler.call(
+                    route['model'],
+                    lambda: client.chat.completions.with_raw_response.create(
+                        model=route['model'],
+                        messages=messages,
+                        max_tokens=budget['max_tokens']
+                    ),
+                    estimated_tokens=budget['prompt_tokens'] + budget['max_tokens']
+                ),
+                latency_key=f"chatgpt_text:{route['model']}"
+            )
+    except CircuitOpenError:
+        raise
+    except Exception:
+        model_router.record_latency(route, time.monotonic() - start, success=False)
+        raise
+    model_router.record_latency(route, time.monotonic() - start)
+    token_budget.record_usage(budget, response.usage, response.choices[0].finish_reason)
+
+    response_text = response.choices[0].message.content
+    if not history:
+        store_cached_response(user_message, route, response_text)
+    remember_turn(conversation_key, user_message, response_text, route['model'])
+    return response_text
+
+async def stream_chatgpt_response(user_message, conversation_key=None, route=None):
+    """ChatGPT APIの応答をトークン単位で逐次取得（完了したら会話履歴に追加）
 
-        return response.choices[0].message.content
+    失敗は応答テキストに混ぜずに例外で通知する（TokenBudgetError / CircuitOpenError / ChatReplyError など）
+    """
+    client = get_openai_client()
+    if client is None:
+        raise ChatReplyError("OpenAI APIキーが設定されていません。")
 
+    history = get_conversation_history(conversation_key)
+    if route is None:
+        route = model_router.route(user_message, history)
+    messages, budget = build_chat_request(user_message, history, route['model'])
+    await circuit_breakers.wait_for_probe('chat')
+    circuit_breakers.before_call('chat')
+
+    usage = None
+    finish_reason = None
+    response_text = ""
+    start = time.monotonic()
+    paused = 0.0
+    try:
+        stream = await openai_throttler.call(
+            route['model'],
+            lambda: client.chat.completions.with_raw_response.create(
+                model=route['model'],
+                messages=messages,
+                max_tokens=budget['max_tokens'],
+                stream=True,
+                stream_options={"include_usage": True}  # 最後のチャンクで使用量を受け取る
+            ),
+            estimated_tokens=budget['prompt_tokens'] + budget['max_tokens']
+        )
+
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices[0].delta.content:
+                response_text += chunk.choices[0].delta.content
+                # 呼び出し側がメッセージ編集している間はレイテンシに含めない
+                yielded_at = time.monotonic()
+                yield chunk.choices[0].delta.content
+                paused += time.monotonic() - yielded_at
     except Exception as e:
-        print(f"ChatGPTテキスト応答エラー: {str(e)}")
-        return "エラーが発生しました。"
+        model_router.record_latency(route, time.monotonic() - start - paused, success=False)
+        circuit_breakers.record('chat', time.monotonic() - start - paused, e)
+        raise
+    except BaseException as e:
+        # 呼び出し側が途中で読むのをやめた場合も、ハーフオープンの試行枠を戻すために記録
+        circuit_breakers.record('chat', time.monotonic() - start - paused, e)
+        raise
 
-async def handle_chatgpt_conversation(message):
-    """ChatGPTとのテキスト会話処理"""
+    # ストリーミングでも応答全体の所要時間を階層のレイテンシとして記録
+    model_router.record_latency(route, time.monotonic() - start - paused)
+    circuit_breakers.record('chat', time.monotonic() - start - paused)
+    token_budget.record_usage(budget, usage, finish_reason)
+    remember_turn(conversation_key, user_message, response_text, route['model'])
+
+def is_chatgpt_trigger(message, triggers=None):
+    """ChatGPT応答の対象メッセージかどうかを判定（triggersは照合済みのトリガー）"""
     from config import BOT_CONFIG
 
     print(f"[DEBUG] ChatGPT処理開始: チャンネルID={message.channel.id}, メッセージ='{message.content}'")
@@ -56,32 +213,124 @@ async def handle_chatgpt_conversation(message):
         print(f"[DEBUG] チャンネルID不一致のためスキップ")
         return False
 
-    # 特定のキーワードでChatGPT応答をトリガー（テスト用に拡張）
-    trigger_keywords = ['chatgpt', 'gpt', '質問', 'おしえて', '教えて', '会話', '話', 'ai']
-    content_lower = message.content.lower()
-    print(f"[DEBUG] キーワード検索: '{content_lower}' in {trigger_keywords}")
-    if not any(keyword in content_lower for keyword in trigger_keywords):
+    # 特定のキーワードでChatGPT応答をトリガー（キーワードはTRIGGER_KEYWORDSで設定）
+    if triggers is None:
+        triggers = trigger_registry.match(message.content)
+    if 'chatgpt_text' not in triggers:
         print(f"[DEBUG] トリガーキーワード未検出のためスキップ")
         return False
 
-    print(f"[DEBUG] ChatGPTテキスト会話トリガー成功: {message.content}")
+    print(f"[DEBUG] ChatGPTテキスト会話トリガー成功: '{triggers['chatgpt_text']}' in {message.content}")
+    return True
+
+async def send_chatgpt_reply(message, response_text):
+    """応答テキストを返信（長すぎる場合は分割、分割数が多ければファイルで送信）"""
+    return await send_long_reply(message, response_text, "🤖 ChatGPT応答", "chatgpt_response.md")
+
+async def stream_reply_with_chatgpt(message):
+    """プレースホルダーを返信し、ストリーミング応答に合わせて編集"""
+    conversation_key = (message.channel.id, message.author.id)
+    history = get_conversation_history(conversation_key)
+    use_cache = not history
 
+    # 単発の質問でキャッシュヒットした場合はストリーミングせずに即座に返信
+    route = model_router.route(message.content, history)
+    if use_cache:
+        cached_text = lookup_cached_response(message.content, route)
+        if cached_text is not None:
+            remember_turn(conversation_key, message.content, cached_text, route['model'])
+            await send_chatgpt_reply(message, cached_text)
+            return True
+
+    max_length = CHATGPT_CONFIG['max_message_length']
+    edit_interval = CHATGPT_CONFIG['stream_edit_interval']
+    edit_tokens = CHATGPT_CONFIG['stream_edit_tokens']
+    header = "**🤖 ChatGPT応答:**\n"
+    continued_header = "**🤖 ChatGPT応答 (続き):**\n"
+    cursor = " ▌"
+
+    start = time.monotonic()
+    reply = None
+    current_header = header
+    current_text = ""
+    full_text = ""
     try:
-        # ChatGPT応答を取得
-        response_text = await get_chatgpt_response(message.content)
-
-        # 長すぎる場合は分割して送信
-        max_length = CHATGPT_CONFIG['max_message_length']
-        if len(response_text) > max_length:
-            chunks = [response_text[i:i+max_length] for i in range(0, len(response_text), max_length)]
-            for i, chunk in enumerate(chunks):
-                await message.reply(f"**🤖 ChatGPT応答 ({i+1}/{len(chunks)}):**\n{chunk}")
+        reply = await discord_actions.reply(message, f"{header}考え中...{cursor}")
+
+        pending_tokens = 0
+        last_edit = time.monotonic()
+        first_token_at = None
+
+        async for delta in stream_chatgpt_response(message.content, conversation_key, route):
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+                print(f"[DEBUG] ChatGPT最初のトークン受信: {(first_token_at - start) * 1000:.0f}ms")
+
+            current_text += delta
+            full_text += delta
+            pending_tokens += 1
+
+            # 文字数上限を超えたら行・コードブロックの境界で現在のメッセージを確定し、次のメッセージへ
+            body_limit = max_length - len(current_header) - len(cursor)
+            while len(current_text) > body_limit:
+                head, current_text = split_first_chunk(current_text, body_limit)
+                await discord_actions.edit(reply, content=f"{current_header}{head}")
+                current_header = continued_header
+                body_limit = max_length - len(current_header) - len(cursor)
+                reply = await discord_actions.send(message.channel, f"{current_header}{current_text[:body_limit]}{cursor}")
+                pending_tokens = 0
+                last_edit = time.monotonic()
+
+            # レート制限に配慮し、最短間隔を空けたうえで一定トークン数たまったら編集
+            if time.monotonic() - last_edit >= edit_interval and pending_tokens >= edit_tokens:
+                await discord_actions.edit(reply, content=f"{current_header}{current_text}{cursor}")
+                pending_tokens = 0
+                last_edit = time.monotonic()
+
+        if not current_text.strip() and current_header == header:
+            current_text = "応答を取得できませんでした。"
+        await discord_actions.edit(reply, content=f"{current_header}{current_text}")
+        if use_cache:
+            store_cached_response(message.content, route, full_text)
+
+        print(f"[DEBUG] ChatGPTストリーミング応答完了: {(time.monotonic() - start) * 1000:.0f}ms")
+        return True
+
+    except Exception as e:
+        # エラー表示はキャッシュにも会話履歴にも残さない
+        print(f"ChatGPTストリーミング応答エラー: {str(e)}")
+        notice = describe_chat_error(e)
+        if reply is not None:
+            await discord_actions.edit(reply, content=f"{current_header}{current_text}\n{notice}")
         else:
-            await message.reply(f"**🤖 ChatGPT応答:**\n{response_text}")
+            await discord_actions.reply(message, notice)
+        return False
+
+async def reply_with_chatgpt(message):
+    """ChatGPT応答を取得してメッセージに返信"""
+    # OpenAI側の不調でブレーカーがオープン中なら待たずにすぐ返信
+    open_error = circuit_breakers.open_error('chat')
+    if open_error is not None:
+        await discord_actions.reply(message, f"⚡ {open_error}")
+        return False
 
+    if CHATGPT_CONFIG.get('stream_responses'):
+        return await stream_reply_with_chatgpt(message)
+
+    try:
+        # ChatGPT応答を取得
+        response_text = await get_chatgpt_response(message.content, (message.channel.id, message.author.id))
+        await send_chatgpt_reply(message, response_text)
         return True
 
     except Exception as e:
         print(f"ChatGPT会話処理エラー: {str(e)}")
-        await message.reply("ChatGPTとの会話でエラーが発生しました。")
-        return False
\ No newline at end of file
+        await discord_actions.reply(message, describe_chat_error(e))
+        return False
+
+async def handle_chatgpt_conversation(message):
+    """ChatGPTとのテキスト会話処理"""
+    if not is_chatgpt_trigger(message):
+        return False
+
+    return await reply_with_chatgpt(message)
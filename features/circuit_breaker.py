@@ -0,0 +1,201 @@
+"""
+サーキットブレーカー
+OpenAIのエンドポイント（chat / vision / audio）ごとに直近の失敗率と遅延率を監視し、
+しきい値を超えたら一定時間は呼び出さずに即座に失敗させ、その後は少数の試行で回復を確認
+（試行中に来た呼び出しは、添付や区間の並列処理が失敗しないよう試行の結果が出るまで待たせる）
+"""
+
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from config import CIRCUIT_BREAKER_CONFIG
+
+# 上流の障害とみなす例外（入力の誤りなどはブレーカーの判定に含めない）
+UPSTREAM_ERRORS = (RateLimitError, APIConnectionError, InternalServerError, TimeoutError)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+    """ブレーカーがオープン中で呼び出しを行わなかった場合の例外"""
+
+    def __init__(self, endpoint, label, retry_after):
+        super().__init__(f"{label}は現在OpenAI側の不調により一時停止中です。約{max(1, round(retry_after))}秒後に再度お試しください。")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """1つのエンドポイントのブレーカー"""
+
+    def __init__(self, endpoint, endpoint_config, breaker_config):
+        self.endpoint = endpoint
+        self.label = endpoint_config['label']
+        self.slow_call_seconds = endpoint_config['slow_call_seconds']
+        self.config = breaker_config
+        self.state = CLOSED
+        self.calls = deque()
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_settled = asyncio.Event()  # 試行の結果が出たら（または枠が空いたら）セット
+        self.opened = 0
+        self.rejected = 0
+        self.last_reason = None
+
+    def _prune(self, now):
+        cutoff = now - self.config['window_seconds']
+        while self.calls and self.calls[0][0] < cutoff:
+            self.calls.popleft()
+
+    def retry_after(self):
+        """試行を再開するまでの残り秒数"""
+        return max(0.0, self.opened_at + self.config['open_seconds'] - time.monotonic())
+
+    def get_state(self):
+        """現在の状態（オープン期間が過ぎていればハーフオープン）"""
+        if self.state == OPEN and self.retry_after() <= 0:
+            self.state = HALF_OPEN
+            self.probes = 0
+            print(f"[DEBUG] サーキットブレーカー試行開始: {self.endpoint}")
+        return self.state
+
+    def open_error(self):
+        """オープン中ならCircuitOpenErrorを返す（試行中は結果を待てるのでNone）"""
+        if self.get_state() == OPEN:
+            return CircuitOpenError(self.endpoint, self.label, self.retry_after())
+        return None
+
+    def probes_full(self):
+        """試行中で、試行枠がすべて使われているか"""
+        return self.get_state() == HALF_OPEN and self.probes >= self.config['half_open_max_calls']
+
+    async def wait_for_probe(self):
+        """試行枠が埋まっている間は、試行の結果が出るまで待つ"""
+        while self.probes_full():
+            await self.probe_settled.wait()
+
+    def before_call(self):
+        """呼び出し前に状態を確認（拒否する場合はCircuitOpenErrorを送出）"""
+        if self.get_state() == OPEN or self.probes_full():
+            self.rejected += 1
+            raise CircuitOpenError(self.endpoint, self.label, self.retry_after())
+        if self.state == HALF_OPEN:
+            self.probes += 1
+
+    def _settle_probe(self):
+        """試行を待っている呼び出しを起こす"""
+        self.probe_settled.set()
+        self.probe_settled = asyncio.Event()
+
+    def _open(self, reason):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        self.last_reason = reason
+        self.calls.clear()
+        print(f"[DEBUG] サーキットブレーカーをオープン: {self.endpoint} ({reason}) {self.config['open_seconds']}秒停止")
+
+    def record(self, seconds, error=None):
+        """呼び出しの結果を記録（上流の障害以外の例外は判定に含めない）"""
+        if error is not None and not isinstance(error, UPSTREAM_ERRORS):
+            if self.state == HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+                self._settle_probe()
+            return
+
+        failed = error is not None
+        slow = seconds > self.slow_call_seconds
+
+        if self.state == HALF_OPEN:
+            if failed or slow:
+                self._open('試行失敗' if failed else f'試行が{seconds:.1f}秒')
+            else:
+                self.state = CLOSED
+                self.calls.clear()
+                print(f"[DEBUG] サーキットブレーカーをクローズ: {self.endpoint}")
+            self._settle_probe()
+            return
+        if self.state == OPEN:
+            # オープン前から実行中だった呼び出しの結果は判定に使わない
+            return
+
+        now = time.monotonic()
+        self.calls.append((now, failed, slow))
+        self._prune(now)
+        total = len(self.calls)
+        if total < self.config['min_calls']:
+            return
+        failure_rate = sum(1 for _, call_failed, _ in self.calls if call_failed) / total
+        slow_rate = sum(1 for _, _, call_slow in self.calls if call_slow) / total
+        if failure_rate >= self.config['failure_rate_threshold']:
+            self._open(f'失敗率 {failure_rate:.0%}')
+        elif slow_rate >= self.config['slow_call_rate_threshold']:
+            self._open(f'遅延率 {slow_rate:.0%}')
+
+    def get_stats(self):
+        """ブレーカーの状態を取得"""
+        state = self.get_state()
+        self._prune(time.monotonic())
+        total = len(self.calls)
+        return {
+            'label': self.label,
+            'state': state,
+            'retry_after': self.retry_after() if state == OPEN else 0.0,
+            'calls': total,
+            'failure_rate': sum(1 for _, failed, _ in self.calls if failed) / total if total else 0.0,
+            'slow_rate': sum(1 for _, _, slow in self.calls if slow) / total if total else 0.0,
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'last_reason': self.last_reason,
+        }
+
+class CircuitBreakers:
+    """エンドポイントごとのブレーカーの集合"""
+
+    def __init__(self, breaker_config):
+        self.config = breaker_config
+        self.breakers = {
+            endpoint: CircuitBreaker(endpoint, endpoint_config, breaker_config)
+            for endpoint, endpoint_config in breaker_config['endpoints'].items()
+        }
+
+    def open_error(self, endpoint):
+        """ブレーカーがオープン中ならCircuitOpenErrorを返す（処理を始める前の確認用）"""
+        if not self.config['enabled']:
+            return None
+        return self.breakers[endpoint].open_error()
+
+    async def wait_for_probe(self, endpoint):
+        """試行中なら結果が出るまで待つ"""
+        if self.config['enabled']:
+            await self.breakers[endpoint].wait_for_probe()
+
+    def before_call(self, endpoint):
+        if self.config['enabled']:
+            self.breakers[endpoint].before_call()
+
+    def record(self, endpoint, seconds, error=None):
+        if self.config['enabled']:
+            self.breakers[endpoint].record(seconds, error)
+
+    @asynccontextmanager
+    async def guard(self, endpoint):
+        """ブロック内の呼び出しをブレーカーで保護（オープン中はCircuitOpenErrorを送出）"""
+        await self.wait_for_probe(endpoint)
+        self.before_call(endpoint)
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.record(endpoint, time.monotonic() - start, e)
+            raise
+        self.record(endpoint, time.monotonic() - start)
+
+    def get_stats(self):
+        """エンドポイントごとのブレーカーの状態を取得"""
+        return {endpoint: breaker.get_stats() for endpoint, breaker in self.breakers.items()}
+
+# グローバルサーキットブレーカーインスタンス
+circuit_breakers = CircuitBreakers(CIRCUIT_BREAKER_CONFIG)
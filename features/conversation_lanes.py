@@ -0,0 +1,119 @@
+"""
+会話レーン
+会話（チャンネルまたはユーザー）ごとに応答を順番に処理し、別の会話は並列に処理（全体の同時実行数は上限付き）
+"""
+
+import asyncio
+from collections import deque
+from config import CONVERSATION_LANE_CONFIG
+
+class LaneFullError(Exception):
+    """会話の待ちが上限を超えた場合の例外"""
+
+class ConversationLanes:
+    """会話ごとのロックと待ち数、全体の同時実行数を管理"""
+
+    def __init__(self, lane_config):
+        self.config = lane_config
+        self.locks = {}
+        self.pending = {}
+        self.waiting = {}  # submit用: 会話キー -> 未完了ジョブの列（先頭だけがジョブキューにある）
+        self.global_semaphore = asyncio.Semaphore(lane_config['max_concurrent'])
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def make_key(self, channel_id, user_id):
+        """設定の単位（チャンネル or ユーザー）に応じた会話キーを作成"""
+        if self.config['scope'] == 'channel':
+            return channel_id
+        return (channel_id, user_id)
+
+    def is_full(self, key):
+        """この会話の待ち（実行中を含む）が上限に達しているか"""
+        return self.pending.get(key, 0) >= self.config['max_pending']
+
+    async def run(self, key, job_factory):
+        """会話内では到着順に1件ずつ、全体では上限数まで並列にjobを実行"""
+        if self.is_full(key):
+            self.rejected += 1
+            raise LaneFullError(key)
+
+        # asyncio.Lockは待機順に獲得されるので、同じ会話の中の順序が保たれる
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.pending[key] = self.pending.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self.global_semaphore:
+                    self.running += 1
+                    try:
+                        return await job_factory()
+                    finally:
+                        self.running -= 1
+                        self.completed += 1
+        finally:
+            self.pending[key] -= 1
+            if self.pending[key] == 0:
+                # 待ちのなくなった会話は破棄して辞書を小さく保つ
+                del self.pending[key]
+                del self.locks[key]
+
+    async def submit(self, key, job_factory, enqueue):
+        """会話ごとに順番を決めてから、先頭のジョブだけをenqueueでジョブキューへ渡す
+
+        run()をジョブキューの中で呼ぶと、同じ会話の後続がワーカーを塞いだままロックを待つため、
+        順番待ちはキューの手前で行う。enqueue(job)は投入できたかを返すコルーチン関数。
+        """
+        if self.is_full(key):
+            self.rejected += 1
+            raise LaneFullError(key)
+
+        lane = self.waiting.setdefault(key, deque())
+        lane.append((job_factory, enqueue))
+        self.pending[key] = self.pending.get(key, 0) + 1
+        if len(lane) == 1:
+            await self._dispatch(key)
+
+    async def _dispatch(self, key):
+        """会話の先頭のジョブをジョブキューへ投入（満杯で投入できなければ破棄して次へ）"""
+        lane = self.waiting.get(key)
+        while lane:
+            job_factory, enqueue = lane[0]
+
+            async def run_head(job_factory=job_factory):
+                self.running += 1
+                try:
+                    return await job_factory()
+                finally:
+                    self.running -= 1
+                    self.completed += 1
+                    # 終わったら同じ会話の次のジョブをキューへ
+                    self._pop_head(key)
+                    await self._dispatch(key)
+
+            if await enqueue(run_head):
+                return
+            self._pop_head(key)
+
+    def _pop_head(self, key):
+        """会話の先頭のジョブを取り除く（空になった会話は破棄）"""
+        lane = self.waiting[key]
+        lane.popleft()
+        self.pending[key] -= 1
+        if not lane:
+            del self.waiting[key]
+            del self.pending[key]
+
+    def get_stats(self):
+        """会話レーンの状態を取得"""
+        return {
+            'active_conversations': len(self.pending),
+            'queued': sum(self.pending.values()) - self.running,
+            'running': self.running,
+            'max_concurrent': self.config['max_concurrent'],
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+# グローバル会話レーンインスタンス
+conversation_lanes = ConversationLanes(CONVERSATION_LANE_CONFIG)
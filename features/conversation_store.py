@@ -0,0 +1,113 @@
+"""
+会話コンテキストストア
+(チャンネル, ユーザー) ごとに直近の会話ターンを保持し、トークン数を追加時に計算して累計で管理
+"""
+
+import time
+from collections import OrderedDict, deque
+from config import CONVERSATION_CONFIG
+from features.token_budget import count_tokens, TOKENS_PER_MESSAGE
+
+class ConversationContext:
+    """1つの会話の直近ターン（上限件数・上限トークン数付き）"""
+
+    def __init__(self, max_turns, max_tokens):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.turns = deque()
+        self.total_tokens = 0
+        self.updated_at = time.time()
+
+    def add_turn(self, user_message, bot_response, model):
+        """ターンを追加し、上限を超えた古いターンを先頭から削除"""
+        # ユーザー発言と応答の2メッセージ分のトークン数を追加時に1度だけ数える
+        tokens = (count_tokens(user_message, model) + count_tokens(bot_response, model)
+                  + TOKENS_PER_MESSAGE * 2)
+        self.turns.append({
+            'user_message': user_message,
+            'bot_response': bot_response,
+            'tokens': tokens,
+        })
+        self.total_tokens += tokens
+        self.updated_at = time.time()
+
+        while self.turns and (len(self.turns) > self.max_turns or self.total_tokens > self.max_tokens):
+            self.total_tokens -= self.turns.popleft()['tokens']
+
+    def build_messages(self, token_limit=None):
+        """トークン上限内に収まる直近のターンをmessages形式で返す"""
+        if token_limit is None:
+            token_limit = self.max_tokens
+
+        # 古いターンから順に、残りが上限に収まるまで読み飛ばす
+        skip_tokens = self.total_tokens
+        start = 0
+        while start < len(self.turns) and skip_tokens > token_limit:
+            skip_tokens -= self.turns[start]['tokens']
+            start += 1
+
+        messages = []
+        for index in range(start, len(self.turns)):
+            turn = self.turns[index]
+            messages.append({"role": "user", "content": turn['user_message']})
+            messages.append({"role": "assistant", "content": turn['bot_response']})
+        return messages
+
+class ConversationStore:
+    """会話コンテキストを (チャンネルID, ユーザーID) ごとに保持（古い会話から削除）"""
+
+    def __init__(self, conversation_config):
+        self.config = conversation_config
+        self.conversations = OrderedDict()
+
+    def _is_expired(self, context):
+        return time.time() - context.updated_at > self.config['ttl_seconds']
+
+    def get(self, channel_id, user_id):
+        """会話コンテキストを取得（期限切れ・未登録はNone）"""
+        key = (channel_id, user_id)
+        context = self.conversations.get(key)
+        if context is None:
+            return None
+        if self._is_expired(context):
+            del self.conversations[key]
+            return None
+        self.conversations.move_to_end(key)
+        return context
+
+    def add_turn(self, channel_id, user_id, user_message, bot_response, model):
+        """会話にターンを追加"""
+        context = self.get(channel_id, user_id)
+        if context is None:
+            context = ConversationContext(self.config['max_turns'], self.config['max_context_tokens'])
+            self.conversations[(channel_id, user_id)] = context
+            while len(self.conversations) > self.config['max_conversations']:
+                self.conversations.popitem(last=False)
+        context.add_turn(user_message, bot_response, model)
+
+    def build_messages(self, channel_id, user_id, token_limit=None):
+        """会話履歴をmessages形式で取得（履歴がなければ空リスト）"""
+        context = self.get(channel_id, user_id)
+        if context is None:
+            return []
+        return context.build_messages(token_limit)
+
+    def clear(self, channel_id, user_id=None):
+        """会話履歴を削除（ユーザー省略時はチャンネル内の全会話）し、削除したターン数を返す"""
+        keys = [key for key in self.conversations
+                if key[0] == channel_id and (user_id is None or key[1] == user_id)]
+        removed_turns = 0
+        for key in keys:
+            removed_turns += len(self.conversations.pop(key).turns)
+        return removed_turns
+
+    def get_stats(self):
+        """保持している会話数・ターン数・トークン数を取得"""
+        return {
+            'conversations': len(self.conversations),
+            'turns': sum(len(context.turns) for context in self.conversations.values()),
+            'tokens': sum(context.total_tokens for context in self.conversations.values()),
+        }
+
+# グローバル会話ストアインスタンス
+conversation_store = ConversationStore(CONVERSATION_CONFIG)
@@ -0,0 +1,227 @@
+"""
+Discord送信アクションキュー
+リアクションはチャンネルごとのルートバケットに合わせた間隔で順番に送信し、
+処理中の絵文字の追加→削除のように打ち消し合う操作は送らずに省略、同じチャンネルの返信を優先
+"""
+
+import time
+import asyncio
+import logging
+import itertools
+import contextlib
+import discord
+from config import DISCORD_ACTION_CONFIG, REACTION_EMOJIS
+
+# 同じチャンネル内での送信の優先度（小さいほど先）
+PRIORITY_STATUS = 0      # 処理中・成功・失敗などの状態表示
+PRIORITY_COSMETIC = 1    # 自動で付ける機能の案内リアクション
+
+class RouteBucket:
+    """period秒あたりlimit回まで送信できるバケット"""
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.sent_at = []
+
+    def wait_time(self):
+        """次に送信できるまでの待機秒数"""
+        now = time.monotonic()
+        self.sent_at = [sent for sent in self.sent_at if now - sent < self.period]
+        if len(self.sent_at) < self.limit:
+            return 0.0
+        return self.sent_at[0] + self.period - now
+
+    def consume(self):
+        self.sent_at.append(time.monotonic())
+
+class DiscordRateLimitLogHandler(logging.Handler):
+    """discord.pyが429を受けて待機したときのログから待ち時間を記録"""
+
+    def __init__(self, action_queue):
+        super().__init__(level=logging.WARNING)
+        self.action_queue = action_queue
+
+    def emit(self, record):
+        if not isinstance(record.msg, str) or not record.msg.startswith('We are being rate limited.'):
+            return
+        if 'Retrying in' not in record.msg or len(record.args) != 3:
+            return
+        _, url, retry_after = record.args
+        self.action_queue.record_rate_limited('reaction' if '/reactions/' in str(url) else 'message', retry_after)
+
+class DiscordActionQueue:
+    """リアクションの送信キューと返信の優先制御"""
+
+    def __init__(self, action_config):
+        self.config = action_config
+        self.pending = {}
+        self.queues = {}
+        self.workers = {}
+        self.buckets = {}
+        self.direct_tasks = set()
+        self.sequence = itertools.count()
+        self.replies_pending = {}
+        self.reply_condition = None
+        self.stats = {
+            'queued': 0, 'sent': 0, 'coalesced': 0, 'duplicates': 0, 'failed': 0,
+            'replies': 0, 'reply_seconds': 0.0,
+            'bucket_wait_seconds': 0.0, 'rate_limited': {}, 'rate_limit_seconds': {},
+        }
+
+    def _get_reply_condition(self):
+        # イベントループ起動後に作成する
+        if self.reply_condition is None:
+            self.reply_condition = asyncio.Condition()
+        return self.reply_condition
+
+    def add_reaction(self, message, emoji, priority=PRIORITY_STATUS):
+        """リアクションの追加を予約（送信を待たずに戻る）"""
+        self._enqueue(message, emoji, 'add', None, priority)
+
+    def remove_reaction(self, message, emoji, member, priority=PRIORITY_STATUS):
+        """リアクションの削除を予約（未送信の追加があれば両方とも送らない）"""
+        self._enqueue(message, emoji, 'remove', member, priority)
+
+    def finish_processing(self, message, result_emoji, member):
+        """処理中の絵文字を外して結果の絵文字を付ける（短い処理では処理中の絵文字自体を送らない）"""
+        self.remove_reaction(message, REACTION_EMOJIS['processing'], member)
+        self.add_reaction(message, result_emoji)
+
+    def _enqueue(self, message, emoji, op, member, priority):
+        action = {'message': message, 'emoji': emoji, 'op': op, 'member': member, 'ready_at': time.monotonic()}
+        if not self.config['enabled']:
+            task = asyncio.create_task(self._execute(action))
+            self.direct_tasks.add(task)
+            task.add_done_callback(self.direct_tasks.discard)
+            return
+
+        key = (message.id, str(emoji))
+        current = self.pending.get(key)
+        if current is not None:
+            if current['op'] == op:
+                self.stats['duplicates'] += 1
+                return
+            # まだ送っていない逆の操作と打ち消し合うので、どちらも送らない
+            del self.pending[key]
+            self.stats['coalesced'] += 2
+            return
+
+        if op == 'add' and str(emoji) in self.config['transient_emojis']:
+            action['ready_at'] += self.config['coalesce_seconds']
+        self.pending[key] = action
+        self.stats['queued'] += 1
+
+        channel_id = message.channel.id
+        if channel_id not in self.queues:
+            self.queues[channel_id] = asyncio.PriorityQueue()
+            self.workers[channel_id] = asyncio.create_task(self._worker(channel_id))
+        self.queues[channel_id].put_nowait((priority, next(self.sequence), key))
+
+    async def _worker(self, channel_id):
+        """チャンネルごとにリアクションを1件ずつバケットの間隔を守って送信"""
+        queue = self.queues[channel_id]
+        bucket = self.buckets.setdefault(
+            channel_id, RouteBucket(self.config['reaction_limit'], self.config['reaction_period'])
+        )
+        while True:
+            try:
+                _, _, key = await asyncio.wait_for(queue.get(), timeout=self.config['worker_idle_seconds'])
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[channel_id]
+                    del self.workers[channel_id]
+                    self.buckets.pop(channel_id, None)
+                    return
+                continue
+
+            action = self.pending.get(key)
+            if action is None:
+                continue
+
+            # 一時的な絵文字は少し待ち、その間に削除が予約されたら送らない
+            delay = action['ready_at'] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # 同じチャンネルで返信を送信中ならそちらを先に通す
+            condition = self._get_reply_condition()
+            async with condition:
+                await condition.wait_for(lambda: not self.replies_pending.get(channel_id))
+
+            wait = bucket.wait_time()
+            while wait > 0:
+                self.stats['bucket_wait_seconds'] += wait
+                await asyncio.sleep(wait)
+                wait = bucket.wait_time()
+
+            if self.pending.get(key) is not action:
+                continue
+            del self.pending[key]
+            bucket.consume()
+            await self._execute(action)
+
+    async def _execute(self, action):
+        message = action['message']
+        try:
+            if action['op'] == 'add':
+                await message.add_reaction(action['emoji'])
+            else:
+                await message.remove_reaction(action['emoji'], action['member'])
+            self.stats['sent'] += 1
+        except discord.HTTPException as e:
+            self.stats['failed'] += 1
+            print(f"リアクション送信エラー ({action['op']} {action['emoji']}): {e}")
+
+    @contextlib.asynccontextmanager
+    async def _sending(self, channel_id):
+        """メッセージ送信中は同じチャンネルのリアクションを待たせる"""
+        self.replies_pending[channel_id] = self.replies_pending.get(channel_id, 0) + 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stats['replies'] += 1
+            self.stats['reply_seconds'] += time.monotonic() - start
+            self.replies_pending[channel_id] -= 1
+            if self.replies_pending[channel_id] == 0:
+                del self.replies_pending[channel_id]
+            condition = self._get_reply_condition()
+            async with condition:
+                condition.notify_all()
+
+    async def reply(self, message, content=None, **kwargs):
+        """メッセージに返信（送信中は同じチャンネルのリアクションを待たせる）"""
+        async with self._sending(message.channel.id):
+            return await message.reply(content, **kwargs)
+
+    async def send(self, channel, content=None, **kwargs):
+        """チャンネルに送信（ストリーミング返信の続きのメッセージなど）"""
+        async with self._sending(channel.id):
+            return await channel.send(content, **kwargs)
+
+    async def edit(self, message, **kwargs):
+        """送信済みメッセージを編集（ストリーミング返信の途中経過など）"""
+        async with self._sending(message.channel.id):
+            return await message.edit(**kwargs)
+
+    def record_rate_limited(self, route, retry_after):
+        """discord.pyが429で待機した時間をルート種別ごとに記録"""
+        self.stats['rate_limited'][route] = self.stats['rate_limited'].get(route, 0) + 1
+        self.stats['rate_limit_seconds'][route] = self.stats['rate_limit_seconds'].get(route, 0.0) + retry_after
+
+    def get_stats(self):
+        """送信キューの状態を取得"""
+        replies = self.stats['replies']
+        return {
+            **self.stats,
+            'rate_limited': dict(self.stats['rate_limited']),
+            'rate_limit_seconds': dict(self.stats['rate_limit_seconds']),
+            'pending': len(self.pending),
+            'active_channels': len(self.workers),
+            'avg_reply_seconds': self.stats['reply_seconds'] / replies if replies else 0.0,
+        }
+
+# グローバル送信キューインスタンス
+discord_actions = DiscordActionQueue(DISCORD_ACTION_CONFIG)
+logging.getLogger('discord.http').addHandler(DiscordRateLimitLogHandler(discord_actions))
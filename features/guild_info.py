@@ -7,6 +7,8 @@ import discord
 import json
 import os
 from datetime import datetime
+from features.discord_actions import discord_actions, PRIORITY_COSMETIC
+from features.trigger_registry import trigger_registry
 
 async def handle_guild_info_collection(bot, guild):
     """ギルド情報収集のメイン関数"""
@@ -94,7 +96,7 @@ async def handle_guild_info_reaction(message, bot):
 
     try:
         # 処理開始を通知
-        await message.add_reaction(REACTION_EMOJIS['processing'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['processing'])
 
         guild = message.guild
 
@@ -111,7 +113,7 @@ async def handle_guild_info_reaction(message, bot):
             summary_text += f"・収集メンバー数: {len(members_info)}\n"
             summary_text += f"・チャンネル数: {len(channels_info)}\n"
 
-            await message.reply(summary_text)
+            await discord_actions.reply(message, summary_text)
 
             # データをファイルに保存して送信
             try:
@@ -154,21 +156,19 @@ async def handle_guild_info_reaction(message, bot):
                 print(f"ギルド情報ファイル送信エラー: {e}")
 
         else:
-            await message.reply("ギルド情報の収集に失敗しました。")
+            await discord_actions.reply(message, "ギルド情報の収集に失敗しました。")
 
         # 処理完了を通知
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['success'])
+        discord_actions.finish_processing(message, REACTION_EMOJIS['success'], bot.user)
         return True
 
     except Exception as e:
         print(f"ギルド情報処理エラー: {str(e)}")
-        await message.reply("ギルド情報収集中にエラーが発生しました。")
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['error'])
+        await discord_actions.reply(message, "ギルド情報収集中にエラーが発生しました。")
+        discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
         return False
 
-async def auto_add_guild_info_reaction(message):
+async def auto_add_guild_info_reaction(message, triggers=None):
     """特定のキーワードメッセージに自動で🏛️リアクションを追加"""
     from config import BOT_CONFIG, REACTION_EMOJIS
 
@@ -177,9 +177,10 @@ async def auto_add_guild_info_reaction(message):
         return False
 
     # 特定のキーワードでギルド情報をトリガー
-    trigger_keywords = ['ギルド情報', 'guild info', 'サーバー情報', 'server info', 'メンバー情報', 'member info']
-    if message.content and any(keyword in message.content.lower() for keyword in trigger_keywords):
+    if triggers is None:
+        triggers = trigger_registry.match(message.content)
+    if 'guild_info' in triggers:
         print(f"[DEBUG] 🏛️リアクション追加: ギルド情報トリガー")
-        await message.add_reaction(REACTION_EMOJIS['guild_info'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['guild_info'], PRIORITY_COSMETIC)
         return True
     return False
\ No newline at end of file
@@ -3,106 +3,261 @@
 ChatGPT Vision APIを使用した画像からのテキスト抽出
 """
 
-import os
-import aiohttp
+import time
 import base64
-from config import CHATGPT_CONFIG, REACTION_EMOJIS
-from openai import OpenAI
+import asyncio
+from config import CHATGPT_CONFIG, REACTION_EMOJIS, OCR_CACHE_CONFIG, VISION_DETAIL_CONFIG
+from features.openai_client import get_openai_client
+from features.openai_throttle import openai_throttler
+from features.request_hedging import request_hedger
+from features.circuit_breaker import circuit_breakers, CircuitOpenError
+from features.discord_actions import discord_actions, PRIORITY_COSMETIC
+from features.reply_delivery import send_long_reply
+from features.token_budget import token_budget
+from features.result_store import ResultStore, make_content_key
+from features.image_preprocess import preprocess_image
+from features.attachments import process_attachments, combine_attachment_results, AttachmentError
 
-async def transcribe_image_with_gpt(image_data):
-    """ChatGPT APIを使用して画像内のテキストを抽出"""
-    try:
-        OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-        if not OPENAI_API_KEY:
-            return "OpenAI APIキーが設定されていません。"
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
 
-        # APIキーをクリーンアップ（改行や空白を除去）
-        OPENAI_API_KEY = OPENAI_API_KEY.strip().replace('\n', '').replace(' ', '')
-        print(f"[DEBUG] OpenAI APIキー長 (画像OCR): {len(OPENAI_API_KEY)}")
+# 文字起こし指示（内容を変えたらOCR_PROMPT_VERSIONを上げてキャッシュを無効化）
+OCR_PROMPT = "この画像に含まれているすべてのテキストを正確に読み取って、そのまま文字起こししてください。文字化けしないよう、正確な文字で出力してください。テキスト以外の説明は不要で、文字起こししたテキストのみを返してください。"
+OCR_PROMPT_VERSION = 1
 
-        # OpenAIクライアントを初期化
-        client = OpenAI(api_key=OPENAI_API_KEY)
+# 画像ハッシュをキーにしたOCR結果キャッシュ
+ocr_result_store = ResultStore(
+    OCR_CACHE_CONFIG['db_path'],
+    max_entries=OCR_CACHE_CONFIG['max_entries'],
+    max_bytes=OCR_CACHE_CONFIG['max_bytes'],
+)
 
-        # 画像をbase64エンコード
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+# 詳細度ごとの画像入力トークン数の目安（highは2048px相当の上限側）
+VISION_ESTIMATED_TOKENS = {
+    'low': 85,
+    'high': 1105,
+}
 
-        response = client.chat.completions.create(
-            model=CHATGPT_CONFIG['vision_model'],
-            messages=[
+# 詳細度ごとの利用回数と累計レイテンシ
+vision_detail_stats = {
+    'low_only': 0,
+    'escalated': 0,
+    'high_direct': 0,
+    'low_seconds': 0.0,
+    'high_seconds': 0.0,
+}
+
+async def request_image_transcription(client, image_url, detail):
+    """指定した詳細度でVision APIに文字起こしを依頼し (テキスト, 終了理由) を返す"""
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": OCR_PROMPT
+                },
                 {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "この画像に含まれているすべてのテキストを正確に読み取って、そのまま文字起こししてください。文字化けしないよう、正確な文字で出力してください。テキスト以外の説明は不要で、文字起こししたテキストのみを返してください。"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                        "detail": detail
+                    }
                 }
-            ],
-            max_tokens=CHATGPT_CONFIG['max_tokens']
+            ]
+        }
+    ]
+    # 画像入力のトークン数は詳細度と解像度で変わるため上限側で見積もり、
+    # 読み取る文字量は事前に分からないので応答長は設定の上限を使う
+    budget = token_budget.plan(
+        f"image_ocr:{detail}",
+        CHATGPT_CONFIG['vision_model'],
+        messages,
+        CHATGPT_CONFIG['max_tokens'],
+        extra_prompt_tokens=VISION_ESTIMATED_TOKENS.get(detail, VISION_ESTIMATED_TOKENS['high']),
+        expected_completion_tokens=CHATGPT_CONFIG['max_tokens'],
+    )
+
+    async with circuit_breakers.guard('vision'):
+        response = await request_hedger.call(
+            'image_ocr',
+            lambda: openai_throttler.call(
+                CHATGPT_CONFIG['vision_model'],
+                lambda: client.chat.completions.with_raw_response.create(
+                    model=CHATGPT_CONFIG['vision_model'],
+                    messages=messages,
+                    max_tokens=budget['max_tokens']
+                ),
+                estimated_tokens=budget['prompt_tokens'] + budget['max_tokens']
+            ),
+            latency_key=f"image_ocr:{detail}"
         )
 
-        return response.choices[0].message.content
+    choice = response.choices[0]
+    token_budget.record_usage(budget, response.usage, choice.finish_reason)
+    return choice.message.content or "", choice.finish_reason
+
+def choose_initial_detail(preprocess_info):
+    """画像サイズと情報量から最初に試す詳細度を決める"""
+    if not preprocess_info or not preprocess_info.get('output_size'):
+        return 'low', 'サイズ不明'
+
+    width, height = preprocess_info['output_size']
+    aspect = max(width, height) / max(1, min(width, height))
+    if aspect >= VISION_DETAIL_CONFIG['tall_aspect_ratio']:
+        return 'high', f'縦横比 {aspect:.1f}'
+
+    # 圧縮後のバイト数/画素数が大きいほど細かい文字が詰まっている
+    bytes_per_pixel = preprocess_info['output_bytes'] / max(1, width * height)
+    if bytes_per_pixel >= VISION_DETAIL_CONFIG['dense_bytes_per_pixel']:
+        return 'high', f'情報密度 {bytes_per_pixel:.2f}B/px'
+
+    return 'low', f'情報密度 {bytes_per_pixel:.2f}B/px'
+
+def get_escalation_reason(text, finish_reason):
+    """低詳細度の結果を高詳細度でやり直すべき理由を返す（不要ならNone）"""
+    if finish_reason == 'length':
+        return '出力が途中で切れた'
+
+    stripped = text.strip()
+    if len(stripped) < VISION_DETAIL_CONFIG['min_text_length']:
+        return '結果がほぼ空'
+
+    if any(marker in stripped for marker in VISION_DETAIL_CONFIG['unreadable_markers']):
+        return '判読不能の応答'
+
+    return None
+
+async def transcribe_with_adaptive_detail(client, image_url, preprocess_info):
+    """低詳細度から試し、結果が不十分なときだけ高詳細度で再実行"""
+    detail, reason = choose_initial_detail(preprocess_info)
+
+    start = time.monotonic()
+    text, finish_reason = await request_image_transcription(client, image_url, detail)
+    first_elapsed = time.monotonic() - start
+    vision_detail_stats[f'{detail}_seconds'] += first_elapsed
+
+    if detail == 'high':
+        vision_detail_stats['high_direct'] += 1
+        print(f"[DEBUG] OCR詳細度: high ({reason}) {first_elapsed:.2f}秒")
+        return text
 
+    escalation_reason = get_escalation_reason(text, finish_reason)
+    if escalation_reason is None:
+        vision_detail_stats['low_only'] += 1
+        print(f"[DEBUG] OCR詳細度: low ({reason}) {first_elapsed:.2f}秒, {len(text)}文字")
+        return text
+
+    start = time.monotonic()
+    text, _ = await request_image_transcription(client, image_url, 'high')
+    high_elapsed = time.monotonic() - start
+    vision_detail_stats['high_seconds'] += high_elapsed
+    vision_detail_stats['escalated'] += 1
+    print(f"[DEBUG] OCR詳細度: low -> high ({reason}, 昇格理由: {escalation_reason}) "
+          f"low {first_elapsed:.2f}秒 + high {high_elapsed:.2f}秒, {len(text)}文字")
+    return text
+
+async def transcribe_image_with_gpt(image_data):
+    """ChatGPT APIを使用して画像内のテキストを抽出（失敗時はAttachmentError）"""
+    try:
+        # 同じ画像・モデル・プロンプトの結果があれば再利用
+        cache_key = None
+        if OCR_CACHE_CONFIG['enabled']:
+            cache_key = await asyncio.to_thread(
+                make_content_key, image_data, CHATGPT_CONFIG['vision_model'], f"v{OCR_PROMPT_VERSION}"
+            )
+            cached_text = await ocr_result_store.aget(cache_key)
+            if cached_text is not None:
+                print(f"[DEBUG] OCRキャッシュヒット: {cache_key[:16]}...")
+                return cached_text
+
+        # 共有クライアントを取得
+        client = get_openai_client()
+        if client is None:
+            raise AttachmentError("OpenAI APIキーが設定されていません。")
+
+        # 縮小・再圧縮して正しいMIMEタイプを判定
+        processed_data, mime_type, preprocess_info = await preprocess_image(image_data)
+
+        # 画像をbase64エンコード
+        image_base64 = base64.b64encode(processed_data).decode('utf-8')
+        image_url = f"data:{mime_type};base64,{image_base64}"
+
+        if CHATGPT_CONFIG['vision_detail'] == 'adaptive':
+            transcribed_text = await transcribe_with_adaptive_detail(client, image_url, preprocess_info)
+        else:
+            transcribed_text, _ = await request_image_transcription(client, image_url, CHATGPT_CONFIG['vision_detail'])
+
+        if cache_key is not None:
+            await ocr_result_store.aput(cache_key, transcribed_text)
+        return transcribed_text
+
+    except AttachmentError:
+        raise
+    except CircuitOpenError as e:
+        raise AttachmentError(f"⚡ {e}") from e
     except Exception as e:
         print(f"画像文字起こしエラー: {str(e)}")
-        return "エラーが発生しました。"
+        raise AttachmentError("エラーが発生しました。") from e
+
+def is_image_attachment(attachment):
+    """画像ファイルの添付かどうかを判定"""
+    return any(attachment.filename.lower().endswith(ext) for ext in IMAGE_EXTENSIONS)
 
 async def handle_image_ocr_reaction(message, bot):
-    """🦀リアクションによる画像文字起こし処理"""
+    """🦀リアクションによる画像文字起こし処理（成功時は結果の返信メッセージを返す）"""
     # 画像添付がない場合はスキップ
     if not message.attachments:
         return False
 
-    # 画像ファイルかチェック
-    image_attachment = None
-    for attachment in message.attachments:
-        if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']):
-            image_attachment = attachment
-            break
+    # 画像ファイルをすべて対象にする
+    image_attachments = [attachment for attachment in message.attachments if is_image_attachment(attachment)]
+    if not image_attachments:
+        return False
 
-    if not image_attachment:
+    # OpenAI側の不調でブレーカーがオープン中ならダウンロードせずにすぐ返信
+    open_error = circuit_breakers.open_error('vision')
+    if open_error is not None:
+        await discord_actions.reply(message, f"⚡ {open_error}")
         return False
 
     try:
         # 処理開始を通知
-        await message.add_reaction(REACTION_EMOJIS['processing'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['processing'])
 
-        # 画像をダウンロード
-        image_data = await image_attachment.read()
+        async def transcribe_attachment(attachment):
+            # 画像をダウンロードしてChatGPT APIで文字起こし
+            image_data = await attachment.read()
+            return await transcribe_image_with_gpt(image_data)
 
-        # ChatGPT APIで文字起こし
-        transcribed_text = await transcribe_image_with_gpt(image_data)
+        # 複数画像を同時実行数の上限付きで並列処理し、添付順にまとめる
+        results = await process_attachments(
+            image_attachments, transcribe_attachment, CHATGPT_CONFIG['max_parallel_attachments']
+        )
+        transcribed_text, succeeded = combine_attachment_results(
+            image_attachments, results, "（テキストなし）", "（処理中にエラーが発生しました）"
+        )
 
-        # 結果を送信（UTF-8で正しく表示されるように）
+        # 結果を送信（UTF-8で正しく表示されるように、先頭の返信を処理済み結果として返す）
+        result_reply = None
         if transcribed_text.strip():
-            max_length = CHATGPT_CONFIG['max_message_length']
-            # 長すぎる場合は分割して送信
-            if len(transcribed_text) > max_length:
-                chunks = [transcribed_text[i:i+max_length] for i in range(0, len(transcribed_text), max_length)]
-                for i, chunk in enumerate(chunks):
-                    await message.reply(f"**📝 文字起こし結果 ({i+1}/{len(chunks)}):**\n```\n{chunk}\n```")
-            else:
-                await message.reply(f"**📝 文字起こし結果:**\n```\n{transcribed_text}\n```")
+            # 長すぎる場合は行単位で分割し、分割数が多ければファイルで送信
+            result_reply = await send_long_reply(
+                message, transcribed_text, "📝 文字起こし結果", "ocr_result.txt", code_block=True
+            )
         else:
-            await message.reply("画像からテキストを検出できませんでした。")
+            result_reply = await discord_actions.reply(message, "画像からテキストを検出できませんでした。")
 
-        # 処理完了を通知
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['success'])
-        return True
+        # 処理完了を通知（失敗した添付があれば完了済みとして記録させない）
+        if not succeeded:
+            discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
+            return False
+        discord_actions.finish_processing(message, REACTION_EMOJIS['success'], bot.user)
+        return result_reply
 
     except Exception as e:
         print(f"画像処理エラー: {str(e)}")
-        await message.reply("画像の処理中にエラーが発生しました。")
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['error'])
+        await discord_actions.reply(message, "画像の処理中にエラーが発生しました。")
+        discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
         return False
 
 async def auto_add_image_reaction(message):
@@ -116,8 +271,8 @@ async def auto_add_image_reaction(message):
 
     if message.attachments:
         for attachment in message.attachments:
-            if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']):
+            if is_image_attachment(attachment):
                 print(f"[DEBUG] 🦀リアクション追加: {attachment.filename}")
-                await message.add_reaction(REACTION_EMOJIS['image_ocr'])
+                discord_actions.add_reaction(message, REACTION_EMOJIS['image_ocr'], PRIORITY_COSMETIC)
                 return True
     return False
\ No newline at end of file
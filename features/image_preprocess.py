@@ -0,0 +1,149 @@
+"""
+画像前処理機能
+Vision APIへ送る前に画像を縮小・再圧縮してアップロード量とトークン消費を削減
+"""
+
+import io
+import asyncio
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from config import IMAGE_PREPROCESS_CONFIG
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# マジックバイトによる形式判定 (先頭バイト列, 形式名, MIMEタイプ)
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpeg', 'image/jpeg'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+    (b'BM', 'bmp', 'image/bmp'),
+]
+
+# Vision APIがそのまま受け付ける形式
+VISION_SUPPORTED_FORMATS = {'png', 'jpeg', 'gif', 'webp'}
+
+# 前処理の累計統計
+preprocess_stats = {
+    'images': 0,
+    'original_bytes': 0,
+    'output_bytes': 0,
+}
+
+_process_pool = None
+
+def sniff_image_format(data):
+    """先頭のマジックバイトから画像形式とMIMEタイプを判定"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+
+    for signature, image_format, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_format, mime_type
+
+    return None, 'application/octet-stream'
+
+def _preprocess_image_sync(data, max_edge, jpeg_quality):
+    """画像を縮小・再圧縮してメタデータを除去（プロセスプール内で実行）"""
+    source_format, source_mime = sniff_image_format(data)
+    info = {
+        'source_format': source_format,
+        'original_bytes': len(data),
+        'output_bytes': len(data),
+        'original_size': None,
+        'output_size': None,
+        'resized': False,
+        'had_metadata': False,
+    }
+
+    if Image is None:
+        info['skipped'] = 'Pillow未インストール'
+        return data, source_mime, info
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.seek(0)  # アニメーションGIFは先頭フレームのみ使用
+        info['original_size'] = image.size
+        info['had_metadata'] = bool(image.getexif()) or any(
+            key in image.info for key in ('exif', 'xmp', 'XML:com.adobe.xmp'))
+
+        # EXIFの回転情報を反映してから破棄する
+        image = ImageOps.exif_transpose(image)
+
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            info['resized'] = True
+        info['output_size'] = image.size
+
+        # スクリーンショット系（PNG/GIF/BMP）は文字がにじまないよう可逆圧縮、写真系はJPEG
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        buffer = io.BytesIO()
+        if source_format in ('png', 'gif', 'bmp') or has_alpha:
+            if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            image.save(buffer, format='PNG', optimize=True)
+            output_mime = 'image/png'
+        else:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(buffer, format='JPEG', quality=jpeg_quality, optimize=True)
+            output_mime = 'image/jpeg'
+
+    output = buffer.getvalue()
+
+    # 縮小不要で再圧縮しても小さくならない場合は元データを使う
+    # （EXIF等が付いている場合は位置情報を送らないよう必ず再エンコード結果を使う）
+    if (not info['resized'] and not info['had_metadata'] and len(output) >= len(data)
+            and source_format in VISION_SUPPORTED_FORMATS):
+        return data, source_mime, info
+
+    info['output_bytes'] = len(output)
+    return output, output_mime, info
+
+def get_process_pool():
+    """前処理用のプロセスプールを取得（初回に作成）"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_CONFIG['process_workers'])
+    return _process_pool
+
+def shutdown_process_pool():
+    """前処理用のプロセスプールを終了"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+async def preprocess_image(image_data):
+    """画像を前処理して (画像データ, MIMEタイプ, 処理情報) を返す"""
+    if not IMAGE_PREPROCESS_CONFIG['enabled']:
+        _, mime_type = sniff_image_format(image_data)
+        return image_data, mime_type, None
+
+    try:
+        loop = asyncio.get_running_loop()
+        output, mime_type, info = await loop.run_in_executor(
+            get_process_pool(),
+            partial(
+                _preprocess_image_sync,
+                image_data,
+                IMAGE_PREPROCESS_CONFIG['max_edge'],
+                IMAGE_PREPROCESS_CONFIG['jpeg_quality'],
+            )
+        )
+    except Exception as e:
+        print(f"画像前処理エラー（元画像を使用）: {e}")
+        _, mime_type = sniff_image_format(image_data)
+        return image_data, mime_type, None
+
+    preprocess_stats['images'] += 1
+    preprocess_stats['original_bytes'] += info['original_bytes']
+    preprocess_stats['output_bytes'] += info['output_bytes']
+
+    saved = info['original_bytes'] - info['output_bytes']
+    print(f"[DEBUG] 画像前処理: {info['source_format']} {info['original_size']} -> {mime_type} {info['output_size']}, "
+          f"{info['original_bytes']:,} -> {info['output_bytes']:,} bytes (削減: {saved:,} bytes)")
+    return output, mime_type, info
@@ -0,0 +1,120 @@
+"""
+ジョブキュー機能
+機能ごとの有界キューとワーカープールでAPI呼び出しの同時実行数を制御
+"""
+
+import asyncio
+import time
+from config import JOB_QUEUE_CONFIG
+
+class FeatureQueue:
+    """1機能分のキューとワーカー、統計情報"""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.worker_count = workers
+        self.max_queue = max_queue
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.workers = []
+        self.running = 0
+
+        # 統計情報
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def get_stats(self):
+        """キューの統計情報を取得"""
+        finished = self.completed + self.failed
+        return {
+            'depth': self.queue.qsize(),
+            'max_queue': self.max_queue,
+            'workers': self.worker_count,
+            'running': self.running,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'avg_wait': self.total_wait / finished if finished else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+class JobScheduler:
+    """機能ごとのキューにジョブを振り分けるスケジューラー"""
+
+    def __init__(self, queue_config):
+        self.queues = {
+            name: FeatureQueue(name, settings['workers'], settings['max_queue'])
+            for name, settings in queue_config.items()
+        }
+
+    def start(self):
+        """全キューのワーカーを起動（起動済みなら何もしない）"""
+        for feature_queue in self.queues.values():
+            if feature_queue.workers:
+                continue
+            for i in range(feature_queue.worker_count):
+                task = asyncio.create_task(self._worker(feature_queue), name=f"{feature_queue.name}-worker-{i}")
+                feature_queue.workers.append(task)
+            print(f"[DEBUG] ジョブキュー起動: {feature_queue.name} "
+                  f"(ワーカー: {feature_queue.worker_count}, 最大キュー長: {feature_queue.max_queue})")
+
+    def submit(self, feature, job_factory, label=''):
+        """ジョブを投入（キューが満杯の場合はFalseを返して破棄）"""
+        feature_queue = self.queues[feature]
+        if not feature_queue.workers:
+            self.start()
+
+        try:
+            feature_queue.queue.put_nowait((time.monotonic(), job_factory, label))
+        except asyncio.QueueFull:
+            feature_queue.dropped += 1
+            print(f"[DEBUG] ジョブキュー満杯のため破棄: {feature} {label} "
+                  f"(待機中: {feature_queue.queue.qsize()}/{feature_queue.max_queue})")
+            return False
+
+        feature_queue.submitted += 1
+        print(f"[DEBUG] ジョブ投入: {feature} {label} (待機中: {feature_queue.queue.qsize()})")
+        return True
+
+    async def _worker(self, feature_queue):
+        """キューからジョブを取り出して順に実行"""
+        while True:
+            enqueued_at, job_factory, label = await feature_queue.queue.get()
+            wait = time.monotonic() - enqueued_at
+            feature_queue.total_wait += wait
+            feature_queue.max_wait = max(feature_queue.max_wait, wait)
+            feature_queue.running += 1
+
+            print(f"[DEBUG] ジョブ開始: {feature_queue.name} {label} "
+                  f"(待ち時間: {wait:.2f}秒, 残り: {feature_queue.queue.qsize()})")
+            try:
+                await job_factory()
+                feature_queue.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                feature_queue.failed += 1
+                print(f"ジョブ実行エラー ({feature_queue.name} {label}): {e}")
+            finally:
+                feature_queue.running -= 1
+                feature_queue.queue.task_done()
+
+    def get_stats(self):
+        """全キューの統計情報を取得"""
+        return {name: feature_queue.get_stats() for name, feature_queue in self.queues.items()}
+
+    async def stop(self):
+        """全ワーカーを停止"""
+        tasks = [task for feature_queue in self.queues.values() for task in feature_queue.workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for feature_queue in self.queues.values():
+            feature_queue.workers = []
+
+# グローバルスケジューラーインスタンス
+job_scheduler = JobScheduler(JOB_QUEUE_CONFIG)
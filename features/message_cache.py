@@ -0,0 +1,69 @@
+"""
+リアクション対象メッセージのキャッシュ
+discord.pyのメッセージキャッシュに頼らず、必要になったメッセージだけを取得して件数上限付きで保持
+"""
+
+import asyncio
+from collections import OrderedDict
+import discord
+from config import BOT_CONFIG
+
+class MessageCache:
+    """メッセージIDごとのLRUキャッシュ（同じメッセージの同時取得は1回にまとめる）"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.messages = OrderedDict()
+        self.fetching = {}
+        self.hits = 0
+        self.fetches = 0
+        self.not_found = 0
+
+    def remember(self, message):
+        """受信済みのメッセージを保持（後からのリアクションで取得せずに済むように）"""
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        while len(self.messages) > self.max_entries:
+            self.messages.popitem(last=False)
+
+    async def get(self, bot, channel_id, message_id):
+        """メッセージを取得（キャッシュになければAPIから取得、見つからなければNone）"""
+        message = self.messages.get(message_id)
+        if message is not None:
+            self.messages.move_to_end(message_id)
+            self.hits += 1
+            return message
+
+        # 同じメッセージへのリアクションが同時に来ても取得は1回だけ行う
+        future = self.fetching.get(message_id)
+        if future is not None:
+            return await future
+
+        future = asyncio.get_running_loop().create_future()
+        self.fetching[message_id] = future
+        message = None
+        try:
+            self.fetches += 1
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            message = await channel.fetch_message(message_id)
+            self.remember(message)
+        except (discord.NotFound, discord.Forbidden) as e:
+            self.not_found += 1
+            print(f"リアクション対象メッセージ取得エラー ({message_id}): {e}")
+        finally:
+            del self.fetching[message_id]
+            future.set_result(message)
+        return message
+
+    def get_stats(self):
+        """キャッシュの状態を取得"""
+        return {
+            'entries': len(self.messages),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'fetches': self.fetches,
+            'not_found': self.not_found,
+        }
+
+# グローバルメッセージキャッシュインスタンス
+message_cache = MessageCache(BOT_CONFIG['fetched_message_cache_size'])
@@ -0,0 +1,75 @@
+"""
+メッセージ処理パイプライン
+on_messageの処理を段階の列として事前に組み立て、互いに依存しない段階（自動リアクション・ログ記録）は
+TaskGroupで並列に、順序が必要な段階は順番に実行し、段階ごとの所要時間とエラーを記録
+"""
+
+import time
+import asyncio
+
+class MessagePipeline:
+    """段階（並列グループまたは単独の段階）を順に実行するパイプライン"""
+
+    def __init__(self):
+        self.steps = []
+        self.stats = {}
+
+    def add_parallel(self, stages):
+        """並列に実行する段階のグループを追加（stagesは (名前, ハンドラー) の一覧）"""
+        if stages:
+            self.steps.append(stages)
+            for name, _ in stages:
+                self._init_stats(name)
+        return self
+
+    def add_stage(self, name, handler):
+        """前の段階の完了後に実行する段階を追加（Trueを返したら以降の段階は実行しない）"""
+        self.steps.append([(name, handler)])
+        self._init_stats(name)
+        return self
+
+    def _init_stats(self, name):
+        self.stats[name] = {'runs': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'last_error': None}
+
+    async def _run_stage(self, name, handler, message, results):
+        """1段階を実行して時間を記録（例外は記録して他の段階に影響させない）"""
+        stage_stats = self.stats[name]
+        start = time.monotonic()
+        try:
+            results[name] = await handler(message, results)
+        except Exception as e:
+            stage_stats['errors'] += 1
+            stage_stats['last_error'] = str(e)
+            results[name] = None
+            print(f"メッセージ処理段階エラー ({name}): {e}")
+        finally:
+            elapsed = time.monotonic() - start
+            stage_stats['runs'] += 1
+            stage_stats['total_seconds'] += elapsed
+            stage_stats['max_seconds'] = max(stage_stats['max_seconds'], elapsed)
+
+    async def run(self, message, context=None):
+        """全段階を実行して段階名ごとの結果を返す（contextは各段階に渡す事前の値）"""
+        results = dict(context or {})
+        for stages in self.steps:
+            if len(stages) == 1:
+                name, handler = stages[0]
+                await self._run_stage(name, handler, message, results)
+                if results[name] is True:
+                    break
+                continue
+
+            async with asyncio.TaskGroup() as group:
+                for name, handler in stages:
+                    group.create_task(self._run_stage(name, handler, message, results))
+        return results
+
+    def get_stats(self):
+        """段階ごとの実行回数・平均時間・エラーを取得"""
+        return {
+            name: {
+                **stage_stats,
+                'avg_seconds': stage_stats['total_seconds'] / stage_stats['runs'] if stage_stats['runs'] else 0.0,
+            }
+            for name, stage_stats in self.stats.items()
+        }
@@ -0,0 +1,129 @@
+"""
+モデルルーター
+質問の長さ・複雑さから応答モデルの階層を選び、選んだ階層のp95レイテンシがSLOを超えていれば速い階層へ切り替え
+"""
+
+import re
+import time
+from collections import deque
+from config import CHATGPT_CONFIG, MODEL_ROUTER_CONFIG
+from features.token_budget import count_tokens
+from features.trigger_registry import keyword_pattern, normalize
+
+CODE_PATTERN = re.compile(r'```|`[^`]+`|\bdef\b|\bclass\b|[{};]\s*$', re.MULTILINE)
+
+def percentile(values, ratio):
+    """値の一覧から指定した割合の位置の値を取得"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * ratio))
+    return ordered[index]
+
+class ModelRouter:
+    """階層ごとのレイテンシを記録しながら応答モデルを選択"""
+
+    def __init__(self, router_config):
+        self.config = router_config
+        self.tiers = router_config['tiers']
+        self.latencies = {tier['name']: deque(maxlen=router_config['latency_window']) for tier in self.tiers}
+        self.stats = {
+            tier['name']: {'decisions': 0, 'fallback_in': 0, 'errors': 0, 'reasons': {}}
+            for tier in self.tiers
+        }
+        # 'code' が 'decode' や 'encoder' の一部に一致しないよう、英字キーワードは単語の境界で照合
+        keywords = [normalize(keyword) for keyword in router_config['complex_keywords']]
+        self.complex_pattern = re.compile('|'.join(keyword_pattern(keyword) for keyword in keywords)) if keywords else None
+
+    def get_model(self, tier):
+        """階層のモデル名（未指定はテキスト会話の既定モデル）"""
+        return tier['model'] or CHATGPT_CONFIG['text_model']
+
+    def classify(self, user_message, history):
+        """質問の長さと複雑さから階層の位置と理由を決める"""
+        strongest = len(self.tiers) - 1
+        prompt_tokens = count_tokens(user_message, CHATGPT_CONFIG['text_model'])
+
+        if prompt_tokens >= self.config['long_prompt_tokens']:
+            return strongest, '長い質問'
+        if CODE_PATTERN.search(user_message):
+            return strongest, 'コードを含む'
+        if self.complex_pattern is not None and self.complex_pattern.search(normalize(user_message)):
+            return strongest, '複雑な質問'
+        if user_message.count('?') + user_message.count('？') >= 2 or user_message.count('\n') >= 4:
+            return strongest, '複数の質問'
+
+        # 会話の続きは前の応答の文脈を扱えるよう最速の階層は使わない
+        if prompt_tokens <= self.config['short_prompt_tokens'] and not history:
+            return 0, '短い質問'
+        return min(1, strongest), '通常の質問'
+
+    def get_recent_latencies(self, tier_name):
+        """有効期間内のレイテンシ一覧（古い記録は判定に使わない）"""
+        cutoff = time.monotonic() - self.config['latency_max_age_seconds']
+        return [seconds for recorded_at, seconds in self.latencies[tier_name] if recorded_at >= cutoff]
+
+    def get_p95(self, tier_name):
+        """階層の直近のp95レイテンシ（件数不足ならNone）"""
+        # 切り替え後は遅い階層に記録が増えないため、古い記録が期限切れになれば元の階層に戻る
+        latencies = self.get_recent_latencies(tier_name)
+        if len(latencies) < self.config['min_latency_samples']:
+            return None
+        return percentile(latencies, 0.95)
+
+    def route(self, user_message, history=None):
+        """応答に使う階層を決めて {'tier', 'model', 'reason'} を返す"""
+        if not self.config['enabled']:
+            return {'tier': None, 'model': CHATGPT_CONFIG['text_model'], 'reason': 'ルーター無効'}
+
+        index, reason = self.classify(user_message, history)
+
+        # SLOを超えている階層は1つずつ速い階層へ切り替える
+        while index > 0:
+            tier = self.tiers[index]
+            p95 = self.get_p95(tier['name'])
+            if p95 is None or p95 <= tier['slo_p95_seconds']:
+                break
+            index -= 1
+            reason = f"{reason}（{tier['name']}がSLO超過）"
+            print(f"[DEBUG] {tier['name']}のp95 {p95:.1f}秒がSLO {tier['slo_p95_seconds']}秒を超過")
+            self.stats[self.tiers[index]['name']]['fallback_in'] += 1
+
+        tier = self.tiers[index]
+        tier_stats = self.stats[tier['name']]
+        tier_stats['decisions'] += 1
+        tier_stats['reasons'][reason] = tier_stats['reasons'].get(reason, 0) + 1
+
+        decision = {'tier': tier['name'], 'model': self.get_model(tier), 'reason': reason}
+        print(f"[DEBUG] モデル選択: {decision['tier']} ({decision['model']}) - {reason}")
+        return decision
+
+    def record_latency(self, decision, seconds, success=True):
+        """応答にかかった時間を階層ごとに記録（失敗は件数のみ）"""
+        if decision['tier'] is None:
+            return
+        if not success:
+            self.stats[decision['tier']]['errors'] += 1
+            return
+        self.latencies[decision['tier']].append((time.monotonic(), seconds))
+
+    def get_stats(self):
+        """階層ごとの選択回数とレイテンシを取得"""
+        result = {}
+        for tier in self.tiers:
+            name = tier['name']
+            latencies = self.get_recent_latencies(name)
+            result[name] = {
+                'model': self.get_model(tier),
+                'decisions': self.stats[name]['decisions'],
+                'fallback_in': self.stats[name]['fallback_in'],
+                'errors': self.stats[name]['errors'],
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'slo_p95_seconds': tier['slo_p95_seconds'],
+                'reasons': dict(self.stats[name]['reasons']),
+            }
+        return result
+
+# グローバルモデルルーターインスタンス
+model_router = ModelRouter(MODEL_ROUTER_CONFIG)
@@ -0,0 +1,97 @@
+"""
+OpenAI共有クライアント
+プロセス全体で1つのAsyncOpenAIクライアントを共有し、接続をプールして再利用
+"""
+
+import os
+import time
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+from config import OPENAI_CLIENT_CONFIG
+
+# プロセス共有のクライアントインスタンス
+_client = None
+_client_api_key = None
+
+def get_api_key():
+    """環境変数からAPIキーを取得してクリーンアップ"""
+    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+    if not OPENAI_API_KEY:
+        return None
+
+    # APIキーをクリーンアップ（改行や空白を除去）
+    return OPENAI_API_KEY.strip().replace('\n', '').replace(' ', '')
+
+def get_base_url():
+    """APIの接続先を取得（設定 → 環境変数OPENAI_BASE_URL の順、どちらもなければNoneで公式API）"""
+    return OPENAI_CLIENT_CONFIG.get('base_url') or os.getenv('OPENAI_BASE_URL') or None
+
+def _create_client(api_key):
+    """接続プール設定済みのAsyncOpenAIクライアントを作成"""
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_CLIENT_CONFIG['max_connections'],
+            max_keepalive_connections=OPENAI_CLIENT_CONFIG['max_keepalive_connections'],
+            keepalive_expiry=OPENAI_CLIENT_CONFIG['keepalive_expiry'],
+        ),
+    )
+
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=get_base_url(),
+        http_client=http_client,
+        timeout=Timeout(
+            OPENAI_CLIENT_CONFIG['timeout'],
+            connect=OPENAI_CLIENT_CONFIG['connect_timeout'],
+        ),
+        max_retries=OPENAI_CLIENT_CONFIG['max_retries'],
+    )
+
+def get_openai_client():
+    """共有AsyncOpenAIクライアントを取得（APIキー未設定時はNone）"""
+    global _client, _client_api_key
+
+    api_key = get_api_key()
+    if not api_key:
+        return None
+
+    # APIキーが変わった場合のみ作り直す
+    if _client is None or _client_api_key != api_key:
+        _client = _create_client(api_key)
+        _client_api_key = api_key
+        print(f"[DEBUG] OpenAI共有クライアント作成 (APIキー長: {len(api_key)}, "
+              f"最大接続数: {OPENAI_CLIENT_CONFIG['max_connections']}, 接続先: {_client.base_url})")
+
+    return _client
+
+async def warmup_openai_client():
+    """接続を事前に確立して初回リクエストのTLSハンドシェイクを省く"""
+    if not OPENAI_CLIENT_CONFIG.get('warmup_on_ready', True):
+        return False
+
+    client = get_openai_client()
+    if client is None:
+        print("[DEBUG] OpenAI APIキー未設定のためウォームアップをスキップ")
+        return False
+
+    try:
+        start = time.monotonic()
+        await client.models.list()
+        elapsed_ms = (time.monotonic() - start) * 1000
+        print(f"[DEBUG] OpenAI接続ウォームアップ完了: {elapsed_ms:.0f}ms")
+        return True
+    except Exception as e:
+        print(f"OpenAI接続ウォームアップエラー: {e}")
+        return False
+
+async def close_openai_client():
+    """共有クライアントの接続プールを閉じる"""
+    global _client, _client_api_key
+
+    if _client is not None:
+        try:
+            await _client.close()
+        except Exception as e:
+            print(f"OpenAIクライアント終了エラー: {e}")
+        _client = None
+        _client_api_key = None
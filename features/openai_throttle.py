@@ -0,0 +1,251 @@
+"""
+OpenAIレート制限スロットラー
+レスポンスヘッダーの残りリクエスト数・トークン数を追跡し、
+429や遅延の急増に応じて同時実行数をAIMDで調整、ジッター付き指数バックオフで再試行
+"""
+
+import re
+import time
+import random
+import asyncio
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from config import THROTTLE_CONFIG
+
+DURATION_PART_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_reset_duration(value):
+    """'1s' / '6m0s' / '20ms' 形式のリセット時間を秒に変換"""
+    if not value:
+        return None
+    parts = DURATION_PART_PATTERN.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+def _to_int(value):
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+def get_retry_after(headers):
+    """retry-after系ヘッダーから待機秒数を取得"""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return None
+
+class RateBucket:
+    """ヘッダーで同期する残量バケット（リクエスト数またはトークン数）"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, limit, remaining, reset_seconds):
+        """レスポンスヘッダーの値で残量を更新"""
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+        if reset_seconds is not None:
+            self.reset_at = time.monotonic() + reset_seconds
+
+    def wait_time(self, amount):
+        """amount分を使えるようになるまでの待機秒数"""
+        if self.remaining is None:
+            return 0.0
+        now = time.monotonic()
+        if now >= self.reset_at:
+            # リセット済みとみなして上限まで回復
+            self.remaining = self.limit if self.limit is not None else self.remaining
+            return 0.0
+        if self.remaining >= amount:
+            return 0.0
+        return self.reset_at - now
+
+    def reserve(self, amount):
+        """次のヘッダー更新までの間、手元で残量を減らしておく"""
+        if self.remaining is not None:
+            self.remaining = max(0, self.remaining - amount)
+
+class AdaptiveConcurrencyLimiter:
+    """AIMDで上限を調整する同時実行数リミッター"""
+
+    def __init__(self, initial, minimum, maximum, decrease_factor):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def increase(self):
+        """加算的に増加（上限に達するまで1ウィンドウあたり約+1）"""
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def decrease(self):
+        """乗算的に減少"""
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+class OpenAIThrottler:
+    """すべてのOpenAI呼び出しで共有するスロットラー"""
+
+    def __init__(self, throttle_config):
+        self.config = throttle_config
+        self.limiter = AdaptiveConcurrencyLimiter(
+            throttle_config['initial_concurrency'],
+            throttle_config['min_concurrency'],
+            throttle_config['max_concurrency'],
+            throttle_config['decrease_factor'],
+        )
+        self.request_buckets = {}
+        self.token_buckets = {}
+        self.latency_ewma = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+    def _buckets(self, model):
+        if model not in self.request_buckets:
+            self.request_buckets[model] = RateBucket()
+            self.token_buckets[model] = RateBucket()
+        return self.request_buckets[model], self.token_buckets[model]
+
+    def update_from_headers(self, model, headers):
+        """x-ratelimit-* ヘッダーからバケットを更新"""
+        if headers is None:
+            return
+        request_bucket, token_bucket = self._buckets(model)
+        request_bucket.update(
+            _to_int(headers.get('x-ratelimit-limit-requests')),
+            _to_int(headers.get('x-ratelimit-remaining-requests')),
+            parse_reset_duration(headers.get('x-ratelimit-reset-requests')),
+        )
+        token_bucket.update(
+            _to_int(headers.get('x-ratelimit-limit-tokens')),
+            _to_int(headers.get('x-ratelimit-remaining-tokens')),
+            parse_reset_duration(headers.get('x-ratelimit-reset-tokens')),
+        )
+
+    async def _wait_for_capacity(self, model, estimated_tokens):
+        """リクエスト数・トークン数の残量が足りるまで待機"""
+        request_bucket, token_bucket = self._buckets(model)
+        while True:
+            wait = max(request_bucket.wait_time(1), token_bucket.wait_time(estimated_tokens))
+            if wait <= 0:
+                request_bucket.reserve(1)
+                token_bucket.reserve(estimated_tokens)
+                return
+            print(f"[DEBUG] レート制限の残量不足のため待機: {model} {wait:.2f}秒")
+            await asyncio.sleep(min(wait, self.config['backoff_max']))
+
+    def _backoff_delay(self, attempt, headers=None):
+        """ジッター付き指数バックオフの待機秒数（retry-afterがあれば優先）"""
+        retry_after = get_retry_after(headers)
+        if retry_after is not None:
+            return min(retry_after, self.config['backoff_max'])
+        delay = min(self.config['backoff_max'], self.config['backoff_base'] * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def _record_latency(self, model, latency):
+        """遅延の急増を検出したら同時実行数を下げ、通常時は少しずつ上げる"""
+        average = self.latency_ewma.get(model)
+        if average is None:
+            self.latency_ewma[model] = latency
+            self.limiter.increase()
+            return
+
+        if latency > average * self.config['latency_spike_factor'] and latency > self.config['latency_spike_min_seconds']:
+            self.limiter.decrease()
+            print(f"[DEBUG] レイテンシ急増を検出: {model} {latency:.2f}秒 (平均 {average:.2f}秒) "
+                  f"-> 同時実行上限 {self.limiter.limit:.1f}")
+        else:
+            self.limiter.increase()
+        self.latency_ewma[model] = average * 0.8 + latency * 0.2
+
+    async def call(self, model, request_fn, estimated_tokens=0):
+        """with_raw_responseのリクエストを実行してパース済みの結果を返す
+
+        request_fn は呼ぶたびに新しいリクエストを送るコルーチン関数。
+        """
+        max_retries = self.config['max_retries']
+        for attempt in range(max_retries + 1):
+            await self._wait_for_capacity(model, estimated_tokens)
+            await self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                self.requests += 1
+                raw_response = await request_fn()
+            except RateLimitError as e:
+                headers = e.response.headers if e.response is not None else None
+                self.update_from_headers(model, headers)
+                # 利用枠の超過は待っても回復しないので即座に失敗させる
+                if getattr(e, 'code', None) == 'insufficient_quota' or attempt == max_retries:
+                    raise
+                self.rate_limited += 1
+                self.limiter.decrease()
+                delay = self._backoff_delay(attempt, headers)
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                if attempt == max_retries:
+                    raise
+                headers = getattr(getattr(e, 'response', None), 'headers', None)
+                delay = self._backoff_delay(attempt, headers)
+            else:
+                self._record_latency(model, time.monotonic() - start)
+                self.update_from_headers(model, raw_response.headers)
+                return raw_response.parse()
+            finally:
+                await self.limiter.release()
+
+            self.retries += 1
+            print(f"[DEBUG] OpenAI再試行 ({attempt + 1}/{max_retries}): {model} {delay:.2f}秒後 "
+                  f"(同時実行上限 {self.limiter.limit:.1f})")
+            await asyncio.sleep(delay)
+
+    def get_stats(self):
+        """スロットラーの状態を取得"""
+        buckets = {}
+        for model, request_bucket in self.request_buckets.items():
+            token_bucket = self.token_buckets[model]
+            buckets[model] = {
+                'remaining_requests': request_bucket.remaining,
+                'remaining_tokens': token_bucket.remaining,
+            }
+        return {
+            'concurrency_limit': self.limiter.limit,
+            'in_flight': self.limiter.in_flight,
+            'requests': self.requests,
+            'rate_limited': self.rate_limited,
+            'retries': self.retries,
+            'buckets': buckets,
+        }
+
+# グローバルスロットラーインスタンス
+openai_throttler = OpenAIThrottler(THROTTLE_CONFIG)
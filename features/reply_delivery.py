@@ -0,0 +1,117 @@
+"""
+長文の返信
+文字数上限に合わせて行・コードブロックの境界で分割し、分割数が多すぎる場合は
+メモリ上のバッファから作った添付ファイル1つで送信
+"""
+
+import io
+import re
+import discord
+from config import CHATGPT_CONFIG, REPLY_DELIVERY_CONFIG
+from features.discord_actions import discord_actions
+
+FENCE_PATTERN = re.compile(r'^\s*(`{3,}|~{3,})(.*)$')
+LINE_BREAK_CHARS = ('。', '、', '. ', ', ', ' ')
+
+def split_long_line(line, width):
+    """上限より長い1行を句読点や空白の位置で分割"""
+    pieces = []
+    while len(line) > width:
+        cut = max(line.rfind(char, 0, width) + len(char) for char in LINE_BREAK_CHARS)
+        # 区切りが前半にしかなければ上限の位置でそのまま切る
+        if cut < width // 2:
+            cut = width
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def _split(text, limit, max_chunks=None):
+    """行単位でlimit文字以内のチャンクに詰め、(チャンク一覧, 残りのテキスト) を返す
+
+    コードブロックの途中で分割する場合は閉じてから次のチャンクで同じ言語指定で開き直す。
+    max_chunks件に達したら残りは分割せずにそのまま返す。
+    """
+    chunks = []
+    lines = []
+    length = 0
+    offset = 0    # 元のテキストのうち現在のチャンクまでに含めた位置
+    fence = None  # 開いているコードブロックの開始行
+
+    for line_index, line in enumerate(text.split('\n')):
+        match = FENCE_PATTERN.match(line)
+        next_fence = fence
+        if match and fence is None:
+            next_fence = line.strip()
+        elif match and fence is not None and match.group(1)[0] == fence[0] and not match.group(2).strip():
+            next_fence = None
+
+        # 途中で分割したときに閉じる記号と開き直す行の分を空けておく
+        reserve = len(next_fence) + 1 if next_fence else 0
+        reopen = len(fence) + 1 if fence else 0
+        for piece_index, piece in enumerate(split_long_line(line, max(1, limit - reserve - reopen))):
+            added = len(piece) + (1 if lines else 0)
+            if lines and length + added + reserve > limit:
+                body = '\n'.join(lines)
+                if fence is not None:
+                    body += '\n' + FENCE_PATTERN.match(fence).group(1)
+                chunks.append(body)
+                # 新しい行から始まる場合は区切りの改行を含めない
+                rest = text[offset + (1 if piece_index == 0 and line_index > 0 else 0):]
+                if fence is not None:
+                    rest = fence + '\n' + rest
+                if max_chunks is not None and len(chunks) >= max_chunks:
+                    return chunks, rest
+                lines = [fence] if fence is not None else []
+                length = len(fence) if fence is not None else 0
+                added = len(piece) + (1 if lines else 0)
+            lines.append(piece)
+            length += added
+            # 2行目以降の先頭の断片は直前の改行も含めて消費
+            offset += len(piece) + (1 if piece_index == 0 and line_index > 0 else 0)
+        fence = next_fence
+
+    chunks.append('\n'.join(lines))
+    return chunks, ''
+
+def split_text(text, limit):
+    """行単位でlimit文字以内のチャンクに詰める（コードブロックは分割位置で閉じて開き直す）
+
+    最後のチャンクは閉じないので、逐次表示中のテキストの分割にも使える。
+    """
+    if not text:
+        return []
+    return _split(text, limit)[0]
+
+def split_first_chunk(text, limit):
+    """先頭のチャンクと、続きのテキスト（コードブロックの途中なら開き直した状態）に分ける"""
+    chunks, rest = _split(text, limit, max_chunks=1)
+    return chunks[0], rest
+
+def format_chunk(title, chunk, index, total, code_block):
+    """返信1件分の本文を作成"""
+    header = f"**{title} ({index}/{total}):**" if total > 1 else f"**{title}:**"
+    if code_block:
+        return f"{header}\n```\n{chunk}\n```"
+    return f"{header}\n{chunk}"
+
+async def send_long_reply(message, text, title, filename, code_block=False):
+    """長文を分割して返信し、分割数が上限を超える場合は添付ファイルで返信（最初の返信を返す）"""
+    max_length = CHATGPT_CONFIG['max_message_length']
+    overhead = len(format_chunk(title, '', 99, 99, code_block))
+    chunks = split_text(text, max_length - overhead)
+
+    if len(chunks) > REPLY_DELIVERY_CONFIG['max_chunks']:
+        # 1件ずつ返信するとAPI呼び出しが増えるため、全文はファイルにまとめて1回で送る
+        preview = split_text(text, REPLY_DELIVERY_CONFIG['file_preview_length'])[0]
+        content = format_chunk(title, preview, 1, 1, code_block)
+        content += f"\n（全{len(text)}文字のため全文を添付ファイルで送信します）"
+        file = discord.File(io.BytesIO(text.encode('utf-8')), filename=filename)
+        print(f"[DEBUG] 長文をファイルで送信: {filename} {len(text)}文字 ({len(chunks)}分割相当)")
+        return await discord_actions.reply(message, content, file=file)
+
+    first_reply = None
+    for i, chunk in enumerate(chunks):
+        sent = await discord_actions.reply(message, format_chunk(title, chunk, i + 1, len(chunks), code_block))
+        first_reply = first_reply or sent
+    return first_reply
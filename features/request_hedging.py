@@ -0,0 +1,114 @@
+"""
+ヘッジリクエスト
+冪等なOpenAI呼び出しが直近のp90レイテンシを過ぎても返らなければ同じリクエストをもう1本送り、
+先に返った方を使って残りはキャンセル（追加リクエスト数は機能ごとの予算内に制限）
+"""
+
+import time
+import asyncio
+from collections import deque
+from config import HEDGING_CONFIG
+from features.model_router import percentile
+from features.openai_throttle import openai_throttler
+
+class RequestHedger:
+    """機能ごとのレイテンシとヘッジ予算を管理して遅いリクエストを二重化"""
+
+    def __init__(self, hedging_config):
+        self.config = hedging_config
+        self.latencies = {}
+        self.stats = {}
+
+    def _feature_stats(self, feature):
+        if feature not in self.stats:
+            self.stats[feature] = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'skipped_budget': 0}
+        return self.stats[feature]
+
+    def is_enabled(self, feature):
+        return self.config['enabled'] and feature in self.config['features']
+
+    def get_hedge_delay(self, latency_key):
+        """2本目を送るまでの待ち時間（件数不足ならNone）"""
+        latencies = self.latencies.get(latency_key)
+        if latencies is None or len(latencies) < self.config['min_latency_samples']:
+            return None
+        delay = percentile(latencies, self.config['hedge_percentile'])
+        return max(self.config['min_delay_seconds'], delay)
+
+    def record_latency(self, latency_key, seconds):
+        if latency_key not in self.latencies:
+            self.latencies[latency_key] = deque(maxlen=self.config['latency_window'])
+        self.latencies[latency_key].append(seconds)
+
+    def _has_budget(self, feature_stats):
+        """追加リクエストが全体の一定割合に収まるか"""
+        return feature_stats['hedged'] + 1 <= feature_stats['requests'] * self.config['budget_ratio']
+
+    def _is_throttled(self):
+        """同時実行数が上限に達しているときはヘッジで負荷を増やさない"""
+        limiter = openai_throttler.limiter
+        return limiter.in_flight >= int(limiter.limit)
+
+    async def call(self, feature, request_fn, latency_key=None):
+        """request_fnを実行し、遅ければ2本目を送って先に成功した結果を返す
+
+        request_fn は呼ぶたびに新しいリクエストを送るコルーチン関数。
+        latency_key はレイテンシを分けて記録する単位（省略時は機能名、モデルごとに分ける場合などに指定）。
+        """
+        if not self.is_enabled(feature):
+            return await request_fn()
+
+        latency_key = latency_key or feature
+        feature_stats = self._feature_stats(feature)
+        feature_stats['requests'] += 1
+
+        start = time.monotonic()
+        primary = asyncio.create_task(request_fn())
+        tasks = {primary}
+        try:
+            delay = self.get_hedge_delay(latency_key)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if not self._has_budget(feature_stats):
+                        feature_stats['skipped_budget'] += 1
+                    elif not self._is_throttled():
+                        feature_stats['hedged'] += 1
+                        print(f"[DEBUG] ヘッジリクエスト送信: {feature} ({delay:.1f}秒経過)")
+                        tasks.add(asyncio.create_task(request_fn()))
+
+            # 先に成功した方を使い、片方が失敗してももう片方の結果を待つ
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                failed = [task for task in done if task.exception() is not None]
+                winner = next((task for task in done if task not in failed), None)
+                if winner is not None or not pending:
+                    break
+                tasks = pending
+
+            if winner is None:
+                raise failed[0].exception()
+
+            if winner is not primary:
+                feature_stats['hedge_wins'] += 1
+            # キャンセルしたリクエストの時間は分からないため、採用した結果までの時間を記録
+            self.record_latency(latency_key, time.monotonic() - start)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def get_stats(self):
+        """機能ごとのヘッジ状況を取得"""
+        result = {}
+        for feature, feature_stats in self.stats.items():
+            requests = feature_stats['requests']
+            result[feature] = {
+                **feature_stats,
+                'hedge_rate': feature_stats['hedged'] / requests if requests else 0.0,
+            }
+        return {'enabled': self.config['enabled'], 'features': result}
+
+# グローバルヘッジインスタンス
+request_hedger = RequestHedger(HEDGING_CONFIG)
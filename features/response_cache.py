@@ -0,0 +1,169 @@
+"""
+ChatGPT応答キャッシュ
+正規化したプロンプト・モデル・max_tokensをキーにLRU/TTLで応答を保持
+"""
+
+import os
+import json
+import asyncio
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from config import RESPONSE_CACHE_CONFIG
+
+class ResponseCache:
+    """サイズ上限付きLRU + TTLのメモリキャッシュ（任意でJSONに永続化）"""
+
+    def __init__(self, max_entries, ttl_seconds, persist_path=None, save_delay=5.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.save_delay = save_delay
+        self._save_handle = None  # 遅延保存のタイマー
+        self._save_task = None    # 書き込み中のスレッドタスク
+        self.entries = OrderedDict()  # key -> {'value': ..., 'created_at': ...}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    @staticmethod
+    def normalize_prompt(text):
+        """表記ゆれを吸収するためプロンプトを正規化"""
+        text = unicodedata.normalize('NFKC', text or '')
+        return ' '.join(text.split()).lower()
+
+    def make_key(self, prompt, model, max_tokens):
+        """キャッシュキーを生成"""
+        raw = f"{model}\n{max_tokens}\n{self.normalize_prompt(prompt)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """キャッシュから値を取得（期限切れ・未登録はNone）"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if time.time() - entry['created_at'] > self.ttl_seconds:
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry['value']
+
+    def set(self, key, value):
+        """キャッシュに値を保存し、上限を超えた分を古い順に削除"""
+        self.entries[key] = {'value': value, 'created_at': time.time()}
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+        self.schedule_save()
+
+    def load(self):
+        """永続化ファイルからキャッシュを復元"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+
+            now = time.time()
+            for key, entry in data.items():
+                if now - entry['created_at'] <= self.ttl_seconds:
+                    self.entries[key] = entry
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            print(f"[DEBUG] 応答キャッシュ復元: {len(self.entries)}件")
+        except Exception as e:
+            print(f"応答キャッシュ読み込みエラー: {e}")
+
+    def schedule_save(self):
+        """永続化を遅延させ、続けて保存された分を1回の書き込みにまとめる"""
+        if not self.persist_path:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外ではその場で書き出す
+            self.save()
+            return
+
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(self.save_delay, self._start_save)
+
+    def _start_save(self):
+        """スナップショットを取り、書き込みをスレッドで実行"""
+        self._save_handle = None
+        if self._save_task is not None and not self._save_task.done():
+            # 前回の書き込みが終わっていなければ次の機会に回す
+            self.schedule_save()
+            return
+
+        snapshot = dict(self.entries)
+        self._save_task = asyncio.ensure_future(asyncio.to_thread(self._write, snapshot))
+
+    async def flush(self):
+        """保存待ちのタイマーを取り消し、書き込み中の保存を待ってから最新の内容を書き出し（終了時用）"""
+        if self._save_handle is None:
+            if self._save_task is not None:
+                await self._save_task
+            return
+
+        self._save_handle.cancel()
+        self._save_handle = None
+        if self._save_task is not None:
+            await self._save_task
+        snapshot = dict(self.entries)
+        await asyncio.to_thread(self._write, snapshot)
+
+    def save(self):
+        """キャッシュを同期的にファイルへ書き出し"""
+        self._write(dict(self.entries))
+
+    def _write(self, entries):
+        """ファイルに書き出し（途中で壊れないよう一時ファイル経由で置き換え）"""
+        if not self.persist_path:
+            return
+
+        try:
+            cache_dir = os.path.dirname(self.persist_path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            temp_path = f"{self.persist_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(temp_path, self.persist_path)
+        except Exception as e:
+            print(f"応答キャッシュ保存エラー: {e}")
+
+    def get_stats(self):
+        """ヒット率などの統計情報を取得"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+# グローバルキャッシュインスタンス
+chatgpt_response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_CONFIG['max_entries'],
+    ttl_seconds=RESPONSE_CACHE_CONFIG['ttl_seconds'],
+    persist_path=RESPONSE_CACHE_CONFIG.get('persist_path'),
+    save_delay=RESPONSE_CACHE_CONFIG.get('save_delay_seconds', 5.0),
+)
@@ -0,0 +1,128 @@
+"""
+結果ストア
+内容のハッシュをキーに処理結果をSQLiteへ保存（LRU削除・件数/サイズ上限付き）
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+
+def make_content_key(data, *parts):
+    """バイト列のSHA-256と付加情報（モデル名など）からキーを生成"""
+    digest = hashlib.sha256(data).hexdigest()
+    return ':'.join([digest] + [str(part) for part in parts])
+
+class ResultStore:
+    """SQLiteを使ったディスク上の結果キャッシュ"""
+
+    def __init__(self, db_path, max_entries, max_bytes=None):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        """初回アクセス時にDBを開いてテーブルを作成"""
+        if self.conn is not None:
+            return self.conn
+
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' last_access REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)')
+        self.conn.commit()
+        return self.conn
+
+    def get(self, key):
+        """結果を取得（未登録はNone）し、最終アクセス時刻を更新"""
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        """結果を保存し、上限を超えた分を最終アクセスの古い順に削除"""
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, value, size, now, now)
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        """件数上限・サイズ上限を超えた分を削除"""
+        count = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+        excess = max(0, count - self.max_entries)
+        if excess:
+            conn.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access LIMIT ?)',
+                (excess,)
+            )
+            self.evictions += excess
+
+        if self.max_bytes is None:
+            return
+
+        total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        while total_size > self.max_bytes:
+            row = conn.execute('SELECT key, size FROM results ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            conn.execute('DELETE FROM results WHERE key = ?', (row[0],))
+            total_size -= row[1]
+            self.evictions += 1
+
+    async def aget(self, key):
+        """イベントループを止めないようスレッドで取得"""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, value):
+        """イベントループを止めないようスレッドで保存"""
+        await asyncio.to_thread(self.put, key, value)
+
+    def get_stats(self):
+        """ヒット率などの統計情報を取得"""
+        with self.lock:
+            conn = self._connect()
+            entries, total_size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'total_bytes': total_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -6,7 +6,11 @@
 import os
 import datetime
 import json
+import asyncio
+import threading
 from config import BOT_CONFIG
+from features.discord_actions import discord_actions, PRIORITY_COSMETIC
+from features.trigger_registry import trigger_registry
 
 # 対象ルームIDは設定ファイルから取得
 def get_target_room_id():
@@ -23,6 +27,7 @@ class RoomLogger:
             os.makedirs(self.log_dir)
         self.log_file = os.path.join(self.log_dir, f"room_{room_id}_log.txt")
         self.metadata_file = os.path.join(self.log_dir, f"room_{room_id}_metadata.json")
+        self.write_lock = threading.Lock()  # スレッドから同時にメタデータを書き換えないように
         self.ensure_log_files()
 
     def ensure_log_files(self):
@@ -44,27 +49,31 @@ class RoomLogger:
 
     def log_message(self, message):
         """メッセージをログファイルに記録"""
+        self.write_entry(f"{message.author.name}#{message.author.discriminator}", message.content)
+
+    def write_entry(self, user_info, content):
+        """ログ1行の追記とメタデータ更新（スレッドから呼ばれるためロックで直列化）"""
         try:
             timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            log_entry = f"[{timestamp}] {message.author.name}#{message.author.discriminator}: {message.content}\n"
+            log_entry = f"[{timestamp}] {user_info}: {content}\n"
 
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
+            with self.write_lock:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(log_entry)
 
-            # メタデータ更新
-            self.update_metadata(message.author)
+                # メタデータ更新
+                self.update_metadata(user_info)
 
         except Exception as e:
             print(f"ログ記録エラー: {e}")
 
-    def update_metadata(self, author):
+    def update_metadata(self, user_info):
         """メタデータファイルを更新"""
         try:
             with open(self.metadata_file, 'r', encoding='utf-8') as f:
                 metadata = json.load(f)
 
             # ユーザー情報を更新
-            user_info = f"{author.name}#{author.discriminator}"
             if user_info not in metadata["unique_users"]:
                 metadata["unique_users"].append(user_info)
 
@@ -87,7 +96,9 @@ async def handle_room_logging(message):
         return False
 
     try:
-        room_logger.log_message(message)
+        # ファイル書き込みは並列に動く他の段階を止めないようスレッドで実行
+        user_info = f"{message.author.name}#{message.author.discriminator}"
+        await asyncio.to_thread(room_logger.write_entry, user_info, message.content)
         if BOT_CONFIG.get('debug_level') == 'DEBUG':
             print(f"ルームログ記録: {message.author.name} in {message.channel.name}")
         return True
@@ -112,7 +123,7 @@ async def handle_room_stats_reaction(message, bot):
 
     try:
         # 処理開始を通知
-        await message.add_reaction(REACTION_EMOJIS['processing'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['processing'])
 
         # 統計情報を取得
         stats = await get_room_stats()
@@ -124,7 +135,7 @@ async def handle_room_stats_reaction(message, bot):
             stats_text += f"・ユニークユーザー数: {len(stats['unique_users'])}\n"
             stats_text += f"・最終更新: {stats['last_updated'][:19]}\n"
 
-            await message.reply(stats_text)
+            await discord_actions.reply(message, stats_text)
 
             # ログファイルをDiscordに送信
             try:
@@ -140,21 +151,19 @@ async def handle_room_stats_reaction(message, bot):
             except Exception as e:
                 print(f"ログファイル送信エラー: {e}")
         else:
-            await message.reply("ルーム統計の取得に失敗しました。")
+            await discord_actions.reply(message, "ルーム統計の取得に失敗しました。")
 
         # 処理完了を通知
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['success'])
+        discord_actions.finish_processing(message, REACTION_EMOJIS['success'], bot.user)
         return True
 
     except Exception as e:
         print(f"ルーム統計処理エラー: {str(e)}")
-        await message.reply("ルーム統計の処理中にエラーが発生しました。")
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['error'])
+        await discord_actions.reply(message, "ルーム統計の処理中にエラーが発生しました。")
+        discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
         return False
 
-async def auto_add_room_stats_reaction(message):
+async def auto_add_room_stats_reaction(message, triggers=None):
     """特定のキーワードメッセージに自動で📊リアクションを追加"""
     from config import BOT_CONFIG, REACTION_EMOJIS
 
@@ -163,9 +172,10 @@ async def auto_add_room_stats_reaction(message):
         return False
 
     # 特定のキーワードでルーム統計をトリガー
-    trigger_keywords = ['ルーム統計', 'room stats', '統計', 'stats', 'ログ統計', '部屋統計']
-    if message.content and any(keyword in message.content.lower() for keyword in trigger_keywords):
+    if triggers is None:
+        triggers = trigger_registry.match(message.content)
+    if 'room_stats' in triggers:
         print(f"[DEBUG] 📊リアクション追加: ルーム統計トリガー")
-        await message.add_reaction(REACTION_EMOJIS['room_stats'])
+        discord_actions.add_reaction(message, REACTION_EMOJIS['room_stats'], PRIORITY_COSMETIC)
         return True
     return False
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+ジョブの重複排除（シングルフライト）
+同じメッセージ・同じ機能の処理は1つだけ実行し、後からのリアクションは実行中の処理に合流、
+完了済みの場合は以前の返信へのリンクで応答
+"""
+
+import json
+import time
+import asyncio
+from config import SINGLE_FLIGHT_CONFIG
+from features.result_store import ResultStore
+
+class SingleFlight:
+    """(メッセージID, 機能) ごとの実行中ジョブと完了済み結果の索引"""
+
+    def __init__(self, single_flight_config):
+        self.config = single_flight_config
+        self.in_flight = {}
+        self.completed_index = ResultStore(
+            single_flight_config['db_path'],
+            max_entries=single_flight_config['max_entries'],
+        )
+        self.started = 0
+        self.joined = 0
+        self.linked = 0
+
+    def make_key(self, message_id, feature):
+        return f"{message_id}:{feature}"
+
+    def join(self, message_id, feature):
+        """実行中のジョブがあればそのFutureを返す（なければNone）"""
+        future = self.in_flight.get(self.make_key(message_id, feature))
+        if future is not None:
+            self.joined += 1
+        return future
+
+    def claim(self, message_id, feature):
+        """実行権を確保してFutureを登録（awaitを挟まずに呼ぶことで重複起動を防ぐ）"""
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[self.make_key(message_id, feature)] = future
+        self.started += 1
+        return future
+
+    def release(self, message_id, feature, result=None):
+        """ジョブの終了を記録して合流中の待機者に結果を渡す"""
+        future = self.in_flight.pop(self.make_key(message_id, feature), None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def lookup_completed(self, message_id, feature):
+        """完了済み結果の返信先 {'channel_id', 'reply_id', 'jump_url'} を取得（なければNone）"""
+        if not self.config['enabled']:
+            return None
+        value = await self.completed_index.aget(self.make_key(message_id, feature))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def record_completed(self, message_id, feature, reply):
+        """完了した処理の返信メッセージを索引に保存"""
+        if not self.config['enabled'] or not reply:
+            return
+        value = json.dumps({
+            'channel_id': reply.channel.id,
+            'reply_id': reply.id,
+            'jump_url': reply.jump_url,
+            'completed_at': time.time(),
+        })
+        await self.completed_index.aput(self.make_key(message_id, feature), value)
+
+    def get_stats(self):
+        """重複排除の統計を取得"""
+        index_stats = self.completed_index.get_stats()
+        return {
+            'in_flight': len(self.in_flight),
+            'started': self.started,
+            'joined': self.joined,
+            'linked': self.linked,
+            'completed_entries': index_stats['entries'],
+        }
+
+# グローバルシングルフライトインスタンス
+single_flight = SingleFlight(SINGLE_FLIGHT_CONFIG)
@@ -0,0 +1,191 @@
+"""
+トークン予算管理
+送信前にtiktokenでプロンプトのトークン数を数え、コンテキスト長と想定応答長からmax_tokensを決定し、
+予測と実際の使用量を記録
+"""
+
+import asyncio
+from config import TOKEN_BUDGET_CONFIG
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# メッセージ1件ごとの書式トークン数と、応答開始の固定トークン数
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+# モデル名ごとのエンコーダー（読み込み失敗時はNoneを保持して再試行しない）
+_encoders = {}
+
+class TokenBudgetError(Exception):
+    """入力がトークン予算に収まらない場合の例外"""
+
+def get_encoder(model):
+    """モデルに対応するエンコーダーを取得（初回のみ読み込み）"""
+    if model in _encoders:
+        return _encoders[model]
+
+    encoder = None
+    if tiktoken is not None:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # 未登録のモデル名は新しい世代のエンコーディングで代用
+            try:
+                encoder = tiktoken.get_encoding('o200k_base')
+            except Exception as e:
+                print(f"tiktokenエンコーダー読み込みエラー ({model}): {e}")
+        except Exception as e:
+            print(f"tiktokenエンコーダー読み込みエラー ({model}): {e}")
+
+    _encoders[model] = encoder
+    return encoder
+
+async def preload_encoders(models):
+    """エンコーダーの読み込み（初回はダウンロードを伴う）をスレッドで済ませておく"""
+    for model in set(models):
+        await asyncio.to_thread(get_encoder, model)
+
+def count_tokens(text, model):
+    """テキストのトークン数を数える（エンコーダーがない場合はUTF-8バイト数から概算）"""
+    if not text:
+        return 0
+    encoder = get_encoder(model)
+    if encoder is None:
+        # 日本語は1文字(3バイト)≒1トークン、英語は多めに見積もる
+        return len(text.encode('utf-8')) // 3 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model):
+    """Chat Completionsのmessagesのトークン数を数える（画像部分は含まない）"""
+    total = REPLY_PRIMING_TOKENS
+    for message in messages:
+        total += TOKENS_PER_MESSAGE
+        content = message.get('content')
+        if isinstance(content, str):
+            total += count_tokens(content, model)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    total += count_tokens(part.get('text', ''), model)
+    return total
+
+def get_cached_tokens(usage):
+    """usageからプロンプトキャッシュで再利用された入力トークン数を取得"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', None) or 0
+
+class TokenBudget:
+    """プロンプトのトークン数からmax_tokensを決め、予測と実績を機能ごとに集計"""
+
+    def __init__(self, budget_config):
+        self.config = budget_config
+        self.stats = {}
+
+    def _feature_stats(self, feature):
+        if feature not in self.stats:
+            self.stats[feature] = {
+                'calls': 0,
+                'predicted_prompt_tokens': 0,
+                'actual_prompt_tokens': 0,
+                'cached_prompt_tokens': 0,
+                'reserved_completion_tokens': 0,
+                'actual_completion_tokens': 0,
+                'truncated': 0,
+                'trimmed_inputs': 0,
+                'rejected': 0,
+            }
+        return self.stats[feature]
+
+    def get_context_window(self, model):
+        """モデルのコンテキスト長を取得"""
+        return self.config['context_windows'].get(model, self.config['default_context_window'])
+
+    def fit_input(self, feature, text, model):
+        """ユーザー入力を上限まで切り詰める（大きすぎる入力はTokenBudgetError）"""
+        tokens = count_tokens(text, model)
+        if tokens > self.config['reject_input_tokens']:
+            self._feature_stats(feature)['rejected'] += 1
+            raise TokenBudgetError(f"メッセージが長すぎます（約{tokens:,}トークン、上限 {self.config['reject_input_tokens']:,}トークン）。")
+
+        limit = self.config['max_input_tokens']
+        if tokens <= limit:
+            return text
+
+        encoder = get_encoder(model)
+        if encoder is not None:
+            trimmed = encoder.decode(encoder.encode(text, disallowed_special=())[:limit])
+        else:
+            trimmed = text[:len(text) * limit // tokens]
+        self._feature_stats(feature)['trimmed_inputs'] += 1
+        print(f"[DEBUG] 入力を切り詰め: {feature} {tokens}トークン -> {limit}トークン")
+        return trimmed
+
+    def expected_answer_tokens(self, text, model):
+        """質問文の長さから想定応答長を見積もる"""
+        return int(count_tokens(text, model) * self.config['answer_ratio'])
+
+    def plan(self, feature, model, messages, max_completion_tokens, extra_prompt_tokens=0, expected_completion_tokens=None):
+        """プロンプトのトークン数を数えてmax_tokensを決める
+
+        extra_prompt_tokens は画像など数えられない入力の見積もり。
+        expected_completion_tokens を省略した場合は入力の長さから想定応答長を決める。
+        """
+        prompt_tokens = count_message_tokens(messages, model) + extra_prompt_tokens
+        available = self.get_context_window(model) - prompt_tokens - self.config['safety_margin_tokens']
+        if available < self.config['min_completion_tokens']:
+            self._feature_stats(feature)['rejected'] += 1
+            raise TokenBudgetError(f"入力が長すぎて応答の余地がありません（約{prompt_tokens:,}トークン）。")
+
+        if expected_completion_tokens is None:
+            expected_completion_tokens = int(prompt_tokens * self.config['answer_ratio'])
+        expected_completion_tokens = max(self.config['min_completion_tokens'], expected_completion_tokens)
+
+        max_tokens = min(max_completion_tokens, expected_completion_tokens, available)
+        return {
+            'feature': feature,
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'max_tokens': max_tokens,
+        }
+
+    def record_usage(self, budget, usage, finish_reason=None):
+        """予測したトークン数と実際の使用量を記録"""
+        stats = self._feature_stats(budget['feature'])
+        stats['calls'] += 1
+        stats['predicted_prompt_tokens'] += budget['prompt_tokens']
+        stats['reserved_completion_tokens'] += budget['max_tokens']
+        if usage is not None:
+            stats['actual_prompt_tokens'] += usage.prompt_tokens
+            stats['cached_prompt_tokens'] += get_cached_tokens(usage)
+            stats['actual_completion_tokens'] += usage.completion_tokens
+        if finish_reason == 'length':
+            stats['truncated'] += 1
+
+        if usage is not None:
+            print(f"[DEBUG] トークン使用量 ({budget['feature']}): 入力 予測{budget['prompt_tokens']}/実際{usage.prompt_tokens}"
+                  f" (キャッシュ{get_cached_tokens(usage)}), "
+                  f"出力 上限{budget['max_tokens']}/実際{usage.completion_tokens}")
+
+    def get_stats(self):
+        """機能ごとの予測精度と予約トークンの使用率を取得"""
+        result = {}
+        for feature, stats in self.stats.items():
+            result[feature] = dict(stats)
+            actual_prompt = stats['actual_prompt_tokens']
+            reserved = stats['reserved_completion_tokens']
+            result[feature]['prompt_error_rate'] = (
+                (stats['predicted_prompt_tokens'] - actual_prompt) / actual_prompt if actual_prompt else 0.0
+            )
+            result[feature]['cache_rate'] = (
+                stats['cached_prompt_tokens'] / actual_prompt if actual_prompt else 0.0
+            )
+            result[feature]['completion_utilization'] = (
+                stats['actual_completion_tokens'] / reserved if reserved else 0.0
+            )
+        return result
+
+# グローバルトークン予算インスタンス
+token_budget = TokenBudget(TOKEN_BUDGET_CONFIG)
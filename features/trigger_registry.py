@@ -0,0 +1,89 @@
+"""
+トリガーキーワード登録
+全機能のキーワードを1つの正規表現にまとめ、メッセージを1回走査するだけで一致した機能をすべて取得
+（同じ位置から始まる別の機能のキーワードも機能ごとのグループで取得）
+"""
+
+import re
+import unicodedata
+from config import TRIGGER_KEYWORDS
+
+KANJI = r'㐀-䶿一-鿿豈-﫿々'
+ASCII_WORD_PATTERN = re.compile(r'^[a-z0-9 ]+$')
+SINGLE_KANJI_PATTERN = re.compile(f'^[{KANJI}]$')
+
+def normalize(text):
+    """全角英数字を半角にして小文字化"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+def keyword_pattern(keyword):
+    """短いキーワードの誤検出を防ぐ境界条件付きのパターン"""
+    escaped = re.escape(keyword)
+    if ASCII_WORD_PATTERN.match(keyword):
+        # 'ai' が 'said' や 'email' の一部に一致しないよう英字の境界を要求（'gpt4' のような後ろの数字は許可）
+        return rf'(?<![a-z0-9]){escaped}(?![a-z])'
+    if SINGLE_KANJI_PATTERN.match(keyword):
+        # '話' が '電話' や '話題' のような別の熟語の一部に一致しないようにする
+        return rf'(?<![{KANJI}]){escaped}(?![{KANJI}])'
+    return escaped
+
+class TriggerRegistry:
+    """機能ごとのキーワードをまとめた正規表現（キーワードが変わったら作り直す）"""
+
+    def __init__(self, trigger_keywords):
+        self.trigger_keywords = trigger_keywords
+        self.version = 0          # キーワードを変更するたびに増やす
+        self.built_version = None
+        self.pattern = None
+        self.group_features = {}
+        self.builds = 0
+        self.rebuild()
+
+    def set_keywords(self, feature, keywords):
+        """機能のキーワードを変更（次の照合で正規表現を作り直す）"""
+        self.trigger_keywords[feature] = list(keywords)
+        self.version += 1
+
+    def rebuild(self):
+        """キーワードから正規表現を作成"""
+        all_keywords = set()
+        feature_alternatives = []
+        self.group_features = {}
+        for index, (feature, keywords) in enumerate(self.trigger_keywords.items()):
+            normalized = sorted({normalize(keyword) for keyword in keywords}, key=len, reverse=True)
+            if not normalized:
+                continue
+            all_keywords.update(normalized)
+            # 機能ごとに1つの先読みグループにまとめ、同じ位置から始まる別の機能のキーワードも取りこぼさない
+            group = f'f{index}'
+            self.group_features[group] = feature
+            alternatives = '|'.join(keyword_pattern(keyword) for keyword in normalized)
+            feature_alternatives.append(f'(?:(?=(?P<{group}>{alternatives})))?')
+
+        if all_keywords:
+            # 先頭の先読みでキーワードが始まらない位置を読み飛ばし、一致した位置でだけ機能ごとに照合
+            any_keyword = '|'.join(keyword_pattern(keyword) for keyword in sorted(all_keywords, key=len, reverse=True))
+            self.pattern = re.compile(f"(?={any_keyword}){''.join(feature_alternatives)}")
+        else:
+            self.pattern = None
+        self.built_version = self.version
+        self.builds += 1
+        print(f"[DEBUG] トリガーキーワード構築: {len(all_keywords)}語 / {len(self.trigger_keywords)}機能")
+
+    def match(self, text):
+        """一致した機能と最初に一致したキーワードの辞書 {機能: キーワード} を返す"""
+        if self.built_version != self.version:
+            self.rebuild()
+        if not text or self.pattern is None:
+            return {}
+
+        matched = {}
+        for match in self.pattern.finditer(normalize(text)):
+            for group, feature in self.group_features.items():
+                keyword = match.group(group)
+                if keyword is not None:
+                    matched.setdefault(feature, keyword)
+        return matched
+
+# グローバルトリガー登録インスタンス
+trigger_registry = TriggerRegistry(TRIGGER_KEYWORDS)
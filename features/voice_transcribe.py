@@ -3,97 +3,182 @@
 音声ファイルをChatGPT Whisper APIで文字起こし
 """
 
-import os
-import tempfile
-from openai import OpenAI
-from config import REACTION_EMOJIS
-
-async def transcribe_audio_with_whisper(audio_data, filename):
-    """Whisper APIを使用して音声をテキストに変換"""
-    temp_file_path = None
+import asyncio
+from config import CHATGPT_CONFIG, REACTION_EMOJIS, TRANSCRIPTION_CACHE_CONFIG, AUDIO_CHUNK_CONFIG
+from features.openai_client import get_openai_client
+from features.openai_throttle import openai_throttler
+from features.request_hedging import request_hedger
+from features.circuit_breaker import circuit_breakers, CircuitOpenError
+from features.discord_actions import discord_actions, PRIORITY_COSMETIC
+from features.reply_delivery import send_long_reply
+from features.result_store import ResultStore, make_content_key
+from features.attachments import process_attachments, combine_attachment_results, AttachmentError
+from features.audio_chunking import ffmpeg_available, transcribe_long_audio
+
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.m4a', '.flac']
+
+TRANSCRIBE_LANGUAGE = 'ja'
+
+# 音声ハッシュと言語をキーにした文字起こし結果キャッシュ（sample05と共有）
+transcription_result_store = ResultStore(
+    TRANSCRIPTION_CACHE_CONFIG['db_path'],
+    max_entries=TRANSCRIPTION_CACHE_CONFIG['max_entries'],
+    max_bytes=TRANSCRIPTION_CACHE_CONFIG['max_bytes'],
+)
+
+async def lookup_cached_transcription(audio_data, language):
+    """同じ音声・言語の文字起こし結果を検索（無効またはミスの場合はNone）"""
+    if not TRANSCRIPTION_CACHE_CONFIG['enabled']:
+        return None
+
+    cache_key = await asyncio.to_thread(make_content_key, audio_data, language)
+    cached_text = await transcription_result_store.aget(cache_key)
+    if cached_text is not None:
+        print(f"[DEBUG] 文字起こしキャッシュヒット: {cache_key[:16]}...")
+    return cached_text
+
+async def store_cached_transcription(audio_data, language, text):
+    """文字起こし結果をキャッシュに保存"""
+    if not TRANSCRIPTION_CACHE_CONFIG['enabled']:
+        return
+
+    cache_key = await asyncio.to_thread(make_content_key, audio_data, language)
+    await transcription_result_store.aput(cache_key, text)
+
+async def request_transcription(client, audio_data, upload_name):
+    """Whisper APIで1ファイル分を文字起こし"""
+    # 一時ファイルを使わずメモリ上のバイト列をそのまま送信
+    async with circuit_breakers.guard('audio'):
+        transcription = await request_hedger.call(
+            'voice_transcribe',
+            lambda: openai_throttler.call(
+                "whisper-1",
+                lambda: client.audio.transcriptions.with_raw_response.create(
+                    model="whisper-1",
+                    file=(upload_name, audio_data),
+                    response_format="text",
+                    language=TRANSCRIBE_LANGUAGE,
+                    prompt="以下は日本語の音声です。正確に文字起こしをしてください。句読点も適切に付けてください。"
+                )
+            ),
+            # 処理時間は音声の長さに比例するため、ヘッジの待ち時間はサイズ5MB刻みで計算
+            latency_key=f"voice_transcribe:{len(audio_data) // (5 * 1024 * 1024)}"
+        )
+    return transcription.strip()
+
+async def transcribe_audio_with_whisper(audio_data, filename, on_segment=None):
+    """Whisper APIを使用して音声をテキストに変換（長い音声は分割して並列処理、失敗時はAttachmentError）"""
     try:
-        OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-        if not OPENAI_API_KEY:
-            return "OpenAI APIキーが設定されていません。"
-
-        # APIキーをクリーンアップ（改行や空白を除去）
-        OPENAI_API_KEY = OPENAI_API_KEY.strip().replace('\n', '').replace(' ', '')
-        print(f"[DEBUG] OpenAI APIキー長 (音声): {len(OPENAI_API_KEY)}")
-
-        # OpenAIクライアントを初期化
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
-        # 一時ファイルとして保存
-        file_ext = os.path.splitext(filename)[1] if filename else '.mp3'
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as temp_file:
-            temp_file.write(audio_data)
-            temp_file_path = temp_file.name
-
-        # Whisper APIで文字起こし
-        with open(temp_file_path, 'rb') as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                response_format="text",
-                language="ja",
-                prompt="以下は日本語の音声です。正確に文字起こしをしてください。句読点も適切に付けてください。"
+        # 同じ音声の結果があれば再利用
+        cached_text = await lookup_cached_transcription(audio_data, TRANSCRIBE_LANGUAGE)
+        if cached_text is not None:
+            return cached_text
+
+        # 共有クライアントを取得
+        client = get_openai_client()
+        if client is None:
+            raise AttachmentError("OpenAI APIキーが設定されていません。")
+
+        upload_name = filename if filename else 'audio.mp3'
+
+        transcribed_text = None
+        if AUDIO_CHUNK_CONFIG['enabled'] and ffmpeg_available():
+            # 長い音声・大きい音声は区間に分けて並列に文字起こし（分割不要ならNone）
+            transcribed_text = await transcribe_long_audio(
+                audio_data,
+                upload_name,
+                lambda segment_data, segment_name: request_transcription(client, segment_data, segment_name),
+                on_segment
             )
 
-        return transcription.strip()
+        if transcribed_text is None:
+            if len(audio_data) > AUDIO_CHUNK_CONFIG['max_upload_bytes']:
+                max_mb = AUDIO_CHUNK_CONFIG['max_upload_bytes'] // (1024 * 1024)
+                raise AttachmentError(f"音声ファイルが{max_mb}MBを超えています。分割して処理するにはffmpegが必要です。")
+            transcribed_text = await request_transcription(client, audio_data, upload_name)
 
+        await store_cached_transcription(audio_data, TRANSCRIBE_LANGUAGE, transcribed_text)
+        return transcribed_text
+
+    except AttachmentError:
+        raise
+    except CircuitOpenError as e:
+        raise AttachmentError(f"⚡ {e}") from e
     except Exception as e:
         print(f"音声文字起こしエラー: {str(e)}")
-        return "エラーが発生しました。"
-    finally:
-        # 一時ファイルを削除
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.unlink(temp_file_path)
-            except Exception as e:
-                print(f"一時ファイル削除エラー: {e}")
+        raise AttachmentError("エラーが発生しました。") from e
+
+def is_audio_attachment(attachment):
+    """音声ファイルの添付かどうかを判定"""
+    return any(attachment.filename.lower().endswith(ext) for ext in AUDIO_EXTENSIONS)
 
 async def handle_voice_transcription(message, bot):
-    """音声ファイルの文字起こし処理"""
+    """音声ファイルの文字起こし処理（成功時は結果の返信メッセージを返す）"""
     # 音声添付がない場合はスキップ
     if not message.attachments:
         return False
 
-    # 音声ファイルかチェック
-    audio_attachment = None
-    for attachment in message.attachments:
-        if any(attachment.filename.lower().endswith(ext) for ext in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']):
-            audio_attachment = attachment
-            break
+    # 音声ファイルをすべて対象にする
+    audio_attachments = [attachment for attachment in message.attachments if is_audio_attachment(attachment)]
+    if not audio_attachments:
+        return False
 
-    if not audio_attachment:
+    # OpenAI側の不調でブレーカーがオープン中ならダウンロードせずにすぐ返信
+    open_error = circuit_breakers.open_error('audio')
+    if open_error is not None:
+        await discord_actions.reply(message, f"⚡ {open_error}")
         return False
 
     try:
         # 処理開始を通知
-        await message.add_reaction(REACTION_EMOJIS['processing'])
-
-        # 音声をダウンロード
-        audio_data = await audio_attachment.read()
-
-        # Whisper APIで文字起こし
-        transcribed_text = await transcribe_audio_with_whisper(audio_data, audio_attachment.filename)
-
-        # 結果を送信
+        discord_actions.add_reaction(message, REACTION_EMOJIS['processing'])
+
+        async def transcribe_attachment(attachment):
+            # 音声をダウンロードしてWhisper APIで文字起こし
+            audio_data = await attachment.read()
+            progress_message = None
+
+            async def on_segment(done, total, text_so_far):
+                # 長い音声は区間が終わるたびに途中結果を表示
+                nonlocal progress_message
+                preview = text_so_far[-1500:] if text_so_far else "..."
+                content = f"**🎤 `{attachment.filename}` 文字起こし中 ({done}/{total}区間完了):**\n```\n{preview}\n```"
+                if progress_message is None:
+                    progress_message = await discord_actions.reply(message, content)
+                else:
+                    await discord_actions.edit(progress_message, content=content)
+
+            return await transcribe_audio_with_whisper(audio_data, attachment.filename, on_segment)
+
+        # 複数音声を同時実行数の上限付きで並列処理し、添付順にまとめる
+        results = await process_attachments(
+            audio_attachments, transcribe_attachment, CHATGPT_CONFIG['max_parallel_attachments']
+        )
+        transcribed_text, succeeded = combine_attachment_results(
+            audio_attachments, results, "（音声を認識できませんでした）", "（処理中にエラーが発生しました）"
+        )
+
+        # 結果を送信（先頭の返信を処理済み結果として返す）
+        result_reply = None
         if transcribed_text.strip():
-            await message.reply(f"**🎤 音声文字起こし結果:**\n```\n{transcribed_text}\n```")
+            # 長すぎる場合は行単位で分割し、分割数が多ければファイルで送信
+            result_reply = await send_long_reply(
+                message, transcribed_text, "🎤 音声文字起こし結果", "transcription.txt", code_block=True
+            )
         else:
-            await message.reply("音声からテキストを認識できませんでした。")
+            result_reply = await discord_actions.reply(message, "音声からテキストを認識できませんでした。")
 
-        # 処理完了を通知
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['success'])
-        return True
+        # 処理完了を通知（失敗した添付があれば完了済みとして記録させない）
+        if not succeeded:
+            discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
+            return False
+        discord_actions.finish_processing(message, REACTION_EMOJIS['success'], bot.user)
+        return result_reply
 
     except Exception as e:
         print(f"音声処理エラー: {str(e)}")
-        await message.reply("音声の処理中にエラーが発生しました。")
-        await message.remove_reaction(REACTION_EMOJIS['processing'], bot.user)
-        await message.add_reaction(REACTION_EMOJIS['error'])
+        await discord_actions.reply(message, "音声の処理中にエラーが発生しました。")
+        discord_actions.finish_processing(message, REACTION_EMOJIS['error'], bot.user)
         return False
 
 async def auto_add_voice_reaction(message):
@@ -107,8 +192,8 @@ async def auto_add_voice_reaction(message):
 
     if message.attachments:
         for attachment in message.attachments:
-            if any(attachment.filename.lower().endswith(ext) for ext in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']):
+            if is_audio_attachment(attachment):
                 print(f"[DEBUG] 🎤リアクション追加: {attachment.filename}")
-                await message.add_reaction(REACTION_EMOJIS['voice_transcribe'])
+                discord_actions.add_reaction(message, REACTION_EMOJIS['voice_transcribe'], PRIORITY_COSMETIC)
                 return True
     return False
\ No newline at end of file
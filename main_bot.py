@@ -16,14 +16,30 @@ import logging
 from dotenv import load_dotenv
 
 # 設定とフィーチャーをインポート
-from config import FEATURES, REACTION_EMOJIS, BOT_CONFIG
-from features.image_ocr import handle_image_ocr_reaction, auto_add_image_reaction
-from features.voice_transcribe import handle_voice_transcription, auto_add_voice_reaction
+from config import FEATURES, REACTION_EMOJIS, BOT_CONFIG, CHATGPT_CONFIG
+from features.image_ocr import handle_image_ocr_reaction, auto_add_image_reaction, ocr_result_store, vision_detail_stats
+from features.voice_transcribe import handle_voice_transcription, auto_add_voice_reaction, transcription_result_store
 from features.basic_greeting import handle_basic_greeting
-from features.chatgpt_text import handle_chatgpt_conversation
+from features.chatgpt_text import is_chatgpt_trigger, reply_with_chatgpt
 from features.room_logging import handle_room_logging, get_room_stats
 from features.guild_info import handle_guild_info_collection, handle_member_collection, get_channel_info
 from features.chat_logging import handle_chat_logging, collect_all_channels_history
+from features.openai_client import warmup_openai_client, close_openai_client
+from features.openai_throttle import openai_throttler
+from features.request_hedging import request_hedger
+from features.circuit_breaker import circuit_breakers
+from features.discord_actions import discord_actions
+from features.message_cache import message_cache
+from features.message_pipeline import MessagePipeline
+from features.trigger_registry import trigger_registry
+from features.token_budget import token_budget, preload_encoders
+from features.conversation_store import conversation_store
+from features.single_flight import single_flight
+from features.conversation_lanes import conversation_lanes, LaneFullError
+from features.model_router import model_router
+from features.image_preprocess import shutdown_process_pool, preprocess_stats
+from features.job_queue import job_scheduler
+from features.response_cache import chatgpt_response_cache
 
 # 環境変数を読み込み
 load_dotenv()
@@ -47,8 +63,39 @@ if BOT_CONFIG['intents_reactions']:
 if BOT_CONFIG['intents_voice_states']:
     intents.voice_states = True
 
+class IntegratedBot(commands.Bot):
+    """終了時に共有リソースを解放するボット"""
+
+    async def close(self):
+        await job_scheduler.stop()
+        # 遅延保存中の応答キャッシュを書き出してから終了
+        await chatgpt_response_cache.flush()
+        await close_openai_client()
+        shutdown_process_pool()
+        await super().close()
+
 # ボットを初期化
-bot = commands.Bot(command_prefix=BOT_CONFIG['command_prefix'], intents=intents)
+bot = IntegratedBot(
+    command_prefix=BOT_CONFIG['command_prefix'],
+    intents=intents,
+    max_messages=BOT_CONFIG['max_messages'],
+)
+
+# リアクションで起動するジョブ（機能フラグ, ジョブ名=REACTION_EMOJISのキー, ハンドラー）
+REACTION_JOBS = [
+    ('chatgpt_image_ocr', 'image_ocr', handle_image_ocr_reaction),
+    ('chatgpt_voice', 'voice_transcribe', handle_voice_transcription),
+]
+
+def build_reaction_handlers():
+    """有効な機能だけの 絵文字 → (ジョブ名, ハンドラー) の表を作成"""
+    return {
+        REACTION_EMOJIS[job]: (job, handler)
+        for feature, job, handler in REACTION_JOBS
+        if FEATURES[feature]
+    }
+
+REACTION_HANDLERS = build_reaction_handlers()
 
 @bot.event
 async def on_ready():
@@ -80,31 +127,145 @@ async def on_ready():
 
     print('='*50)
 
+    # 機能ごとのジョブキューのワーカーを起動
+    job_scheduler.start()
+
+    # OpenAI接続を事前確立（初回リクエストの遅延を削減）
+    if FEATURES['chatgpt_text'] or FEATURES['chatgpt_voice'] or FEATURES['chatgpt_image_ocr']:
+        await warmup_openai_client()
+        # トークン数計算用のエンコーダーを先に読み込んでおく
+        await preload_encoders([CHATGPT_CONFIG['text_model'], CHATGPT_CONFIG['vision_model']])
+
+async def submit_feature_job(feature, message, job_factory):
+    """ジョブキューに投入（満杯の場合は混雑リアクションを付けて破棄）"""
+    if job_scheduler.submit(feature, job_factory, label=f"message={message.id}"):
+        return True
+
+    discord_actions.add_reaction(message, REACTION_EMOJIS['busy'])
+    return False
+
+async def link_completed_result(message, completed):
+    """以前の結果の返信が残っていればリンクを返信（削除済みならFalse）"""
+    channel = bot.get_channel(completed['channel_id']) or message.channel
+    try:
+        await channel.fetch_message(completed['reply_id'])
+    except discord.NotFound:
+        return False
+
+    await discord_actions.reply(message, f"✅ このメッセージは処理済みです: {completed['jump_url']}", mention_author=False)
+    single_flight.linked += 1
+    return True
+
+async def submit_single_flight_job(feature, message, job_factory):
+    """同じメッセージ・機能のジョブを1つにまとめてジョブキューに投入"""
+    # 実行中なら同じジョブの完了を待つだけにする（返信は最初のジョブが行う）
+    running = single_flight.join(message.id, feature)
+    if running is not None:
+        print(f"[DEBUG] 実行中のジョブに合流: {feature} message={message.id}")
+        await running
+        return True
+
+    # 完了済みの確認でawaitする前に実行権を確保し、同時に来たリアクションを合流させる
+    single_flight.claim(message.id, feature)
+
+    try:
+        completed = await single_flight.lookup_completed(message.id, feature)
+        if completed is not None and await link_completed_result(message, completed):
+            print(f"[DEBUG] 完了済みの結果へリンク: {feature} message={message.id}")
+            single_flight.release(message.id, feature)
+            return True
+    except Exception as e:
+        print(f"完了済みジョブ確認エラー: {e}")
+
+    async def run_job():
+        reply = None
+        try:
+            # ハンドラーはすべての添付に成功したときだけ返信メッセージを返す
+            reply = await job_factory()
+            await single_flight.record_completed(message.id, feature, reply)
+            return reply
+        finally:
+            single_flight.release(message.id, feature, result=reply)
+
+    if not await submit_feature_job(feature, message, run_job):
+        single_flight.release(message.id, feature)
+        return False
+    return True
+
+async def submit_conversation_job(message):
+    """同じ会話の中では順番に、別の会話とは並列にChatGPT応答をジョブキューへ投入"""
+    conversation_key = conversation_lanes.make_key(message.channel.id, message.author.id)
+    try:
+        await conversation_lanes.submit(
+            conversation_key,
+            lambda: reply_with_chatgpt(message),
+            lambda job: submit_feature_job('chatgpt_text', message, job)
+        )
+    except LaneFullError:
+        discord_actions.add_reaction(message, REACTION_EMOJIS['busy'])
+
 @bot.event
-async def on_reaction_add(reaction, user):
-    """リアクション追加時の処理"""
-    if user.bot:
+async def on_raw_reaction_add(payload):
+    """リアクション追加時の処理（キャッシュにない古いメッセージへのリアクションも受け取る）"""
+    if payload.user_id == bot.user.id or (payload.member is not None and payload.member.bot):
         return
 
-    message = reaction.message
-    emoji_str = str(reaction.emoji)
+    # 対象外の絵文字はメッセージを取得する前に除外
+    emoji_str = str(payload.emoji)
+    entry = REACTION_HANDLERS.get(emoji_str)
+    if entry is None:
+        return
 
     # 指定チャンネルのみで動作
-    if message.channel.id != BOT_CONFIG.get('target_channel_id'):
-        print(f"[DEBUG] リアクション対象外チャンネル: {message.channel.id}")
+    if payload.channel_id != BOT_CONFIG.get('target_channel_id'):
+        print(f"[DEBUG] リアクション対象外チャンネル: {payload.channel_id}")
+        return
+
+    message = await message_cache.get(bot, payload.channel_id, payload.message_id)
+    if message is None:
         return
 
-    print(f"[DEBUG] リアクション検知: {emoji_str} by {user.name} in {message.channel.name}")
+    job, handler = entry
+    print(f"[DEBUG] リアクション検知: {emoji_str} by {payload.user_id} -> {job}開始")
+    await submit_single_flight_job(job, message, lambda: handler(message, bot))
+
+async def chatgpt_text_stage(message, results):
+    """ChatGPTテキスト会話（トリガーに一致したらジョブを投入し、以降の段階は実行しない）"""
+    if not is_chatgpt_trigger(message, results['triggers']):
+        return False
+    await submit_conversation_job(message)
+    return True
+
+async def basic_greeting_stage(message, results):
+    """基本的な挨拶（リアクション追加されていない場合のみ）"""
+    if results.get('image_reaction') or results.get('voice_reaction'):
+        return False
+    return await handle_basic_greeting(message)
+
+def build_message_pipeline():
+    """有効な機能からon_messageの処理段階を組み立て"""
+    pipeline = MessagePipeline()
+
+    # 自動リアクションとログ記録は互いに独立しているので並列に実行（ログのファイル書き込みはスレッドで行う）
+    independent_stages = []
+    if FEATURES['chatgpt_image_ocr']:
+        independent_stages.append(('image_reaction', lambda message, results: auto_add_image_reaction(message)))
+    if FEATURES['chatgpt_voice']:
+        independent_stages.append(('voice_reaction', lambda message, results: auto_add_voice_reaction(message)))
+    if FEATURES['room_logging']:
+        independent_stages.append(('room_logging', lambda message, results: handle_room_logging(message)))
+    if FEATURES['chat_logging']:
+        independent_stages.append(('chat_logging', lambda message, results: handle_chat_logging(message)))
+    pipeline.add_parallel(independent_stages)
 
-    # 🦀 画像文字起こし機能
-    if FEATURES['chatgpt_image_ocr'] and emoji_str == REACTION_EMOJIS['image_ocr']:
-        print(f"[DEBUG] 🦀画像文字起こし開始")
-        await handle_image_ocr_reaction(message, bot)
+    # 応答する段階は順番に（ChatGPTが応答する場合は挨拶しない）
+    if FEATURES['chatgpt_text']:
+        pipeline.add_stage('chatgpt_text', chatgpt_text_stage)
+    if FEATURES['basic_greeting']:
+        pipeline.add_stage('basic_greeting', basic_greeting_stage)
+    return pipeline
 
-    # 🎤 音声文字起こし機能
-    if FEATURES['chatgpt_voice'] and emoji_str == REACTION_EMOJIS['voice_transcribe']:
-        print(f"[DEBUG] 🎤音声文字起こし開始")
-        await handle_voice_transcription(message, bot)
+message_pipeline = build_message_pipeline()
 
 @bot.event
 async def on_message(message):
@@ -120,40 +281,12 @@ async def on_message(message):
     if FEATURES['debug_logging']:
         print(f'[DEBUG] 対象チャンネルメッセージ: {message.author} -> "{message.content[:50]}..." in {message.channel.name}')
 
-    # 自動リアクション追加
-    reaction_added = False
-
-    # 画像に自動で🦀リアクション
-    if FEATURES['chatgpt_image_ocr']:
-        if await auto_add_image_reaction(message):
-            reaction_added = True
-            print(f'[DEBUG] 🦀リアクション追加完了')
-
-    # 音声に自動で🎤リアクション
-    if FEATURES['chatgpt_voice']:
-        if await auto_add_voice_reaction(message):
-            reaction_added = True
-
-    # ログ機能処理
-    # ルームログ機能
-    if FEATURES['room_logging']:
-        await handle_room_logging(message)
-
-    # チャットログ機能
-    if FEATURES['chat_logging']:
-        await handle_chat_logging(message)
-
-    # メッセージ処理
-    # ChatGPTテキスト会話機能
-    if FEATURES['chatgpt_text']:
-        if await handle_chatgpt_conversation(message):
-            await bot.process_commands(message)
-            return
-
-    # 基本的な挨拶機能（リアクション追加されていない場合のみ）
-    if FEATURES['basic_greeting'] and not reaction_added:
-        await handle_basic_greeting(message)
+    # 添付のあるメッセージは後からリアクションされたときに取得し直さないよう保持
+    if message.attachments:
+        message_cache.remember(message)
 
+    # 全機能のトリガーキーワードを1回の走査で照合して各段階で共有
+    await message_pipeline.run(message, {'triggers': trigger_registry.match(message.content)})
     await bot.process_commands(message)
 
 @bot.command(name='features')
@@ -165,6 +298,18 @@ async def show_features(ctx):
         status = "✅ 有効" if enabled else "❌ 無効"
         embed.add_field(name=feature_name, value=status, inline=True)
 
+    state_labels = {'closed': '🟢 正常', 'half_open': '🟡 試行中', 'open': '🔴 停止中'}
+    for endpoint, stats in circuit_breakers.get_stats().items():
+        state = state_labels[stats['state']]
+        if stats['state'] == 'open':
+            state += f" (あと{stats['retry_after']:.0f}秒)"
+        value = (f"{state}\n"
+                 f"直近{stats['calls']}件 失敗率: {stats['failure_rate']:.0%} / 遅延率: {stats['slow_rate']:.0%}\n"
+                 f"停止: {stats['opened']}回 / 即時失敗: {stats['rejected']}件")
+        if stats['last_reason']:
+            value += f"\n前回の停止理由: {stats['last_reason']}"
+        embed.add_field(name=f"API {endpoint} ({stats['label']})", value=value, inline=False)
+
     await ctx.send(embed=embed)
 
 @bot.command(name='help_reactions')
@@ -176,6 +321,7 @@ async def show_reactions(ctx):
         'image_ocr': '画像の文字起こし',
         'voice_transcribe': '音声の文字起こし',
         'processing': '処理中',
+        'busy': '混雑中（しばらくしてから再試行）',
         'success': '成功',
         'error': 'エラー'
     }
@@ -186,6 +332,183 @@ async def show_reactions(ctx):
 
     await ctx.send(embed=embed)
 
+@bot.command(name='queue_stats')
+async def show_queue_stats(ctx):
+    """ジョブキューの状態を表示"""
+    embed = discord.Embed(title="📥 ジョブキュー状態", color=0x0099ff)
+
+    for feature, stats in job_scheduler.get_stats().items():
+        value = (f"待機: {stats['depth']}/{stats['max_queue']}\n"
+                 f"実行中: {stats['running']}/{stats['workers']}\n"
+                 f"完了: {stats['completed']} / 失敗: {stats['failed']} / 破棄: {stats['dropped']}\n"
+                 f"平均待ち: {stats['avg_wait']:.2f}秒 / 最大待ち: {stats['max_wait']:.2f}秒")
+        embed.add_field(name=feature, value=value, inline=False)
+
+    dedup_stats = single_flight.get_stats()
+    embed.add_field(
+        name="重複排除",
+        value=(f"実行中: {dedup_stats['in_flight']} / 開始: {dedup_stats['started']}\n"
+               f"合流: {dedup_stats['joined']} / 処理済みリンク: {dedup_stats['linked']}\n"
+               f"完了済み索引: {dedup_stats['completed_entries']}件"),
+        inline=False
+    )
+
+    lane_stats = conversation_lanes.get_stats()
+    chat_workers = job_scheduler.get_stats()['chatgpt_text']['workers']
+    embed.add_field(
+        name="会話レーン",
+        value=(f"会話数: {lane_stats['active_conversations']} / 待機: {lane_stats['queued']}\n"
+               f"応答中: {lane_stats['running']}/{chat_workers}\n"
+               f"完了: {lane_stats['completed']} / 受付拒否: {lane_stats['rejected']}"),
+        inline=False
+    )
+
+    action_stats = discord_actions.get_stats()
+    rate_limited = ", ".join(
+        f"{route}: {count}回 {action_stats['rate_limit_seconds'][route]:.1f}秒"
+        for route, count in action_stats['rate_limited'].items()
+    ) or "なし"
+    embed.add_field(
+        name="Discord送信",
+        value=(f"リアクション送信待ち: {action_stats['pending']} / 送信: {action_stats['sent']} / 失敗: {action_stats['failed']}\n"
+               f"打ち消しで省略: {action_stats['coalesced']} / 重複: {action_stats['duplicates']}\n"
+               f"返信: {action_stats['replies']}件 (平均 {action_stats['avg_reply_seconds']:.2f}秒)\n"
+               f"バケット待ち: {action_stats['bucket_wait_seconds']:.1f}秒 / 429待機: {rate_limited}"),
+        inline=False
+    )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='pipeline_stats')
+async def show_pipeline_stats(ctx):
+    """メッセージ処理の段階ごとの所要時間とエラーを表示"""
+    embed = discord.Embed(title="🧩 メッセージ処理パイプライン", color=0x0099ff)
+
+    for name, stats in message_pipeline.get_stats().items():
+        value = (f"実行: {stats['runs']}回 / エラー: {stats['errors']}\n"
+                 f"平均: {stats['avg_seconds'] * 1000:.0f}ms / 最大: {stats['max_seconds'] * 1000:.0f}ms")
+        if stats['last_error']:
+            value += f"\n最後のエラー: {stats['last_error'][:200]}"
+        embed.add_field(name=name, value=value, inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='cache_stats')
+async def show_cache_stats(ctx):
+    """キャッシュのヒット率を表示"""
+    embed = discord.Embed(title="🗃️ キャッシュ統計", color=0x0099ff)
+
+    caches = {
+        'ChatGPT応答': chatgpt_response_cache.get_stats(),
+        '画像OCR': ocr_result_store.get_stats(),
+        '音声文字起こし': transcription_result_store.get_stats(),
+    }
+    for name, stats in caches.items():
+        value = (f"件数: {stats['entries']}/{stats['max_entries']}\n"
+                 f"ヒット: {stats['hits']} / ミス: {stats['misses']}\n"
+                 f"ヒット率: {stats['hit_rate']:.1%}")
+        embed.add_field(name=name, value=value, inline=False)
+
+    if preprocess_stats['images']:
+        saved = preprocess_stats['original_bytes'] - preprocess_stats['output_bytes']
+        ratio = saved / preprocess_stats['original_bytes'] if preprocess_stats['original_bytes'] else 0.0
+        embed.add_field(
+            name="画像前処理（OCR送信前）",
+            value=(f"処理枚数: {preprocess_stats['images']}\n"
+                   f"{preprocess_stats['original_bytes']:,} → {preprocess_stats['output_bytes']:,} bytes\n"
+                   f"削減: {saved:,} bytes ({ratio:.1%})"),
+            inline=False
+        )
+
+    message_stats = message_cache.get_stats()
+    embed.add_field(
+        name="リアクション対象メッセージ",
+        value=(f"件数: {message_stats['entries']}/{message_stats['max_entries']}\n"
+               f"ヒット: {message_stats['hits']} / API取得: {message_stats['fetches']} / 取得失敗: {message_stats['not_found']}"),
+        inline=False
+    )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='api_stats')
+async def show_api_stats(ctx):
+    """OpenAI APIのレート制限状況を表示"""
+    stats = openai_throttler.get_stats()
+    embed = discord.Embed(title="🚦 OpenAI API統計", color=0x0099ff)
+    embed.add_field(name="同時実行上限", value=f"{stats['concurrency_limit']:.1f}", inline=True)
+    embed.add_field(name="実行中", value=stats['in_flight'], inline=True)
+    embed.add_field(name="リクエスト数", value=stats['requests'], inline=True)
+    embed.add_field(name="429発生", value=stats['rate_limited'], inline=True)
+    embed.add_field(name="再試行", value=stats['retries'], inline=True)
+
+    for model, bucket in stats['buckets'].items():
+        value = (f"残りリクエスト: {bucket['remaining_requests'] if bucket['remaining_requests'] is not None else '不明'}\n"
+                 f"残りトークン: {bucket['remaining_tokens'] if bucket['remaining_tokens'] is not None else '不明'}")
+        embed.add_field(name=model, value=value, inline=False)
+
+    hedging_stats = request_hedger.get_stats()
+    if hedging_stats['enabled']:
+        for feature, feature_stats in hedging_stats['features'].items():
+            value = (f"ヘッジ: {feature_stats['hedged']}/{feature_stats['requests']} ({feature_stats['hedge_rate']:.1%})\n"
+                     f"2本目が先着: {feature_stats['hedge_wins']} / 予算切れ: {feature_stats['skipped_budget']}")
+            embed.add_field(name=f"ヘッジ ({feature})", value=value, inline=False)
+
+    # OCRの詳細度の内訳（lowで足りた割合と昇格にかかった時間を調整の目安にする）
+    low_calls = vision_detail_stats['low_only'] + vision_detail_stats['escalated']
+    high_calls = vision_detail_stats['escalated'] + vision_detail_stats['high_direct']
+    if low_calls or high_calls:
+        low_avg = vision_detail_stats['low_seconds'] / low_calls if low_calls else 0.0
+        high_avg = vision_detail_stats['high_seconds'] / high_calls if high_calls else 0.0
+        value = (f"lowのみ: {vision_detail_stats['low_only']} / low→high: {vision_detail_stats['escalated']} / "
+                 f"最初からhigh: {vision_detail_stats['high_direct']}\n"
+                 f"平均: low {low_avg:.2f}秒 ({low_calls}回) / high {high_avg:.2f}秒 ({high_calls}回)")
+        embed.add_field(name="OCR詳細度", value=value, inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='router_stats')
+async def show_router_stats(ctx):
+    """モデル階層ごとの選択回数とレイテンシを表示"""
+    embed = discord.Embed(title="🧭 モデルルーター統計", color=0x0099ff)
+
+    for tier_name, stats in model_router.get_stats().items():
+        p50 = f"{stats['p50']:.1f}秒" if stats['p50'] is not None else "-"
+        p95 = f"{stats['p95']:.1f}秒" if stats['p95'] is not None else "-"
+        reasons = "\n".join(f"・{reason}: {count}" for reason, count in stats['reasons'].items()) or "・なし"
+        value = (f"選択: {stats['decisions']}回 (SLO超過による切り替え: {stats['fallback_in']}) / 失敗: {stats['errors']}\n"
+                 f"p50: {p50} / p95: {p95} (SLO {stats['slo_p95_seconds']:.0f}秒)\n"
+                 f"{reasons}")
+        embed.add_field(name=f"{tier_name} ({stats['model']})", value=value[:1024], inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='token_stats')
+async def show_token_stats(ctx):
+    """機能ごとのトークン予測精度と予約トークンの使用率を表示"""
+    stats = token_budget.get_stats()
+    if not stats:
+        await ctx.send("📭 まだトークン使用量の記録がありません。")
+        return
+
+    embed = discord.Embed(title="🧮 トークン予算統計", color=0x0099ff)
+    for feature, feature_stats in stats.items():
+        value = (f"呼び出し: {feature_stats['calls']}回\n"
+                 f"入力 予測/実際: {feature_stats['predicted_prompt_tokens']:,} / {feature_stats['actual_prompt_tokens']:,} "
+                 f"(誤差 {feature_stats['prompt_error_rate']:+.1%})\n"
+                 f"入力キャッシュ: {feature_stats['cached_prompt_tokens']:,} ({feature_stats['cache_rate']:.1%})\n"
+                 f"出力 予約/実際: {feature_stats['reserved_completion_tokens']:,} / {feature_stats['actual_completion_tokens']:,} "
+                 f"(使用率 {feature_stats['completion_utilization']:.1%})\n"
+                 f"打ち切り: {feature_stats['truncated']} / 入力切り詰め: {feature_stats['trimmed_inputs']} / 拒否: {feature_stats['rejected']}")
+        embed.add_field(name=feature, value=value, inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='chat_reset')
+async def reset_chat_context(ctx):
+    """このチャンネルでの自分との会話履歴をリセット"""
+    removed_turns = conversation_store.clear(ctx.channel.id, ctx.author.id)
+    await ctx.send(f"🧹 会話履歴をリセットしました（{removed_turns}件）。")
+
 @bot.command(name='room_stats')
 async def show_room_stats(ctx):
     """ルーム統計を表示"""
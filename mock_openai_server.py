@@ -0,0 +1,302 @@
+"""
+OpenAI互換モックサーバー
+ボットが使うChat Completions（テキスト・画像）、音声文字起こし、モデル一覧をローカルで模倣し、
+遅延分布・エラー/429の注入・ストリーミングでネットワークなしの負荷試験を可能にする
+
+使い方:
+    python mock_openai_server.py --port 8089 --error-rate 0.05 --rate-limit-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock python main_bot.py
+"""
+
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from aiohttp import web
+from config import MOCK_OPENAI_CONFIG
+from features.token_budget import count_tokens, count_message_tokens
+
+MOCK_SENTENCE = "これはモックサーバーからの応答です。実際のモデルは呼び出していません。"
+MOCK_OCR_TEXT = "（モック）画像から読み取ったテキスト\n1行目のテキスト\n2行目のテキスト"
+MOCK_TRANSCRIPT = "（モック）これは音声の文字起こし結果です。"
+
+class MockOpenAIServer:
+    """遅延・エラー・レート制限を設定どおりに再現するOpenAI互換サーバー"""
+
+    def __init__(self, mock_config):
+        self.config = mock_config
+        self.random = random.Random(mock_config['seed'])
+        self.window_started = time.monotonic()
+        self.used_requests = 0
+        self.used_tokens = 0
+        self.stats = {
+            'requests': 0,
+            'responses': {},
+            'errors_injected': 0,
+            'rate_limited': 0,
+        }
+
+    # ---- 遅延・レート制限 ----
+
+    def sample_latency(self, endpoint):
+        """エンドポイントの遅延分布から待機秒数を取得"""
+        spec = self.config['latency'][endpoint]
+        distribution = spec['distribution']
+        if distribution == 'fixed':
+            return spec['value']
+        if distribution == 'uniform':
+            return self.random.uniform(spec['min'], spec['max'])
+        if distribution == 'lognormal':
+            # 中央値とσ（対数スケール）で指定
+            return spec['median'] * self.random.lognormvariate(0, spec['sigma'])
+        if distribution == 'exponential':
+            return self.random.expovariate(1 / spec['mean'])
+        raise ValueError(f"未対応の遅延分布: {distribution}")
+
+    def _refresh_window(self):
+        """1分ごとに擬似レート制限の残量をリセット"""
+        if time.monotonic() - self.window_started >= 60:
+            self.window_started = time.monotonic()
+            self.used_requests = 0
+            self.used_tokens = 0
+
+    def rate_limit_headers(self):
+        """x-ratelimit-* ヘッダーを作成"""
+        reset_seconds = max(0.0, 60 - (time.monotonic() - self.window_started))
+        return {
+            'x-ratelimit-limit-requests': str(self.config['requests_per_minute']),
+            'x-ratelimit-remaining-requests': str(max(0, self.config['requests_per_minute'] - self.used_requests)),
+            'x-ratelimit-reset-requests': f"{reset_seconds:.3f}s",
+            'x-ratelimit-limit-tokens': str(self.config['tokens_per_minute']),
+            'x-ratelimit-remaining-tokens': str(max(0, self.config['tokens_per_minute'] - self.used_tokens)),
+            'x-ratelimit-reset-tokens': f"{reset_seconds:.3f}s",
+        }
+
+    def error_response(self, status, message, error_type, code, headers=None):
+        """OpenAI形式のエラーレスポンスを作成"""
+        self.stats['responses'][status] = self.stats['responses'].get(status, 0) + 1
+        body = {'error': {'message': message, 'type': error_type, 'param': None, 'code': code}}
+        return web.json_response(body, status=status, headers=headers)
+
+    def check_injected_failure(self, tokens):
+        """擬似レート制限・注入エラーに該当すればエラーレスポンスを返す（該当しなければNone）"""
+        self._refresh_window()
+
+        over_limit = (self.used_requests >= self.config['requests_per_minute']
+                      or self.used_tokens + tokens > self.config['tokens_per_minute'])
+        if over_limit or self.random.random() < self.config['rate_limit_rate']:
+            self.stats['rate_limited'] += 1
+            headers = self.rate_limit_headers()
+            retry_after = float(headers['x-ratelimit-reset-requests'][:-1]) if over_limit else self.random.uniform(0.2, 2.0)
+            headers['retry-after-ms'] = str(int(retry_after * 1000))
+            return self.error_response(429, 'Rate limit reached (mock)', 'requests', 'rate_limit_exceeded', headers)
+
+        if self.random.random() < self.config['error_rate']:
+            self.stats['errors_injected'] += 1
+            return self.error_response(500, 'The server had an error (mock)', 'server_error', None)
+
+        self.used_requests += 1
+        self.used_tokens += tokens
+        return None
+
+    # ---- レスポンス生成 ----
+
+    def build_completion_text(self, model, max_tokens, is_vision):
+        """応答テキストと終了理由を作成（max_tokensを超える分は打ち切り）"""
+        if is_vision:
+            text = MOCK_OCR_TEXT
+        else:
+            low, high = self.config['completion_tokens']
+            target = self.random.randint(low, high)
+            text = ""
+            while count_tokens(text, model) < target:
+                text += MOCK_SENTENCE
+
+        finish_reason = 'stop'
+        if max_tokens and count_tokens(text, model) > max_tokens:
+            # 1文字ずつ削って上限に収める（モックなので精度より単純さを優先）
+            text = text[:max_tokens]
+            while text and count_tokens(text, model) > max_tokens:
+                text = text[:-1]
+            finish_reason = 'length'
+        return text, finish_reason
+
+    def build_usage(self, model, messages, text):
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(text, model)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+
+    # ---- ハンドラー ----
+
+    async def handle_models(self, request):
+        self.stats['requests'] += 1
+        await asyncio.sleep(self.sample_latency('models'))
+        models = ['gpt-4', 'gpt-4o', 'gpt-4o-mini', 'gpt-4-turbo-preview', 'whisper-1']
+        self.stats['responses'][200] = self.stats['responses'].get(200, 0) + 1
+        return web.json_response({
+            'object': 'list',
+            'data': [{'id': model, 'object': 'model', 'created': 0, 'owned_by': 'mock'} for model in models],
+        })
+
+    async def handle_chat_completions(self, request):
+        self.stats['requests'] += 1
+        body = await request.json()
+        model = body.get('model', 'gpt-4')
+        messages = body.get('messages', [])
+        max_tokens = body.get('max_tokens') or body.get('max_completion_tokens')
+        is_vision = any(
+            isinstance(message.get('content'), list)
+            and any(part.get('type') == 'image_url' for part in message['content'])
+            for message in messages
+        )
+
+        failure = self.check_injected_failure(count_message_tokens(messages, model) + (max_tokens or 0))
+        if failure is not None:
+            return failure
+
+        # ストリーミングでは最初のトークンまで、通常は応答全体までの遅延
+        await asyncio.sleep(self.sample_latency('vision' if is_vision else 'chat'))
+
+        text, finish_reason = self.build_completion_text(model, max_tokens, is_vision)
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        headers = self.rate_limit_headers()
+
+        if body.get('stream'):
+            return await self.stream_chat_completion(request, body, model, messages, text, finish_reason,
+                                                     completion_id, created, headers)
+
+        self.stats['responses'][200] = self.stats['responses'].get(200, 0) + 1
+        return web.json_response({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': text},
+                'finish_reason': finish_reason,
+            }],
+            'usage': self.build_usage(model, messages, text),
+        }, headers=headers)
+
+    async def stream_chat_completion(self, request, body, model, messages, text, finish_reason,
+                                     completion_id, created, headers):
+        """SSEで応答を少しずつ送信"""
+        response = web.StreamResponse(headers={**headers, 'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def send_chunk(choices, usage=None):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': choices,
+            }
+            if usage is not None:
+                chunk['usage'] = usage
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+        await send_chunk([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+        for i in range(0, len(text), 2):
+            await send_chunk([{'index': 0, 'delta': {'content': text[i:i+2]}, 'finish_reason': None}])
+            await asyncio.sleep(self.config['stream_token_interval'])
+        await send_chunk([{'index': 0, 'delta': {}, 'finish_reason': finish_reason}])
+
+        if (body.get('stream_options') or {}).get('include_usage'):
+            await send_chunk([], usage=self.build_usage(model, messages, text))
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        self.stats['responses'][200] = self.stats['responses'].get(200, 0) + 1
+        return response
+
+    async def handle_audio_transcriptions(self, request):
+        self.stats['requests'] += 1
+        fields = {}
+        file_size = 0
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'file':
+                file_size = len(await part.read())
+            else:
+                fields[part.name] = await part.text()
+
+        failure = self.check_injected_failure(0)
+        if failure is not None:
+            return failure
+
+        await asyncio.sleep(self.sample_latency('audio'))
+
+        text = f"{MOCK_TRANSCRIPT}（{file_size:,} bytes）"
+        headers = self.rate_limit_headers()
+        self.stats['responses'][200] = self.stats['responses'].get(200, 0) + 1
+        if fields.get('response_format') == 'text':
+            return web.Response(text=text + "\n", headers=headers)
+        return web.json_response({'text': text}, headers=headers)
+
+    async def handle_stats(self, request):
+        """注入したエラーや応答数の集計を返す"""
+        return web.json_response({
+            **self.stats,
+            'responses': {str(status): count for status, count in self.stats['responses'].items()},
+            'rate_limit': self.rate_limit_headers(),
+        })
+
+    def create_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get('/v1/models', self.handle_models)
+        app.router.add_post('/v1/chat/completions', self.handle_chat_completions)
+        app.router.add_post('/v1/audio/transcriptions', self.handle_audio_transcriptions)
+        app.router.add_get('/mock/stats', self.handle_stats)
+        return app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='OpenAI互換モックサーバー')
+    parser.add_argument('--host', default=MOCK_OPENAI_CONFIG['host'])
+    parser.add_argument('--port', type=int, default=MOCK_OPENAI_CONFIG['port'])
+    parser.add_argument('--seed', type=int, default=MOCK_OPENAI_CONFIG['seed'])
+    parser.add_argument('--error-rate', type=float, default=MOCK_OPENAI_CONFIG['error_rate'])
+    parser.add_argument('--rate-limit-rate', type=float, default=MOCK_OPENAI_CONFIG['rate_limit_rate'])
+    parser.add_argument('--requests-per-minute', type=int, default=MOCK_OPENAI_CONFIG['requests_per_minute'])
+    parser.add_argument('--tokens-per-minute', type=int, default=MOCK_OPENAI_CONFIG['tokens_per_minute'])
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='すべての遅延に掛ける倍率（0で遅延なし）')
+    return parser.parse_args()
+
+def build_config(args):
+    """設定ファイルの値にコマンドライン引数を反映"""
+    mock_config = dict(MOCK_OPENAI_CONFIG)
+    mock_config.update({
+        'seed': args.seed,
+        'error_rate': args.error_rate,
+        'rate_limit_rate': args.rate_limit_rate,
+        'requests_per_minute': args.requests_per_minute,
+        'tokens_per_minute': args.tokens_per_minute,
+    })
+
+    latency = {}
+    for endpoint, spec in MOCK_OPENAI_CONFIG['latency'].items():
+        scaled = dict(spec)
+        for key in ('value', 'min', 'max', 'median', 'mean'):
+            if key in scaled:
+                scaled[key] *= args.latency_scale
+        latency[endpoint] = scaled
+    mock_config['latency'] = latency
+    mock_config['stream_token_interval'] = MOCK_OPENAI_CONFIG['stream_token_interval'] * args.latency_scale
+    return mock_config
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = MockOpenAIServer(build_config(args))
+    print(f"🧪 OpenAI互換モックサーバー起動: http://{args.host}:{args.port}/v1")
+    print(f"   エラー率: {args.error_rate:.0%} / 429率: {args.rate_limit_rate:.0%} / "
+          f"RPM: {args.requests_per_minute} / 遅延倍率: {args.latency_scale}")
+    web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
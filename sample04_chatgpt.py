@@ -26,10 +26,14 @@ openai_logger.setLevel(logging.DEBUG)
 bot_logger = logging.getLogger('bot')
 import time
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 import datetime
-import json
-import tiktoken
+from collections import deque
+from features.openai_client import get_openai_client
+from features.openai_throttle import openai_throttler
+from features.token_budget import token_budget, count_tokens, get_cached_tokens, TokenBudgetError
+from features.conversation_store import conversation_store
+from features.conversation_lanes import conversation_lanes, LaneFullError
 
 load_dotenv()
 
@@ -50,7 +54,8 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 if OPENAI_API_KEY:
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        # レート制限を他機能と合わせて管理するため共有クライアントを使用
+        client = get_openai_client()
         print(f'[SETUP] OpenAI APIクライアント初期化完了')
         bot_logger.info(f'OpenAI APIクライアント初期化完了 - キー: {OPENAI_API_KEY[:10]}...')
     except Exception as e:
@@ -60,105 +65,85 @@ else:
     print('[WARNING] OPENAI_API_KEYが設定されていません')
     bot_logger.warning('OPENAI_API_KEYが設定されていません')
 
-# トークンエンコーダー初期化
-try:
-    # GPT-4用のエンコーダー
-    encoding = tiktoken.encoding_for_model("gpt-4")
-    print('[SETUP] Tiktokenエンコーダー初期化完了 (GPT-4対応)')
-except Exception as e:
-    print(f'[WARNING] Tiktokenエンコーダー初期化失敗: {e}')
-    encoding = None
+# 使用モデル（自動プロンプトキャッシュに対応したモデル。gpt-4-turbo系はキャッシュされない）
+CHAT_MODEL = "gpt-4o"
+
+# 毎回同じ内容のシステムプロンプト（先頭が一致するとプロバイダ側のプロンプトキャッシュが効く）
+# キャッシュは入力が1024トークン以上の場合のみ有効なため、このプロンプト単体ではヒットせず、
+# 会話履歴が積み上がって入力が長くなってから効き始める
+SYSTEM_PROMPT = """あなたは親しみやすく知識豊富なDiscordボットのアシスタントです。
+
+特徴:
+- 親しみやすく、フレンドリーな口調で話す
+- 質問には具体的で有用な情報を提供する
+- 必要に応じて絵文字を使用して表現を豊かにする
+- 日本語で返答する
+- 返答は簡潔で分かりやすくする（500文字以内を目安）
+- コード例が必要な場合は、適切にフォーマットして提供する
+- 不適切な内容には応答しない
+
+現在のチャンネル・ユーザー・日時は、最新の発言の直前にシステムメッセージで伝えます。"""
 
 class ChatGPTResponder:
     def __init__(self, openai_client):
         self.client = openai_client
-        self.is_responding = False
-        self.response_history = []  # 会話履歴を保持
-        self.max_tokens = 4000  # GPT-4用最大応答トークン数
-        self.max_context_tokens = 8192  # GPT-4用コンテキスト最大トークン数
-        self.retry_count = 3  # リトライ回数
-        self.rate_limit_delay = 1  # レート制限時の待機時間
+        self.usage_log = deque(maxlen=1000)  # 使用統計用の応答記録（会話履歴はconversation_storeで管理）
+        self.max_tokens = 4000  # GPT-4用最大応答トークン数（実際の値は入力に応じてトークン予算で決定）
+        self.retry_count = 3  # リトライ回数（レート制限・一時的な障害の再試行はスロットラーが担当）
         
     def count_tokens(self, text):
-        """テキストのトークン数をカウント"""
-        if encoding:
-            try:
-                return len(encoding.encode(text))
-            except Exception:
-                return len(text) // 4  # おおよその推定
-        return len(text) // 4  # おおよその推定
+        """テキストのトークン数をカウント（エンコーダーは共有キャッシュを使用）"""
+        return count_tokens(text, CHAT_MODEL)
     
-    def trim_conversation_history(self, messages):
-        """会話履歴をトークン制限内に収める"""
-        if not encoding:
-            return messages[-8:]  # エンコーダーがない場合は直近8件
-        
-        total_tokens = 0
-        trimmed_messages = []
-        
-        # 逆順で処理して、制限内の最新履歴を保持
-        for message in reversed(messages):
-            message_tokens = self.count_tokens(json.dumps(message, ensure_ascii=False))
-            if total_tokens + message_tokens > self.max_context_tokens:
-                break
-            total_tokens += message_tokens
-            trimmed_messages.insert(0, message)
-        
-        return trimmed_messages
-    
-    async def generate_response(self, user_message, user_name, channel_name):
-        """ChatGPTに返答を生成させる（リトライ機能付き）"""
+    async def generate_response(self, user_message, user_name, channel_name, channel_id=None, user_id=None):
+        """ChatGPTに返答を生成させる（リトライ機能付き、履歴はチャンネル×ユーザーごと）"""
         if not self.client:
             return "❌ OpenAI APIが設定されていません。"
         
+        # 長すぎる入力は送信前に切り詰め・拒否
+        try:
+            user_message = token_budget.fit_input('sample04', user_message, CHAT_MODEL)
+        except TokenBudgetError as e:
+            return f"❌ {e}"
+        
         for attempt in range(self.retry_count):
             try:
                 print(f'[GPT-4] {user_name}からのメッセージに応答中 (試行 {attempt + 1}/{self.retry_count}): {user_message[:50]}...')
                 bot_logger.info(f'GPT-4応答生成開始 - ユーザー: {user_name}, 試行: {attempt + 1}, メッセージ: {user_message[:100]}')
             
-                # システムメッセージでボットの性格を定義
-                system_message = {
+                # 固定のシステムプロンプト → 会話履歴の順に並べ、リクエスト間で先頭を一致させる
+                messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+                messages.extend(conversation_store.build_messages(channel_id, user_id))
+                
+                # 毎回変わる状況（チャンネル・ユーザー・日時）は末尾に置いてキャッシュ対象の先頭を崩さない
+                messages.append({
                     "role": "system",
-                    "content": f"""あなたは親しみやすく知識豊富なDiscordボットのアシスタントです。
-
-特徴:
-- 親しみやすく、フレンドリーな口調で話す
-- 質問には具体的で有用な情報を提供する
-- 必要に応じて絵文字を使用して表現を豊かにする
-- 日本語で返答する
-- 返答は簡潔で分かりやすくする（500文字以内を目安）
-- コード例が必要な場合は、適切にフォーマットして提供する
-- 不適切な内容には応答しない
-
-現在の状況:
+                    "content": f"""現在の状況:
 - チャンネル: {channel_name}
 - ユーザー: {user_name}
 - 日時: {datetime.datetime.now().strftime('%Y年%m月%d日 %H時%M分')}"""
-                }
-                
-                # 会話履歴を含むメッセージを作成
-                messages = [system_message]
-                
-                # 最近の履歴を含める（GPT-4のコンテキストを活用）
-                recent_history = self.response_history[-8:] if self.response_history else []
-                for hist in recent_history:
-                    messages.append({"role": "user", "content": hist["user_message"]})
-                    messages.append({"role": "assistant", "content": hist["bot_response"]})
+                })
                 
                 # 現在のユーザーメッセージを追加
                 messages.append({"role": "user", "content": user_message})
-                
-                # トークン制限内に履歴を調整
-                messages = self.trim_conversation_history(messages)
+            
+                # 応答の想定長とコンテキスト長の残りからmax_tokensを決定
+                budget = token_budget.plan('sample04', CHAT_MODEL, messages, self.max_tokens,
+                                           expected_completion_tokens=token_budget.expected_answer_tokens(user_message, CHAT_MODEL))
             
                 # GPT-4 Chat Completions API呼び出し
-                bot_logger.debug(f'API呼び出し開始 - メッセージ数: {len(messages)}, モデル: gpt-4-turbo-preview')
-                response = self.client.chat.completions.create(
-                    model="gpt-4-turbo-preview",
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=0.7,
-                    user=f"discord_user_{hash(user_name) % 10000}"  # ユーザー識別用
+                bot_logger.debug(f'API呼び出し開始 - メッセージ数: {len(messages)}, モデル: {CHAT_MODEL}, '
+                                 f'予測入力トークン: {budget["prompt_tokens"]}, max_tokens: {budget["max_tokens"]}')
+                response = await openai_throttler.call(
+                    CHAT_MODEL,
+                    lambda: self.client.chat.completions.with_raw_response.create(
+                        model=CHAT_MODEL,
+                        messages=messages,
+                        max_tokens=budget['max_tokens'],
+                        temperature=0.7,
+                        user=f"discord_user_{hash(user_name) % 10000}"  # ユーザー識別用
+                    ),
+                    estimated_tokens=budget['prompt_tokens'] + budget['max_tokens']
                 )
                 bot_logger.debug(f'API呼び出し完了 - レスポンス受信')
 
@@ -166,26 +151,40 @@ class ChatGPTResponder:
 
                 # 使用量情報をログに記録
                 usage = response.usage
-                print(f'[API] トークン使用量 - 入力: {usage.prompt_tokens}, 出力: {usage.completion_tokens}, 合計: {usage.total_tokens}')
-                bot_logger.info(f'トークン使用量 - 入力: {usage.prompt_tokens}, 出力: {usage.completion_tokens}, 合計: {usage.total_tokens}')
+                token_budget.record_usage(budget, usage, response.choices[0].finish_reason)
+                cached_tokens = get_cached_tokens(usage)
+                print(f'[API] トークン使用量 - 入力: {usage.prompt_tokens} (キャッシュ: {cached_tokens}), 出力: {usage.completion_tokens}, 合計: {usage.total_tokens}')
+                bot_logger.info(f'トークン使用量 - 入力: {usage.prompt_tokens} (キャッシュ: {cached_tokens}), 出力: {usage.completion_tokens}, 合計: {usage.total_tokens}')
                 
-                # 履歴に追加（最大10件まで保持）
-                self.response_history.append({
-                    "user_name": user_name,
-                    "user_message": user_message,
-                    "bot_response": ai_response,
+                # 会話履歴に追加（件数・トークン数の上限を超えた古いターンはストア側で削除）
+                conversation_store.add_turn(channel_id, user_id, user_message, ai_response, CHAT_MODEL)
+                self.usage_log.append({
                     "timestamp": datetime.datetime.now().isoformat(),
-                    "tokens_used": usage.total_tokens
+                    "tokens_used": usage.total_tokens,
+                    "prompt_tokens": usage.prompt_tokens,
+                    "cached_tokens": cached_tokens
                 })
                 
-                # 履歴が10件を超えたら古いものを削除
-                if len(self.response_history) > 10:
-                    self.response_history = self.response_history[-10:]
-                
                 print(f'[GPT-4] 応答生成完了: {ai_response[:50]}...')
                 bot_logger.info(f'GPT-4応答生成完了 - 文字数: {len(ai_response)}, 内容: {ai_response[:100]}...')
                 return ai_response
                 
+            except TokenBudgetError as e:
+                return f"❌ {e}"
+
+            except RateLimitError as e:
+                # スロットラーがバックオフ付きで再試行済みなので、ここでは待たずに返す
+                if getattr(e, 'code', None) == 'insufficient_quota':
+                    return "❌ OpenAI APIの利用枠を超過しました。APIキーの残高を確認してください。"
+                print(f'[WARNING] レート制限により応答できませんでした: {e}')
+                bot_logger.warning(f'レート制限により応答失敗: {e}')
+                return "❌ OpenAI APIが混雑しています。少し時間をおいてから再度お試しください。"
+
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                print(f'[ERROR] API通信エラー（再試行上限）: {type(e).__name__} - {e}')
+                bot_logger.error(f'API通信エラー（再試行上限）: {type(e).__name__} - {e}')
+                return f"❌ GPT-4との通信中にエラーが発生しました: {type(e).__name__}"
+
             except Exception as e:
                 error_type = type(e).__name__
                 error_message = str(e)
@@ -194,11 +193,7 @@ class ChatGPTResponder:
                 bot_logger.error(f'API呼び出しエラー (試行 {attempt + 1}): {error_type} - {error_message}', exc_info=True)
                 
                 # 特定のエラーに対する対応
-                if "rate_limit" in error_message.lower():
-                    print(f'[WARNING] レート制限検出。{self.rate_limit_delay * (attempt + 1)}秒待機中...')
-                    await asyncio.sleep(self.rate_limit_delay * (attempt + 1))
-                    continue
-                elif "insufficient_quota" in error_message.lower():
+                if "insufficient_quota" in error_message.lower():
                     return "❌ OpenAI APIの利用枠を超過しました。APIキーの残高を確認してください。"
                 elif "invalid_api_key" in error_message.lower():
                     return "❌ OpenAI APIキーが無効です。設定を確認してください。"
@@ -214,17 +209,21 @@ class ChatGPTResponder:
     
     def get_usage_stats(self):
         """使用統計を取得"""
-        total_tokens = sum(h.get('tokens_used', 0) for h in self.response_history)
-        recent_responses = [h for h in self.response_history 
+        total_tokens = sum(h.get('tokens_used', 0) for h in self.usage_log)
+        recent_responses = [h for h in self.usage_log 
                            if (datetime.datetime.now() - datetime.datetime.fromisoformat(h['timestamp'])).seconds < 3600]
         recent_tokens = sum(h.get('tokens_used', 0) for h in recent_responses)
+        prompt_tokens = sum(h.get('prompt_tokens', 0) for h in self.usage_log)
+        cached_tokens = sum(h.get('cached_tokens', 0) for h in self.usage_log)
         
         return {
-            "total_responses": len(self.response_history),
+            "total_responses": len(self.usage_log),
             "recent_responses": len(recent_responses),
             "total_tokens": total_tokens,
             "recent_tokens": recent_tokens,
-            "estimated_cost_usd": total_tokens * 0.00001  # GPT-4 Turboのおおよそのコスト計算（仮定値、実際の料金は要確認）
+            "cached_tokens": cached_tokens,
+            "cache_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "estimated_cost_usd": total_tokens * 0.00001  # GPT-4oのおおよそのコスト計算（仮定値、実際の料金は要確認）
         }
 
 # GPT-4応答者初期化
@@ -284,21 +283,19 @@ async def on_message(message):
                            "設定方法: `!gptinfo` コマンドで詳細確認")
         return
     
-    # 応答中の重複処理を防ぐ
-    if chatgpt_responder.is_responding:
-        await message.add_reaction("⏳")  # 処理中を示すリアクション
-        return
+    # 会話（チャンネル×ユーザー）ごとに順番に応答し、別の会話は並列に処理
+    conversation_key = conversation_lanes.make_key(message.channel.id, message.author.id)
     
-    try:
-        chatgpt_responder.is_responding = True
-        
+    async def respond():
         # タイピング中を表示
         async with message.channel.typing():
             # GPT-4に応答生成を依頼
             ai_response = await chatgpt_responder.generate_response(
                 user_message=message.content,
                 user_name=str(message.author),
-                channel_name=message.channel.name
+                channel_name=message.channel.name,
+                channel_id=message.channel.id,
+                user_id=message.author.id
             )
         
         # 応答が長すぎる場合は分割
@@ -319,14 +316,18 @@ async def on_message(message):
             await message.reply(f"🤖 **GPT-4からの返答**\n\n{ai_response}")
         
         print(f'[SUCCESS] GPT-4応答送信完了')
-        
+    
+    try:
+        await conversation_lanes.run(conversation_key, respond)
+    
+    except LaneFullError:
+        # 同じ会話の待ちが多すぎる場合のみ受付を断る
+        await message.add_reaction("⏳")
+    
     except Exception as e:
         print(f'[ERROR] メッセージ処理中にエラー: {e}')
         await message.reply(f"❌ 処理中にエラーが発生しました: {str(e)}")
     
-    finally:
-        chatgpt_responder.is_responding = False
-    
     # コマンドも処理（必要に応じて）
     await bot.process_commands(message)
 
@@ -341,9 +342,9 @@ async def gpt_info(ctx):
     
     embed.add_field(name="🎯 対象チャンネル", value=f"<#{TARGET_CHANNEL_ID}>", inline=False)
     embed.add_field(name="🔧 動作方式", value="メッセージ投稿 → 自動でChatGPTが返答", inline=False)
-    embed.add_field(name="💡 使用モデル", value="GPT-4 Turbo 🚀", inline=True)
+    embed.add_field(name="💡 使用モデル", value=f"{CHAT_MODEL} 🚀", inline=True)
     embed.add_field(name="📝 文字数制限", value="2000文字（自動分割対応）", inline=True)
-    embed.add_field(name="🧠 記憶機能", value="直近10回の会話を記憶", inline=True)
+    embed.add_field(name="🧠 記憶機能", value="ユーザーごとに直近10回の会話を記憶", inline=True)
     
     # 使用統計
     if chatgpt_responder:
@@ -352,7 +353,10 @@ async def gpt_info(ctx):
                        value=f"総応答数: {stats['total_responses']}\n直近1時間: {stats['recent_responses']}", 
                        inline=True)
         embed.add_field(name="💰 トークン使用量", 
-                       value=f"総計: {stats['total_tokens']:,}\n直近1時間: {stats['recent_tokens']:,}\n推定コスト: ${stats['estimated_cost_usd']:.4f}", 
+                       value=f"総計: {stats['total_tokens']:,}\n直近1時間: {stats['recent_tokens']:,}\n"
+                             f"入力キャッシュ: {stats['cached_tokens']:,} ({stats['cache_rate']:.1%})\n"
+                             f"推定コスト: ${stats['estimated_cost_usd']:.4f}\n"
+                             f"※入力キャッシュは入力1024トークン以上の場合のみ（短い会話では0のまま）", 
                        inline=True)
         
         embed.add_field(name="✅ API状態", value="正常動作中", inline=True)
@@ -376,8 +380,7 @@ async def gpt_clear(ctx):
         await ctx.send("❌ ChatGPT機能が利用できません。")
         return
     
-    old_count = len(chatgpt_responder.response_history)
-    chatgpt_responder.response_history = []
+    old_count = conversation_store.clear(ctx.channel.id)
     
     embed = discord.Embed(
         title="🧹 会話履歴クリア完了",
@@ -407,7 +410,9 @@ async def gpt_test(ctx):
             response = await chatgpt_responder.generate_response(
                 user_message=test_message,
                 user_name=str(ctx.author),
-                channel_name=ctx.channel.name
+                channel_name=ctx.channel.name,
+                channel_id=ctx.channel.id,
+                user_id=ctx.author.id
             )
         
         embed = discord.Embed(
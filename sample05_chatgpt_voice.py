@@ -8,6 +8,7 @@ import tempfile
 from dotenv import load_dotenv
 from openai import OpenAI
 import datetime
+from features.voice_transcribe import lookup_cached_transcription, store_cached_transcription
 
 # ログ設定を強化
 logging.basicConfig(
@@ -103,10 +104,17 @@ class VoiceTranscriber:
             bot_logger.info(f'文字起こし開始: {file_path}')
 
             with open(file_path, 'rb') as audio_file:
+                audio_data = audio_file.read()
+
+            # 同じ音声の結果があればWhisperを呼ばずに再利用（main_botと共有のキャッシュ）
+            transcribed_text = await lookup_cached_transcription(audio_data, "ja")
+            if transcribed_text is not None:
+                bot_logger.info(f'文字起こしキャッシュヒット: {len(transcribed_text)} 文字')
+            else:
                 # GPT-4oを使用した高品質な文字起こし
                 transcription = self.client.audio.transcriptions.create(
                     model="gpt-4o-transcribe",  # 最新の高品質モデル
-                    file=audio_file,
+                    file=(original_filename, audio_data),
                     response_format="text",
                     language="ja",  # 日本語を明示的に指定
                     prompt="以下は日本語の音声です。正確に文字起こしをしてください。句読点も適切に付けてください。"  # 日本語用プロンプト
@@ -114,20 +122,21 @@ class VoiceTranscriber:
 
                 transcribed_text = transcription.strip()
                 bot_logger.info(f'文字起こし完了: {len(transcribed_text)} 文字')
+                await store_cached_transcription(audio_data, "ja", transcribed_text)
 
-                # 履歴に保存
-                self.transcription_history.append({
-                    "filename": original_filename,
-                    "text": transcribed_text,
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "text_length": len(transcribed_text)
-                })
+            # 履歴に保存
+            self.transcription_history.append({
+                "filename": original_filename,
+                "text": transcribed_text,
+                "timestamp": datetime.datetime.now().isoformat(),
+                "text_length": len(transcribed_text)
+            })
 
-                # 履歴が20件を超えたら古いものを削除
-                if len(self.transcription_history) > 20:
-                    self.transcription_history = self.transcription_history[-20:]
+            # 履歴が20件を超えたら古いものを削除
+            if len(self.transcription_history) > 20:
+                self.transcription_history = self.transcription_history[-20:]
 
-                return transcribed_text, None
+            return transcribed_text, None
 
         except Exception as e:
             bot_logger.error(f'文字起こしエラー: {e}', exc_info=True)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+features/audio_chunking.pyのテスト用スクリプト
+区間の分け方と文字起こし結果の結合をローカルで確認します（ffmpeg不要）
+"""
+
+import os
+import importlib.util
+
+def load_audio_chunking():
+    """features/__init__.py（ログ用ファイルを作る機能を含む）を経由せずにaudio_chunkingだけを読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'features', 'audio_chunking.py')
+    spec = importlib.util.spec_from_file_location('audio_chunking', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+audio_chunking = load_audio_chunking()
+
+def test_plan_segments():
+    """区間の開始位置・重なり・最後の短い区間を確認"""
+    print("=== 区間分割テスト ===")
+
+    segments = audio_chunking.plan_segments(650, 300, 5)
+    print(f"   650秒: {segments}")
+    assert segments == [(0.0, 300), (295.0, 300), (590.0, 60.0)]
+    # 隣り合う区間は重なり秒数だけ重なる
+    for (start, length), (next_start, _) in zip(segments, segments[1:]):
+        assert start + length - next_start == 5
+    print("✅ 重なり付きで分割し、最後は残りの長さだけ")
+
+    segments = audio_chunking.plan_segments(300, 300, 5)
+    assert segments == [(0.0, 300)]
+    print("✅ 区間の長さちょうどなら1区間")
+
+    segments = audio_chunking.plan_segments(600, 300, 5)
+    print(f"   600秒: {segments}")
+    assert segments == [(0.0, 300), (295.0, 300), (590.0, 10.0)]
+    assert segments[-1][0] + segments[-1][1] == 600
+    print("✅ 最後の短い区間も末尾まで含む")
+
+def test_stitch_transcripts():
+    """重なり部分の重複除去と、一致しない場合の単純結合を確認"""
+    print("=== 文字起こし結合テスト ===")
+
+    merged = audio_chunking.stitch_transcripts([
+        "今日は良い天気です。明日も晴れるでしょう。",
+        "明日も晴れるでしょう。週末は雨の予報です。",
+    ])
+    print(f"   結果: {merged}")
+    assert merged == "今日は良い天気です。明日も晴れるでしょう。週末は雨の予報です。"
+    print("✅ 末尾と先頭の一致部分を1回だけ残して結合")
+
+    merged = audio_chunking.stitch_transcripts(["最初の区間です。", "まったく別の内容。"])
+    print(f"   結果: {merged}")
+    assert merged == "最初の区間です。\nまったく別の内容。"
+    print("✅ 一致しなければ改行でつないで結合")
+
+    merged = audio_chunking.stitch_transcripts(["  前の区間  ", "", "後の区間"])
+    assert merged == "前の区間\n後の区間"
+    print("✅ 空の区間は読み飛ばす")
+
+if __name__ == '__main__':
+    test_plan_segments()
+    test_stitch_transcripts()
+    print(f"\n=== テスト完了 ===")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+features/reply_delivery.pyのテスト用スクリプト
+長文の分割（コードブロックの開き直し・長い行の分割）とファイル送信への切り替えをローカルで確認します
+"""
+
+import os
+import sys
+import types
+import asyncio
+import importlib
+
+def load_feature(name):
+    """features/__init__.py（ログ用ファイルを作る機能を含む）を経由せずに機能モジュールを読み込む"""
+    if 'features' not in sys.modules:
+        package = types.ModuleType('features')
+        package.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'features')]
+        sys.modules['features'] = package
+    return importlib.import_module(f'features.{name}')
+
+reply_delivery = load_feature('reply_delivery')
+
+def assert_within_limit(chunks, limit):
+    for chunk in chunks:
+        assert len(chunk) <= limit, f"{len(chunk)}文字 > {limit}文字"
+
+def test_split_lines():
+    """行の境界で上限以内に分割され、つなぎ直すと元に戻ることを確認"""
+    print("=== 行単位の分割テスト ===")
+
+    text = "\n".join(f"{i}行目のテキストです。" for i in range(40))
+    chunks = reply_delivery.split_text(text, 100)
+    print(f"   {len(text)}文字 -> {len(chunks)}チャンク")
+    assert len(chunks) > 1
+    assert_within_limit(chunks, 100)
+    assert "\n".join(chunks) == text
+    print("✅ 上限以内に分割し、つなぎ直すと元のテキスト")
+
+    head, rest = reply_delivery.split_first_chunk(text, 100)
+    assert len(head) <= 100
+    assert head + "\n" + rest == text
+    print("✅ 先頭のチャンクと残りに分けても元に戻る")
+
+def test_split_code_fence():
+    """コードブロックの途中で分割したら閉じて、同じ言語指定で開き直すことを確認"""
+    print("=== コードブロック分割テスト ===")
+
+    code = "\n".join(f"print('line {i}')" for i in range(30))
+    text = f"説明です。\n```python\n{code}\n```\n以上です。"
+    chunks = reply_delivery.split_text(text, 120)
+    print(f"   {len(text)}文字 -> {len(chunks)}チャンク")
+    assert len(chunks) > 1
+    assert_within_limit(chunks, 120)
+
+    for chunk, next_chunk in zip(chunks, chunks[1:]):
+        if chunk.endswith("\n```") and next_chunk.startswith("```python\n"):
+            continue
+        assert chunk.count("```") % 2 == 0, chunk
+    assert chunks[1].startswith("```python\n")
+    print("✅ 分割位置で閉じ、次のチャンクで```pythonとして開き直す")
+
+    # 分割のために追加した閉じ・開き直しの行を除くと元のテキストに戻る
+    restored = list(chunks)
+    for i in range(len(restored) - 1):
+        if restored[i].endswith("\n```") and restored[i + 1].startswith("```python\n"):
+            restored[i] = restored[i][:-len("\n```")]
+            restored[i + 1] = restored[i + 1][len("```python\n"):]
+    assert "\n".join(restored) == text
+    print("✅ 追加した閉じ・開き直しを除くと元のテキスト")
+
+    head, rest = reply_delivery.split_first_chunk(text, 120)
+    assert head.endswith("\n```")
+    assert rest.startswith("```python\n")
+    print("✅ 先頭で切った残りはコードブロックを開き直した状態")
+
+def test_split_long_line():
+    """上限より長い1行が上限以内の断片に分割されることを確認"""
+    print("=== 長い行の分割テスト ===")
+
+    line = "とても長い文です。" * 40
+    chunks = reply_delivery.split_text(line, 50)
+    print(f"   {len(line)}文字の1行 -> {len(chunks)}チャンク")
+    assert len(chunks) > 1
+    assert_within_limit(chunks, 50)
+    assert "".join(chunk.replace("\n", "") for chunk in chunks) == line
+    # 句読点の直後で切れている
+    assert all(chunk.split("\n")[0].endswith("。") for chunk in chunks[:-1])
+    print("✅ 句読点の位置で上限以内に分割")
+
+    line = "x" * 130
+    pieces = reply_delivery.split_long_line(line, 50)
+    assert [len(piece) for piece in pieces] == [50, 50, 30]
+    print("✅ 区切りがなければ上限の位置で分割")
+
+class RecordingActions:
+    """返信内容を記録するだけのdiscord_actionsの代わり"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply(self, message, content, **kwargs):
+        self.replies.append((content, kwargs))
+        return len(self.replies)
+
+def test_file_fallback():
+    """分割数がmax_chunksを超える場合は添付ファイル1つで送ることを確認"""
+    print("=== ファイル送信切り替えテスト ===")
+
+    original_actions = reply_delivery.discord_actions
+    actions = RecordingActions()
+    reply_delivery.discord_actions = actions
+    try:
+        short_text = "短い返信です。"
+        asyncio.run(reply_delivery.send_long_reply(None, short_text, "結果", "result.txt"))
+        assert len(actions.replies) == 1 and 'file' not in actions.replies[0][1]
+        print("✅ 短い返信はそのまま1件")
+
+        actions.replies.clear()
+        max_length = reply_delivery.CHATGPT_CONFIG['max_message_length']
+        max_chunks = reply_delivery.REPLY_DELIVERY_CONFIG['max_chunks']
+        long_text = "\n".join("長い返信の行です。" * 10 for _ in range(max_length * (max_chunks + 1) // 90))
+        first = asyncio.run(reply_delivery.send_long_reply(None, long_text, "結果", "result.txt"))
+        content, kwargs = actions.replies[0]
+        print(f"   {len(long_text)}文字 -> 返信{len(actions.replies)}件")
+        assert len(actions.replies) == 1 and first == 1
+        assert kwargs['file'].filename == "result.txt"
+        assert len(content) <= max_length
+        assert kwargs['file'].fp.read().decode('utf-8') == long_text
+        print("✅ 分割数が多い場合は添付ファイル1つで全文を送信")
+    finally:
+        reply_delivery.discord_actions = original_actions
+
+if __name__ == '__main__':
+    test_split_lines()
+    test_split_code_fence()
+    test_split_long_line()
+    test_file_fallback()
+    print(f"\n=== テスト完了 ===")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+features/trigger_registry.pyのテスト用スクリプト
+キーワードの照合結果をローカルで確認します
+"""
+
+import os
+import importlib.util
+
+def load_trigger_registry():
+    """features/__init__.py（ログ用ファイルを作る機能を含む）を経由せずにtrigger_registryだけを読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'features', 'trigger_registry.py')
+    spec = importlib.util.spec_from_file_location('trigger_registry', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+TriggerRegistry = load_trigger_registry().TriggerRegistry
+
+def test_same_start_collision():
+    """同じ位置から始まる別の機能のキーワードが両方とも一致することを確認"""
+    print("=== 同じ位置のキーワード衝突テスト ===")
+
+    registry = TriggerRegistry({
+        'chatgpt_text': ['chat'],
+        'chat_collect': ['chat collect'],
+    })
+
+    matched = registry.match("chat collectして")
+    print(f"   結果: {matched}")
+    assert matched == {'chatgpt_text': 'chat', 'chat_collect': 'chat collect'}
+    print("✅ 両方の機能が一致")
+
+    matched = registry.match("CHAT だけ")
+    print(f"   結果: {matched}")
+    assert matched == {'chatgpt_text': 'chat'}
+    print("✅ 短いキーワードのみの場合は1機能だけ一致")
+
+def test_keyword_update():
+    """キーワード変更後の照合で正規表現が作り直されることを確認"""
+    print("=== キーワード変更テスト ===")
+
+    registry = TriggerRegistry({'room_stats': ['統計']})
+    assert registry.match("ルーム統計") == {'room_stats': '統計'}
+
+    builds = registry.builds
+    registry.match("統計")
+    assert registry.builds == builds
+    print("✅ キーワードが変わらなければ作り直さない")
+
+    registry.set_keywords('room_stats', ['stats'])
+    assert registry.match("ルーム統計") == {}
+    assert registry.match("room stats") == {'room_stats': 'stats'}
+    assert registry.builds == builds + 1
+    print("✅ 変更後の照合で作り直し")
+
+if __name__ == '__main__':
+    test_same_start_collision()
+    test_keyword_update()
+    print(f"\n=== テスト完了 ===")